@@ -0,0 +1,2 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
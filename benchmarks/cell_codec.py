@@ -0,0 +1,330 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Micro-benchmarks for the cell hot path.
+
+    Every implemented cell type is built from raw bytes and timed
+    through:
+
+        - Cell.parse()
+        - Cell.enoughDataForCell()
+        - getBytes() and getPayload()
+
+    along with RelayDataCell.make() and Connection.dataReceived() framing
+    a synthetic stream of encrypted RELAY cells (several megabytes, fed
+    to the connection in TLS-record-sized chunks).
+
+    Each benchmark reports cells per second and objects allocated per
+    cell. Python 2 has no tracemalloc, so allocations are counted as the
+    number of new garbage-collected objects (cells, headers, lists, etc.)
+    each call leaves behind, with collection turned off and every result
+    kept alive. Strings aren't tracked by the collector and aren't
+    counted.
+
+    Results can be saved to a JSON baseline and later runs compared
+    against it::
+
+        python -m benchmarks.cell_codec --save baseline.json
+        python -m benchmarks.cell_codec --compare baseline.json
+
+    With --compare, the exit status is non-zero if any benchmark got
+    slower than the baseline by more than --tolerance percent, or
+    allocates more objects per cell than it used to.
+
+'''
+import argparse
+import gc
+import json
+import platform
+import struct
+import sys
+import time
+
+from oppy.cell.cell import Cell
+from oppy.cell.definitions import (
+    AUTH_CHALLENGE_CMD,
+    CERTS_CMD,
+    CREATE2_CMD,
+    CREATED2_CMD,
+    DESTROY_CMD,
+    MAX_RPAYLOAD_LEN,
+    NETINFO_CMD,
+    PADDING_CMD,
+    RECOGNIZED,
+    RELAY_CMD,
+    RELAY_CONNECTED_CMD,
+    RELAY_DATA_CMD,
+    RELAY_DROP_CMD,
+    RELAY_END_CMD,
+    RELAY_EXTEND2_CMD,
+    RELAY_EXTENDED2_CMD,
+    RELAY_SENDME_CMD,
+    RELAY_TRUNCATED_CMD,
+    VERSIONS_CMD,
+    VPADDING_CMD,
+)
+from oppy.cell.fixedlen import FixedLenCell
+from oppy.cell.relay import RelayBeginCell, RelayDataCell, RelayExtend2Cell
+from oppy.cell.util import LinkSpecifier
+from oppy.connection.connection import Connection, ConnState
+from oppy.util.exitrequest import ExitRequest
+
+
+CIRC_ID = 1
+STREAM_ID = 1
+# tor relays write at most one 16 KiB TLS record at a time
+READ_SIZE = 16384
+TIMING_RUNS = 3
+
+
+def fixedCell(cmd, payload):
+    return FixedLenCell.padCellBytes(struct.pack('!HB', CIRC_ID, cmd) +
+                                     payload)
+
+
+def varCell(cmd, payload, circ_id=CIRC_ID):
+    return struct.pack('!HBH', circ_id, cmd, len(payload)) + payload
+
+
+def relayCell(relay_cmd, rpayload, stream_id=STREAM_ID):
+    rheader = struct.pack('!B2sH4sH', relay_cmd, RECOGNIZED, stream_id,
+                          '\x00' * 4, len(rpayload))
+    return fixedCell(RELAY_CMD, rheader + rpayload)
+
+
+# raw bytes of one cell of each implemented type that oppy can parse
+SAMPLES = [
+    ('Create2Cell', fixedCell(CREATE2_CMD, struct.pack('!HH', 2, 84) +
+                              '\x01' * 84)),
+    ('Created2Cell', fixedCell(CREATED2_CMD, struct.pack('!H', 64) +
+                               '\x01' * 64)),
+    ('DestroyCell', fixedCell(DESTROY_CMD, '\x00')),
+    ('NetInfoCell', fixedCell(NETINFO_CMD, struct.pack(
+        '!IBB4sBBB4s', 0, 4, 4, '\x7f\x00\x00\x01', 1, 4, 4,
+        '\x7f\x00\x00\x01'))),
+    ('PaddingCell', fixedCell(PADDING_CMD, '')),
+    ('AuthChallengeCell', varCell(AUTH_CHALLENGE_CMD, '\x01' * 32 +
+                                  struct.pack('!HH', 1, 1))),
+    ('CertsCell', varCell(CERTS_CMD, struct.pack('!B', 2) +
+                          struct.pack('!BH', 1, 600) + '\x01' * 600 +
+                          struct.pack('!BH', 2, 400) + '\x02' * 400)),
+    ('VersionsCell', varCell(VERSIONS_CMD, struct.pack('!HH', 3, 4), 0)),
+    ('VPaddingCell', varCell(VPADDING_CMD, '\x00' * 32)),
+    ('RelayDataCell', relayCell(RELAY_DATA_CMD, '\x01' * MAX_RPAYLOAD_LEN)),
+    ('RelayEndCell', relayCell(RELAY_END_CMD, '\x06')),
+    ('RelayConnectedCell', relayCell(RELAY_CONNECTED_CMD,
+                                     '\x7f\x00\x00\x01' +
+                                     struct.pack('!I', 300))),
+    ('RelaySendMeCell', relayCell(RELAY_SENDME_CMD, '', 0)),
+    ('RelayExtend2Cell', relayCell(RELAY_EXTEND2_CMD, struct.pack(
+        '!BBB4sHHH', 1, 0, 6, '\x7f\x00\x00\x01', 9001, 2, 84) +
+        '\x01' * 84, 0)),
+    ('RelayExtended2Cell', relayCell(RELAY_EXTENDED2_CMD,
+                                     struct.pack('!H', 64) + '\x01' * 64,
+                                     0)),
+    ('RelayTruncatedCell', relayCell(RELAY_TRUNCATED_CMD, '\x01', 0)),
+    ('RelayDropCell', relayCell(RELAY_DROP_CMD, '')),
+]
+
+
+class FakeRelay(object):
+    address = '127.0.0.1'
+    or_port = 9001
+
+
+class CollectingCircuit(object):
+    '''Stands in for a circuit and keeps every cell it's given.'''
+
+    def __init__(self):
+        self.cells = []
+
+    def recvCell(self, cell):
+        self.cells.append(cell)
+
+
+def measure(func, args, repeat):
+    '''Call *func* once per item in *args*, *repeat* times over, and
+    time the fastest of TIMING_RUNS such runs.
+
+    :returns: **tuple** (calls per second, allocated objects per call)
+    '''
+    # count allocations on a single pass with every result kept alive
+    results = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for arg in args:
+            results.append(func(arg))
+        allocs = float(len(gc.get_objects()) - before) / len(args)
+    finally:
+        gc.enable()
+    del results
+
+    # take the best of a few runs to keep noise out of comparisons
+    best = None
+    for _ in xrange(TIMING_RUNS):
+        start = time.time()
+        for _ in xrange(repeat):
+            for arg in args:
+                func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (repeat * len(args)) / best, allocs
+
+
+def benchParse(n):
+    results = {}
+    for name, data in SAMPLES:
+        results['parse/' + name] = measure(Cell.parse, [data] * 100,
+                                           n // 100)
+    encrypted = dict(SAMPLES)['RelayDataCell']
+    results['parse/EncryptedCell'] = measure(
+        lambda d: Cell.parse(d, encrypted=True), [encrypted] * 100, n // 100)
+    return results
+
+
+def benchEnoughData(n):
+    fixed = dict(SAMPLES)['RelayDataCell']
+    var = dict(SAMPLES)['CertsCell']
+    return {
+        'enoughDataForCell/fixed': measure(Cell.enoughDataForCell,
+                                           [fixed] * 100, n // 100),
+        'enoughDataForCell/varlen': measure(Cell.enoughDataForCell,
+                                            [var] * 100, n // 100),
+    }
+
+
+def benchSerialize(n):
+    # parsed EXTEND2 cells keep their link specifiers as raw bytes, so
+    # build the one to serialize the way a circuit does
+    cells = [(name, Cell.parse(data)) for name, data in SAMPLES
+             if name != 'RelayExtend2Cell']
+    cells.append(('RelayExtend2Cell', RelayExtend2Cell.make(
+        CIRC_ID, lspecs=[LinkSpecifier(FakeRelay())], hdata='\x01' * 84)))
+    encrypted = Cell.parse(dict(SAMPLES)['RelayDataCell'], encrypted=True)
+    cells.append(('EncryptedCell', encrypted))
+    request = ExitRequest(struct.pack('!H', 80), addr=u'127.0.0.1')
+    cells.append(('RelayBeginCell',
+                  RelayBeginCell.make(CIRC_ID, STREAM_ID, request)))
+
+    results = {}
+    for name, cell in cells:
+        results['getBytes/' + name] = measure(lambda c: c.getBytes(),
+                                              [cell] * 100, n // 100)
+        results['getPayload/' + name] = measure(lambda c: c.getPayload(),
+                                                [cell] * 100, n // 100)
+    return results
+
+
+def benchMake(n):
+    data = '\x01' * MAX_RPAYLOAD_LEN
+    return {
+        'make/RelayDataCell': measure(
+            lambda d: RelayDataCell.make(CIRC_ID, STREAM_ID, d),
+            [data] * 100, n // 100),
+    }
+
+
+def benchDataReceived(megabytes):
+    cell = dict(SAMPLES)['RelayDataCell']
+    num_cells = (megabytes * 2 ** 20) // len(cell)
+    stream = cell * num_cells
+    chunks = [stream[i:i + READ_SIZE]
+              for i in xrange(0, len(stream), READ_SIZE)]
+
+    def frame(chunks):
+        conn = Connection(FakeRelay())
+        conn._state = ConnState.OPEN
+        circuit = CollectingCircuit()
+        conn._circuit_map[CIRC_ID] = circuit
+        for chunk in chunks:
+            conn.dataReceived(chunk)
+        assert len(circuit.cells) == num_cells
+        return circuit
+
+    rate, allocs = measure(frame, [chunks], 1)
+    # measure() counts whole streams; report per cell instead
+    name = 'dataReceived/{}MiB'.format(megabytes)
+    return {name: (rate * num_cells, allocs / num_cells)}
+
+
+def run(n, megabytes):
+    results = {}
+    for bench in (benchParse, benchEnoughData, benchSerialize, benchMake):
+        results.update(bench(n))
+    results.update(benchDataReceived(megabytes))
+    return dict((name, {'cells_per_sec': rate, 'allocs_per_cell': allocs})
+                for name, (rate, allocs) in results.items())
+
+
+def compare(results, baseline, tolerance):
+    '''Print how *results* differ from *baseline*.
+
+    :returns: **list** names of benchmarks that regressed
+    '''
+    regressed = []
+    print('')
+    print('{:<36}{:>14}{:>10}'.format('benchmark', 'baseline', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name], results[name]
+        change = 100 * (new['cells_per_sec'] - old['cells_per_sec'])
+        change /= old['cells_per_sec']
+        flag = ''
+        if (change < -tolerance or
+                new['allocs_per_cell'] > old['allocs_per_cell'] + 0.5):
+            regressed.append(name)
+            flag = '  REGRESSED'
+        print('{:<36}{:>14.0f}{:>9.1f}%{}'.format(name, old['cells_per_sec'],
+                                                   change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cell parsing, '
+                                     'serialization and framing.')
+    parser.add_argument('-n', '--num-calls', type=int, default=20000,
+                        help='calls per micro-benchmark')
+    parser.add_argument('-m', '--megabytes', type=int, default=8,
+                        help='size of the stream given to dataReceived()')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help='allowed slowdown (percent) with --compare')
+    args = parser.parse_args()
+
+    results = run(args.num_calls, args.megabytes)
+
+    print('{:<36}{:>14}{:>14}'.format('benchmark', 'cells/sec',
+                                      'allocs/cell'))
+    for name in sorted(results):
+        r = results[name]
+        print('{:<36}{:>14.0f}{:>14.2f}'.format(name, r['cells_per_sec'],
+                                                r['allocs_per_cell']))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'num_calls': args.num_calls,
+                'megabytes': args.megabytes,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Measure how many bytes each queued cell costs.
+
+    Cells are built the way they usually sit in circuit and stream
+    queues during a bulk transfer (inbound EncryptedCells and outbound
+    RelayDataCells) and their full object graphs are sized. For
+    comparison, the same cells are also built from subclasses that don't
+    declare __slots__, which gives them back a per-instance __dict__ (the
+    way cells were represented before they were slotted).
+
+    Run from the top of the repository with::
+
+        python -m benchmarks.cell_memory
+
+'''
+import argparse
+import sys
+
+from oppy.cell.definitions import MAX_PAYLOAD_LEN, RELAY_CMD
+from oppy.cell.fixedlen import EncryptedCell, FixedLenCell
+from oppy.cell.relay import RelayCell, RelayDataCell
+
+
+def deepSizeOf(obj, seen=None):
+    '''Return the size in bytes of *obj* and everything it references
+    through its slots or __dict__.
+
+    :param obj: object to size
+    :param set seen: ids of objects that have already been counted
+    :returns: **int** total size of *obj*'s object graph
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(deepSizeOf(i, seen) for i in obj)
+    if hasattr(obj, '__dict__'):
+        size += deepSizeOf(obj.__dict__, seen)
+        size += sum(deepSizeOf(v, seen) for v in obj.__dict__.values())
+    for klass in type(obj).__mro__:
+        for name in klass.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                size += deepSizeOf(getattr(obj, name), seen)
+    return size
+
+
+def unslotted(cls):
+    '''Return a subclass of *cls* whose instances have a __dict__.'''
+    return type('Unslotted' + cls.__name__, (cls,), {})
+
+
+DictHeader = unslotted(FixedLenCell.Header)
+DictRelayHeader = unslotted(RelayCell.RelayHeader)
+DictEncryptedCell = unslotted(EncryptedCell)
+DictRelayDataCell = unslotted(RelayDataCell)
+
+
+def makeEncryptedCell(i, header_type, cell_type):
+    payload = chr(i % 256) * MAX_PAYLOAD_LEN
+    return cell_type(header_type(i, RELAY_CMD, 3), payload)
+
+
+def makeRelayDataCell(i, header_type, rheader_type, cell_type):
+    rpayload = chr(i % 256) * 100
+    rheader = rheader_type(2, '\x00\x00', 1, '\x00' * 4, len(rpayload))
+    return cell_type(header_type(i, RELAY_CMD, 3), rheader, rpayload)
+
+
+def bytesPerCell(cells):
+    return float(deepSizeOf(cells) - sys.getsizeof(cells)) / len(cells)
+
+
+def run(n):
+    results = []
+
+    slotted = [makeEncryptedCell(i, FixedLenCell.Header, EncryptedCell)
+               for i in xrange(n)]
+    unslotted_ = [makeEncryptedCell(i, DictHeader, DictEncryptedCell)
+                  for i in xrange(n)]
+    results.append(('EncryptedCell', bytesPerCell(unslotted_),
+                    bytesPerCell(slotted)))
+
+    slotted = [makeRelayDataCell(i, FixedLenCell.Header,
+                                 RelayCell.RelayHeader, RelayDataCell)
+               for i in xrange(n)]
+    unslotted_ = [makeRelayDataCell(i, DictHeader, DictRelayHeader,
+                                    DictRelayDataCell)
+                  for i in xrange(n)]
+    results.append(('RelayDataCell', bytesPerCell(unslotted_),
+                    bytesPerCell(slotted)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure bytes per '
+                                     'queued cell with and without slots.')
+    parser.add_argument('-n', '--num-cells', type=int, default=10000,
+                        help='number of cells to queue per cell type')
+    args = parser.parse_args()
+
+    print('{:<16}{:>12}{:>12}{:>10}'.format('cell', '__dict__', '__slots__',
+                                             'saved'))
+    for name, before, after in run(args.num_cells):
+        saved = 100 * (before - after) / before
+        print('{:<16}{:>12.1f}{:>12.1f}{:>9.1f}%'.format(name, before, after,
+                                                          saved))
+
+
+if __name__ == '__main__':
+    main()
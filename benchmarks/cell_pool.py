@@ -0,0 +1,186 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Measure what pooling data-plane cells saves during a bulk download.
+
+    The inbound side of a bulk download is replayed without the network
+    or any crypto: a batch of cells is framed as EncryptedCells, as
+    Connection.dataReceived() does for one read, then each is turned into
+    a RelayDataCell, delivered and released, and a circuit-level
+    RelaySendMeCell is built and released every 100 cells. The run is
+    repeated with and without pooling (see :mod:`oppy.cell.pool`).
+
+    Cells that are freed right after they're built never trigger a
+    collection on their own; pauses show up once a single read frames
+    more cells than the youngest generation's threshold allows for (700
+    by default). The default batch size (-b) is above that; smaller ones
+    show no collections at all.
+
+    Python 2 has no gc.callbacks, so automatic collection is turned off
+    while the workload runs and the benchmark starts each collection
+    itself, using the same thresholds CPython would, and times it. That
+    gives the number and total length of the GC pauses the workload
+    would have caused on the reactor thread.
+
+    Run from the top of the repository with::
+
+        python -m benchmarks.cell_pool
+
+'''
+import argparse
+import gc
+import struct
+import time
+
+import oppy.cell.pool as pool
+
+from oppy.cell.definitions import (
+    MAX_PAYLOAD_LEN,
+    MAX_RPAYLOAD_LEN,
+    RECOGNIZED,
+    RELAY_CMD,
+    RELAY_DATA_CMD,
+)
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.relay import RelayDataCell, RelaySendMeCell
+
+
+CIRC_ID = 1
+SENDME_EVERY = 100
+# cells framed per read, more than CPython's default gen-0 threshold
+DEFAULT_BATCH = 1000
+
+
+class GCPauses(object):
+    '''Runs the cyclic garbage collector by hand and times it.'''
+
+    def __init__(self):
+        self.collections = [0, 0, 0]
+        self.total = 0.0
+        self.longest = 0.0
+        self._thresholds = gc.get_threshold()
+
+    def maybeCollect(self):
+        '''Collect the oldest generation that's over its threshold, if
+        any, the way CPython's allocator would.'''
+        counts = gc.get_count()
+        for gen in (2, 1, 0):
+            if counts[gen] > self._thresholds[gen]:
+                start = time.time()
+                gc.collect(gen)
+                pause = time.time() - start
+                self.collections[gen] += 1
+                self.total += pause
+                self.longest = max(self.longest, pause)
+                return
+
+
+def makePayload(i):
+    data = chr(i % 256) * MAX_RPAYLOAD_LEN
+    payload = struct.pack('!B2sH4sH', RELAY_DATA_CMD, RECOGNIZED, 1,
+                          '\x00' * 4, len(data)) + data
+    return payload + '\x00' * (MAX_PAYLOAD_LEN - len(payload))
+
+
+def replay(n, batch, payloads):
+    '''Replay *n* inbound data cells, framing *batch* of them at a time
+    the way Connection.dataReceived() does for one large read.
+
+    :returns: :class:`GCPauses`, elapsed seconds, bytes delivered
+    '''
+    pauses = GCPauses()
+    delivered = 0
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        for first in xrange(0, n, batch):
+            cells = []
+            for i in xrange(first, min(first + batch, n)):
+                cells.append(EncryptedCell.fromPayload(
+                    CIRC_ID, RELAY_CMD, payloads[i % len(payloads)]))
+                pauses.maybeCollect()
+            for i, enc in enumerate(cells, first):
+                dec = RelayDataCell.fromPayload(CIRC_ID, RELAY_CMD,
+                                                enc.enc_payload)
+                pool.release(enc)
+                delivered += len(dec.rpayload)
+                pool.release(dec)
+                if i % SENDME_EVERY == 0:
+                    sendme = RelaySendMeCell.make(CIRC_ID)
+                    sendme.getPayload()
+                    pool.release(sendme)
+                pauses.maybeCollect()
+            del cells
+        elapsed = time.time() - start
+    finally:
+        gc.enable()
+    return pauses, elapsed, delivered
+
+
+def run(n, batch, live_objects):
+    # long-lived objects make full collections as expensive as they are in
+    # a running oppy, where consensus and descriptor data stay in memory
+    heap = [(i, str(i)) for i in xrange(live_objects)]
+    payloads = [makePayload(i) for i in xrange(256)]
+
+    pool.disablePooling()
+    unpooled = replay(n, batch, payloads)
+    pool.enablePooling()
+    pooled = replay(n, batch, payloads)
+    stats = pool.poolStats()
+    pool.disablePooling()
+
+    del heap
+    return unpooled, pooled, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure GC pauses with '
+                                     'and without pooled data-plane cells.')
+    parser.add_argument('-n', '--num-cells', type=int, default=200000,
+                        help='number of inbound data cells to replay')
+    parser.add_argument('-b', '--batch', type=int, default=DEFAULT_BATCH,
+                        help='number of cells framed per read')
+    parser.add_argument('-l', '--live-objects', type=int, default=200000,
+                        help='number of long-lived objects on the heap')
+    args = parser.parse_args()
+
+    unpooled, pooled, stats = run(args.num_cells, args.batch,
+                                   args.live_objects)
+
+    print('{:<10}{:>12}{:>14}{:>14}{:>14}'.format(
+        'mode', 'cells/sec', 'collections', 'gc total ms', 'gc max ms'))
+    for name, (pauses, elapsed, _) in (('unpooled', unpooled),
+                                       ('pooled', pooled)):
+        print('{:<10}{:>12.0f}{:>14}{:>14.2f}{:>14.2f}'.format(
+            name, args.num_cells / elapsed,
+            '/'.join(str(c) for c in pauses.collections),
+            pauses.total * 1000, pauses.longest * 1000))
+
+    before, after = unpooled[0].total, pooled[0].total
+    if before > 0:
+        print('GC pause time reduced by {:.1f}%'.format(
+            100 * (before - after) / before))
+    else:
+        print('No collections at this batch size; try a larger -b.')
+    # pooling trades GC pauses for bookkeeping on every cell, so show what
+    # it costs in throughput too
+    print('Throughput changed by {:+.1f}%'.format(
+        100 * (unpooled[1] / pooled[1] - 1)))
+
+    print('')
+    print('{:<18}{:>10}{:>10}{:>10}'.format('pool', 'hits', 'misses',
+                                            'hit rate'))
+    for name in sorted(stats):
+        s = stats[name]
+        print('{:<18}{:>10}{:>10}{:>9.1f}%'.format(name, s['hits'],
+                                                    s['misses'],
+                                                    100 * s['hit_rate']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Simulate one connection shared by a bulk circuit and an interactive
+    circuit, and measure how long the interactive circuit's cells take to
+    get onto the wire.
+
+    The connection's transport drains at a fixed link rate and, like
+    Twisted's, pauses its registered producer once more than
+    *bufferSize* bytes are waiting and resumes it once they've all been
+    sent. The bulk circuit always keeps a window's worth of cells waiting
+    to be sent; the interactive circuit sends one cell every 100ms.
+
+    Two ways of writing the cells are compared:
+
+        - **fifo**: every cell goes straight to the transport, in the order
+          the circuits wrote them (the default)
+        - **ewma**: cells go through an
+          :class:`~oppy.connection.circuitmux.EWMACircuitMux`
+        - **kist**: cells go through an EWMACircuitMux that only writes as
+          much as the link sends in two KIST run intervals, less what's
+          already waiting in the transport (standing in for
+          :class:`~oppy.connection.kist.SocketLimit`, whose congestion
+          window here would be one run interval's worth of data)
+
+    Time is simulated with a twisted.internet.task.Clock, so the results
+    don't depend on the speed of this host.
+
+    Run from the top of the repository with::
+
+        python -m benchmarks.circuit_scheduler
+
+'''
+import argparse
+
+from twisted.internet import task
+
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.connection.circuitmux import DEFAULT_HALFLIFE, EWMACircuitMux
+from oppy.connection.kist import DEFAULT_RUN_INTERVAL
+
+
+BULK_CIRC_ID = 1
+INTERACTIVE_CIRC_ID = 2
+# cells the bulk circuit keeps waiting, roughly one circuit window
+BULK_BACKLOG = 500
+INTERACTIVE_INTERVAL = 0.1
+TICK = 0.001
+# Twisted's FileDescriptor.bufferSize
+BUFFER_SIZE = 2 ** 16
+
+
+class FakeTransport(object):
+    '''A transport that sends *rate* bytes per second.'''
+
+    def __init__(self, clock, rate):
+        self.clock = clock
+        self.rate = rate
+        self.producer = None
+        self.paused = False
+        # (bytes left, circuit ID, time the cell was written)
+        self.queue = []
+        self.head = 0
+        self.buffered = 0
+        self.sent = {BULK_CIRC_ID: [], INTERACTIVE_CIRC_ID: []}
+        # cells written by each circuit that haven't been sent yet
+        self.outstanding = {BULK_CIRC_ID: 0, INTERACTIVE_CIRC_ID: 0}
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def writeCell(self, cell, written_at):
+        n = len(cell)
+        self.queue.append([n, cell.header.circ_id, written_at])
+        self.buffered += n
+        if self.producer is not None and self.paused is False and \
+                self.buffered > BUFFER_SIZE:
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def drain(self):
+        budget = self.rate * TICK
+        while budget > 0 and self.head < len(self.queue):
+            entry = self.queue[self.head]
+            n = min(entry[0], budget)
+            entry[0] -= n
+            budget -= n
+            self.buffered -= n
+            if entry[0] == 0:
+                latency = self.clock.seconds() - entry[2]
+                self.sent[entry[1]].append(latency)
+                self.outstanding[entry[1]] -= 1
+                self.head += 1
+        if self.head > 4096:
+            del self.queue[:self.head]
+            self.head = 0
+        if self.paused is True and self.buffered == 0:
+            self.paused = False
+            self.producer.resumeProducing()
+
+
+class FakeSocketLimit(object):
+    '''KIST's limit for a transport with a fixed congestion window.'''
+
+    run_interval = DEFAULT_RUN_INTERVAL
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.cwnd_bytes = int(transport.rate * self.run_interval)
+
+    def writableBytes(self):
+        return max(0, 2 * self.cwnd_bytes - self.transport.buffered)
+
+
+def simulate(scheduler, rate, duration):
+    '''Run the simulation for *duration* seconds.
+
+    :returns: **FakeTransport** with the latency of every sent cell
+    '''
+    clock = task.Clock()
+    transport = FakeTransport(clock, rate)
+    written = {}
+
+    def send(cell):
+        transport.writeCell(cell, written.pop(id(cell)))
+
+    if scheduler in ('ewma', 'kist'):
+        if scheduler == 'kist':
+            limit = FakeSocketLimit(transport)
+        else:
+            limit = None
+        mux = EWMACircuitMux(send, DEFAULT_HALFLIFE, limit,
+                             callLater=clock.callLater,
+                             seconds=clock.seconds)
+        transport.registerProducer(mux, True)
+        write = mux.writeCell
+    else:
+        write = send
+
+    def writeCell(circ_id):
+        cell = EncryptedCell.make(circ_id, '\x00' * MAX_PAYLOAD_LEN)
+        written[id(cell)] = clock.seconds()
+        transport.outstanding[circ_id] += 1
+        write(cell)
+
+    next_interactive = 0.0
+    while clock.seconds() < duration:
+        # top the bulk circuit back up to its backlog
+        for _ in xrange(BULK_BACKLOG - transport.outstanding[BULK_CIRC_ID]):
+            writeCell(BULK_CIRC_ID)
+        if clock.seconds() >= next_interactive:
+            writeCell(INTERACTIVE_CIRC_ID)
+            next_interactive += INTERACTIVE_INTERVAL
+        # let the mux send, then put the link to work
+        clock.advance(0)
+        transport.drain()
+        clock.advance(TICK)
+    return transport
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate interactive-circuit latency under bulk load.')
+    parser.add_argument('-r', '--rate', type=int, default=1024 * 1024,
+                        help='link rate in bytes per second')
+    parser.add_argument('-d', '--duration', type=float, default=30.0,
+                        help='simulated seconds')
+    args = parser.parse_args()
+
+    print('{:<8}{:>14}{:>14}{:>14}{:>14}'.format(
+        'sched', 'median ms', 'p95 ms', 'max ms', 'bulk cells/s'))
+    for scheduler in ('fifo', 'ewma', 'kist'):
+        transport = simulate(scheduler, args.rate, args.duration)
+        latencies = transport.sent[INTERACTIVE_CIRC_ID]
+        print('{:<8}{:>14.1f}{:>14.1f}{:>14.1f}{:>14.0f}'.format(
+            scheduler,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            max(latencies) * 1000,
+            len(transport.sent[BULK_CIRC_ID]) / args.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Benchmark the inbound decryption path of a 3-hop circuit: peeling
+    each hop's layer off a RELAY cell and checking whether that hop
+    recognizes it.
+
+    Two traffic mixes are timed:
+
+        - **exit**: every cell comes from the exit, so each cell is
+          decrypted by all three hops and fails the recognized check
+          at the first two
+        - **mixed**: cells come from every hop in turn
+
+    and three ways of decrypting them:
+
+        - **copy**: the old recognition check, which builds a zero-digest
+          copy of the payload, hashes it with a copy of the hop's digest
+          and then hashes it again into the real digest on a match
+        - **single**: decryptCellUntilRecognized(), one cell at a time
+        - **batched**: decryptCellsUntilRecognized() over bursts of cells
+
+    Run from the top of the repository with::
+
+        python -m benchmarks.relay_decrypt
+
+'''
+import argparse
+
+from oppy.cell.definitions import MAX_RPAYLOAD_LEN, RECOGNIZED
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.relay import RelayDataCell
+from oppy.crypto import util
+from oppy.crypto.exceptions import UnrecognizedCell
+
+from benchmarks.crypto_backends import (
+    CIRC_ID,
+    HOPS,
+    TIMING_RUNS,
+    makeCryptPath,
+    measure,
+)
+
+
+BATCH = 32
+
+MIXES = [
+    ('exit', lambda i: HOPS - 1),
+    ('mixed', lambda i: i % HOPS),
+]
+
+
+def makeInbound(n, relay_path, origin):
+    '''Build *n* RELAY_DATA cells, cell *i* sent by hop *origin(i)*.'''
+    cells = []
+    for i in xrange(n):
+        node = origin(i)
+        cell = RelayDataCell.make(CIRC_ID, 1, chr(i % 256) * MAX_RPAYLOAD_LEN)
+        payload = cell.getPayload()
+        relay_path[node].backward_digest.update(payload)
+        payload = util.makePayloadWithDigest(
+            payload, relay_path[node].backward_digest.digest()[:4])
+        for hop in xrange(node, -1, -1):
+            payload = relay_path[hop].backward_cipher.encrypt(payload)
+        cells.append(EncryptedCell.make(CIRC_ID, payload))
+    return cells
+
+
+def decryptWithCopies(cell, crypt_path):
+    '''The recognition check as it used to be done, for comparison.'''
+    payload = cell.getPayload()
+    for node in xrange(len(crypt_path)):
+        relay_crypto = crypt_path[node]
+        payload = relay_crypto.backward_cipher.decrypt(payload)
+        test_payload = util.makePayloadWithDigest(payload)
+        if payload[2:4] != RECOGNIZED:
+            continue
+        test_digest = relay_crypto.backward_digest.copy()
+        test_digest.update(test_payload)
+        if test_digest.digest()[:4] == payload[5:9]:
+            relay_crypto.backward_digest.update(test_payload)
+            return RelayDataCell.parse(cell.header.getBytes() + payload), node
+    raise UnrecognizedCell()
+
+
+def benchCopy(n, origin):
+    path, relay_path = makeCryptPath('copy')
+    cells = [makeInbound(n, relay_path, origin) for _ in xrange(TIMING_RUNS)]
+
+    def run(i):
+        for cell in cells[i]:
+            decryptWithCopies(cell, path)
+    return measure(run, n)
+
+
+def benchSingle(n, origin):
+    path, relay_path = makeCryptPath('single')
+    cells = [makeInbound(n, relay_path, origin) for _ in xrange(TIMING_RUNS)]
+
+    def run(i):
+        for cell in cells[i]:
+            util.decryptCellUntilRecognized(cell, path)
+    return measure(run, n)
+
+
+def benchBatched(n, origin):
+    path, relay_path = makeCryptPath('batched')
+    cells = [makeInbound(n, relay_path, origin) for _ in xrange(TIMING_RUNS)]
+
+    def run(i):
+        for start in xrange(0, n, BATCH):
+            util.decryptCellsUntilRecognized(cells[i][start:start + BATCH],
+                                             path)
+    return measure(run, n)
+
+
+BENCHMARKS = [
+    ('copy', benchCopy),
+    ('single', benchSingle),
+    ('batched x{}'.format(BATCH), benchBatched),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark 3-hop inbound cell decryption.')
+    parser.add_argument('-n', '--num-cells', type=int, default=20000,
+                        help='number of cells per benchmark')
+    args = parser.parse_args()
+
+    print('{:<14}'.format('cells/sec') +
+          ''.join('{:>14}'.format(mix) for mix, _ in MIXES))
+    for bench, func in BENCHMARKS:
+        print('{:<14}'.format(bench) +
+              ''.join('{:>14.0f}'.format(func(args.num_cells, origin))
+                      for _, origin in MIXES))
+
+
+if __name__ == '__main__':
+    main()
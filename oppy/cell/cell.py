@@ -9,10 +9,45 @@ import oppy.cell.definitions as DEF
 from oppy.cell.exceptions import NotEnoughBytes, UnknownCellCommand
 
 
+# precompiled header formats used when framing or serializing cells
+V3_HEADER = struct.Struct("!HB")
+V4_HEADER = struct.Struct("!IB")
+PAYLOAD_LEN_FIELD = struct.Struct("!H")
+
+# memoized results of slotNames()
+_slot_names = {}
+
+
+def slotNames(cls):
+    '''Return the names of every slot defined by *cls* and its bases.
+
+    :param type cls: class to inspect
+    :returns: **tuple, str** slot names, most-derived class last
+    '''
+    try:
+        return _slot_names[cls]
+    except KeyError:
+        names = []
+        for klass in reversed(cls.__mro__):
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            names.extend(n for n in slots if n not in names)
+        _slot_names[cls] = tuple(names)
+        return _slot_names[cls]
+
+
 class Cell(object):
-    '''An abstract base class for other kinds of cells.'''
+    '''An abstract base class for other kinds of cells.
+
+    Cells (and their headers) use __slots__ instead of a per-instance
+    __dict__, since thousands of them may be queued on circuits and streams
+    at once. Every concrete cell type must define __slots__ (even if it's
+    empty) listing any attributes it adds.
+    '''
 
     __metaclass__ = abc.ABCMeta
+    __slots__ = ()
     _subclass_map = None
 
     def getPayload(self):
@@ -27,6 +62,26 @@ class Cell(object):
         start, _ = self.payloadRange()
         return self.getBytes()[start:]
 
+    def writeInto(self, buf, offset=0):
+        '''Serialize this cell into the bytearray *buf*, starting at
+        *offset*, and return the number of bytes written.
+
+        This generic version just copies the output of getBytes() into
+        *buf*. Cell types on the bulk data path override it to pack their
+        fields directly into *buf* without building intermediate strings.
+
+        .. note:: *buf* must have room for len(self) bytes starting at
+            *offset*.
+
+        :param bytearray buf: buffer to write this cell into
+        :param int offset: position in *buf* to start writing at
+        :returns: **int** number of bytes written
+        '''
+        data = self.getBytes()
+        end = offset + len(data)
+        buf[offset:end] = data
+        return end - offset
+
     @abc.abstractmethod
     def payloadRange(self):
         '''Return the (start, end) indices of this cell's payload as a
@@ -43,7 +98,8 @@ class Cell(object):
         The command byte is checked to determine the general type of
         cell to look for. For fixed-length cells, this is enough to know
         how much data is required. For variable-length cells, additionally
-        check the length bytes.
+        check the length bytes (the header and length field count towards
+        the required length, too).
 
         :param str data: The raw string to check.
         :param int link_version: Link Protocol version in use. In version
@@ -67,8 +123,9 @@ class Cell(object):
         if cmd in DEF.FIXED_LEN_CMD_IDS:
             return len(data) >= required_length
         elif cmd in DEF.VAR_LEN_CMD_IDS:
-            required_len = struct.unpack('!H',
-                                         data[header_len:header_len + 2])[0]
+            payload_len = struct.unpack('!H',
+                                        data[header_len:header_len + 2])[0]
+            required_len = header_len + DEF.PAYLOAD_FIELD_LEN + payload_len
             return len(data) >= required_len
         else:
             msg = "Unknown cell cmd: {}.".format(cmd)
@@ -80,7 +137,8 @@ class Cell(object):
 
         If encrypted is True and the type if cell is RELAY or RELAY_EARLY,
         don't try to parse the payload and just return a
-        :class:`~oppy.cell.fixedlen.EncryptedCell`.
+        :class:`~oppy.cell.fixedlen.EncryptedCell` (built without going
+        through the generic parsing machinery).
         Otherwise, instantiate and return the appropriate cell type.
 
         .. note:: *data* str is not modified.
@@ -113,6 +171,114 @@ class Cell(object):
             msg = "When parsing cell data, found an unknown cmd: {}."
             raise UnknownCellCommand(msg.format(cmd))
 
+        # fast path for the common case of an inbound encrypted relay cell
+        if encrypted is True and cmd in DEF.RELAY_CELL_CMD_IDS:
+            from oppy.cell.fixedlen import EncryptedCell
+            if link_version <= 3:
+                cell_len = DEF.FIXED_LEN_V3_LEN
+            else:
+                cell_len = DEF.FIXED_LEN_V4_LEN
+            if len(data) < cell_len:
+                fmt = "Needed {} bytes to finish parsing data; only found {}."
+                raise NotEnoughBytes(fmt.format(cell_len, len(data)))
+            return EncryptedCell.fromPayload(circ_id, cmd,
+                                             data[header_len:cell_len],
+                                             link_version)
+
+        return Cell._parseFromHeader(data, circ_id, cmd, link_version,
+                                     encrypted)
+
+    @staticmethod
+    def parseMany(data, link_version=3, encrypted=False, max_cells=None):
+        '''Walk *data* once and extract every complete cell in it.
+
+        Each cell header is decoded exactly once. Encrypted RELAY and
+        RELAY_EARLY cells are built through the
+        :meth:`~oppy.cell.fixedlen.EncryptedCell.fromPayload` fast path
+        straight from the buffer. PADDING and VPADDING cells are skipped
+        without being instantiated, but their bytes are
+        still counted as consumed. Parsing stops at the first incomplete
+        cell (or after *max_cells* cells have been extracted), so the
+        caller should keep any unconsumed bytes around until more data
+        arrives.
+
+        .. note:: *data* is not modified. *data* may be a **str** or a
+            **buffer** over some larger byte array.
+
+        :param str data: raw bytes to extract cells from
+        :param int link_version: Link Protocol version in use
+        :param bool encrypted: whether or not we think RELAY and
+            RELAY_EARLY cells in *data* are encrypted (see
+            :meth:`~oppy.cell.cell.Cell.parse`)
+        :param int max_cells: if not **None**, stop after this many
+            (non-padding) cells have been extracted
+        :returns: **tuple** (cells, consumed) where *cells* is a list of
+            parsed cells and *consumed* is the number of bytes of *data*
+            those cells (and any skipped padding cells) took up.
+        '''
+        if not 1 <= link_version <= 4:
+            msg = "link_version must be leq 4, but found {} instead"
+            raise ValueError(msg.format(link_version))
+
+        if link_version <= 3:
+            header = V3_HEADER
+            fixed_len = DEF.FIXED_LEN_V3_LEN
+        else:
+            header = V4_HEADER
+            fixed_len = DEF.FIXED_LEN_V4_LEN
+        header_len = header.size
+        varlen_header_len = header_len + DEF.PAYLOAD_FIELD_LEN
+
+        from oppy.cell.fixedlen import EncryptedCell
+
+        cells = []
+        offset = 0
+        data_len = len(data)
+        while data_len - offset >= header_len:
+            if max_cells is not None and len(cells) >= max_cells:
+                break
+
+            circ_id, cmd = header.unpack_from(data, offset)
+            if cmd in DEF.FIXED_LEN_CMD_IDS:
+                cell_len = fixed_len
+            elif cmd in DEF.VAR_LEN_CMD_IDS:
+                if data_len - offset < varlen_header_len:
+                    break
+                (payload_len,) = PAYLOAD_LEN_FIELD.unpack_from(
+                    data, offset + header_len)
+                cell_len = varlen_header_len + payload_len
+            else:
+                msg = "When parsing cell data, found an unknown cmd: {}."
+                raise UnknownCellCommand(msg.format(cmd))
+
+            end = offset + cell_len
+            if end > data_len:
+                break
+
+            if encrypted is True and cmd in DEF.RELAY_CELL_CMD_IDS:
+                cells.append(EncryptedCell.fromPayload(
+                    circ_id, cmd, data[offset + header_len:end],
+                    link_version))
+            elif cmd not in DEF.PADDING_CMD_IDS:
+                cells.append(Cell._parseFromHeader(data[offset:end], circ_id,
+                                                   cmd, link_version,
+                                                   encrypted))
+            offset = end
+
+        return cells, offset
+
+    @staticmethod
+    def _parseFromHeader(data, circ_id, cmd, link_version, encrypted):
+        '''Choose the right abstract cell type for *cmd* and use it to
+        parse the rest of *data*.
+
+        :param str data: raw bytes of exactly one cell
+        :param int circ_id: already decoded circuit ID
+        :param int cmd: already decoded (and known) cell command
+        :param int link_version: Link Protocol version in use
+        :param bool encrypted: see :meth:`~oppy.cell.cell.Cell.parse`
+        :returns: instantiated cell type as dictated by *cmd*
+        '''
         if cmd in DEF.VAR_LEN_CMD_IDS:
             from oppy.cell.varlen import VarLenCell
             cls = VarLenCell
@@ -211,12 +377,22 @@ class Cell(object):
         return end
 
     def __eq__(self, other):
-        if type(self) is type(other):
-            return self.__dict__ == other.__dict__
-        return False
+        if type(self) is not type(other):
+            return False
+        # unset slots compare equal to each other (and to None)
+        for name in slotNames(type(self)):
+            if getattr(self, name, None) != getattr(other, name, None):
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
 
     class Header(object):
         '''A dummy header type that exists only to be overridden by classes
         that inherit from :class:`~oppy.cell.cell.Cell`.'''
+
+        __slots__ = ()
+
         def __init__(self):
             raise NotImplementedError("This is an abstract class.")
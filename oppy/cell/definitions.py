@@ -46,6 +46,12 @@ PADDING_CMD_IDS = (
     VPADDING_CMD,
 )
 
+# Commands of cells that carry (possibly encrypted) relay payloads
+RELAY_CELL_CMD_IDS = (
+    RELAY_CMD,
+    RELAY_EARLY_CMD,
+)
+
 # Commands used in fixed-length cells
 FIXED_LEN_CMD_IDS = (
     PADDING_CMD,
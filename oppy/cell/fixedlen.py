@@ -4,16 +4,20 @@
 import struct
 import time
 
-from oppy.cell.cell import Cell
+from oppy.cell.cell import Cell, V3_HEADER, V4_HEADER
 import oppy.cell.definitions as DEF
+import oppy.cell.pool as pool
 
 from oppy.cell.exceptions import BadCellHeader, BadPayloadData
+from oppy.cell.schema import CellSchema, Field, equals, oneOf
 from oppy.cell.util import TLVTriple
 
 
 class FixedLenCell(Cell):
     '''A container class for representing fixed-length cells.'''
 
+    __slots__ = ('header', 'payload')
+
     _subclass_map = None
 
     def __init__(self, header, payload=None):
@@ -109,6 +113,8 @@ class FixedLenCell(Cell):
         '''A simple container class for representing the header information of
         a fixed-length cell.'''
 
+        __slots__ = ('circ_id', 'cmd', 'link_version')
+
         def __init__(self, circ_id=None, cmd=None, link_version=3):
             self.circ_id = circ_id
             self.cmd = cmd
@@ -119,26 +125,113 @@ class FixedLenCell(Cell):
 
             :returns: **str** byte representation of this header
             '''
-            fmt = "!HB" if self.link_version <= 3 else "!IB"
-            return struct.pack(fmt, self.circ_id, self.cmd)
+            fmt = V3_HEADER if self.link_version <= 3 else V4_HEADER
+            return fmt.pack(self.circ_id, self.cmd)
+
+        def writeInto(self, buf, offset=0):
+            '''Pack this header into the bytearray *buf* at *offset*.
+
+            :param bytearray buf: buffer to write this header into
+            :param int offset: position in *buf* to start writing at
+            :returns: **int** number of bytes written
+            '''
+            fmt = V3_HEADER if self.link_version <= 3 else V4_HEADER
+            fmt.pack_into(buf, offset, self.circ_id, self.cmd)
+            return fmt.size
 
         def __repr__(self):
             fmt = "FixedLenCell.Header(circ_id={}, cmd={}, link_version={})"
             return fmt.format(self.circ_id, self.cmd, self.link_version)
 
         def __eq__(self, other):
-            if type(other) is type(self):
-                return self.__dict__ == other.__dict__
+            if isinstance(other, FixedLenCell.Header):
+                return (self.circ_id == other.circ_id and
+                        self.cmd == other.cmd and
+                        self.link_version == other.link_version)
             return False
 
+        def __ne__(self, other):
+            return not self == other
+
+
+class PackedHeader(FixedLenCell.Header):
+    '''A FixedLenCell.Header that packs itself once, on creation.
+
+    PackedHeaders are meant to be shared between every cell a circuit
+    sends with the same (circ_id, cmd, link_version), so they must not
+    be modified after they're created.
+    '''
+
+    __slots__ = ('packed',)
+
+    def __init__(self, circ_id, cmd, link_version=3):
+        super(PackedHeader, self).__init__(circ_id, cmd, link_version)
+        self.packed = super(PackedHeader, self).getBytes()
+
+    def getBytes(self):
+        '''Return the raw bytes of this header.
+
+        :returns: **str** byte representation of this header
+        '''
+        return self.packed
+
+    def writeInto(self, buf, offset=0):
+        '''Copy this header into the bytearray *buf* at *offset*.
+
+        :param bytearray buf: buffer to write this header into
+        :param int offset: position in *buf* to start writing at
+        :returns: **int** number of bytes written
+        '''
+        end = offset + len(self.packed)
+        buf[offset:end] = self.packed
+        return end - offset
+
+
+class RelayHeaderCache(object):
+    '''The RELAY and RELAY_EARLY headers used by a single circuit, packed
+    once for the lifetime of the circuit.'''
+
+    __slots__ = ('relay', 'relay_early')
+
+    def __init__(self, circ_id, link_version=3):
+        '''
+        :param int circ_id: Circuit ID of the circuit using these headers
+        :param int link_version: Link Protocol version in use
+        '''
+        self.relay = PackedHeader(circ_id, DEF.RELAY_CMD, link_version)
+        self.relay_early = PackedHeader(circ_id, DEF.RELAY_EARLY_CMD,
+                                        link_version)
+
+    def getHeader(self, early=False):
+        '''Return the shared header to use for an outgoing cell.
+
+        :param bool early: if **True**, return the RELAY_EARLY header
+            instead of the RELAY header
+        :returns: :class:`~oppy.cell.fixedlen.PackedHeader`
+        '''
+        return self.relay_early if early is True else self.relay
+
 
 HTYPE_LEN = 2
 HLEN_LEN  = 2
 
+CREATE2_SCHEMA = CellSchema([
+    Field('htype', 'H', equals(DEF.NTOR_HTYPE, "Create2 got htype: {}, but "
+                               "oppy only supports ntor: {}.")),
+    Field('hlen', 'H', equals(DEF.NTOR_HLEN, "Create2 got hlen: {}, but "
+                              "oppy only supports ntor hlen: {}.")),
+], tail='hdata', tail_len='hlen')
+
+CREATED2_SCHEMA = CellSchema([
+    Field('hlen', 'H'),
+], tail='hdata', tail_len='hlen')
+
 
 class Create2Cell(FixedLenCell):
     '''.. note:: tor-spec, Section 5.1'''
 
+    __slots__ = ('htype', 'hlen', 'hdata')
+
     def __init__(self, header, htype=None, hlen=None, hdata=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -197,9 +290,7 @@ class Create2Cell(FixedLenCell):
             according to Link Protocol version in use.
         :returns: **str** formatted byte string represented by this cell
         '''
-        ret = self.header.getBytes()
-        ret += struct.pack('!H', self.htype) + struct.pack('!H', self.hlen)
-        ret += self.hdata
+        ret = self.header.getBytes() + CREATE2_SCHEMA.getBytes(self)
         if trimmed is True:
             return ret
         else:
@@ -213,35 +304,7 @@ class Create2Cell(FixedLenCell):
         :param str data: string to parse
         '''
         start, end = self.payloadRange()
-        offset = start
-
-        if end - start < HTYPE_LEN + HLEN_LEN:
-            msg = "Create2Cell payload was not enough bytes to construct "
-            msg += "a valid Create2Cell."
-            raise BadPayloadData(msg)
-
-        self.htype = struct.unpack('!H', data[offset:offset + HTYPE_LEN])[0]
-
-        if self.htype != DEF.NTOR_HTYPE:
-            msg = "Create2 got htype: {}, but oppy only supports ntor: {}."
-            raise BadPayloadData(msg.format(self.htype, DEF.NTOR_HTYPE))
-
-        offset += HTYPE_LEN
-
-        self.hlen = struct.unpack('!H', data[offset:offset + HLEN_LEN])[0]
-
-        if self.hlen != DEF.NTOR_HLEN:
-            msg = "Create2 got hlen: {}, but oppy only supports ntor hlen: {}."
-            raise BadPayloadData(msg.format(self.hlen, DEF.NTOR_HLEN))
-
-        offset += HLEN_LEN
-
-        try:
-            self.hdata = data[offset:offset + self.hlen]
-        except IndexError:
-            msg = "Create2 hlen was specified to be {} bytes, but actual "
-            msg += "hdata was {} bytes."
-            raise BadPayloadData(msg.format(self.hlen, len(data) - offset))
+        CREATE2_SCHEMA.parseInto(self, data, start, end)
 
     def __repr__(self):
         fmt = '{}, htype={}, hlen={}, hdata={}'
@@ -253,6 +316,8 @@ class Create2Cell(FixedLenCell):
 class Created2Cell(FixedLenCell):
     '''.. note:: tor-spec, Section 5.1'''
 
+    __slots__ = ('hlen', 'hdata')
+
     def __init__(self, header, hlen=None, hdata=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -272,9 +337,7 @@ class Created2Cell(FixedLenCell):
             according to Link Protocol version in use.
         :returns: **str** raw byte string this cell represents.
         '''
-        ret = self.header.getBytes()
-        ret += struct.pack('!H', self.hlen)
-        ret += self.hdata
+        ret = self.header.getBytes() + CREATED2_SCHEMA.getBytes(self)
         if trimmed is True:
             return ret
         else:
@@ -318,13 +381,8 @@ class Created2Cell(FixedLenCell):
 
         :param str data: string to parse
         '''
-        start, _ = self.payloadRange()
-        offset = start
-
-        self.hlen = struct.unpack('!H', data[offset:offset + HLEN_LEN])[0]
-        offset += HLEN_LEN
-
-        self.hdata = data[offset:offset + self.hlen]
+        start, end = self.payloadRange()
+        CREATED2_SCHEMA.parseInto(self, data, start, end)
 
     def __repr__(self):
         fmt = '{}, hlen={}, hdata={}'
@@ -335,34 +393,53 @@ class Created2Cell(FixedLenCell):
 
 class CreatedFastCell(FixedLenCell):
     '''.. note:: Not Implemented.'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make CreatedFastCell yet.")
 
 
 class CreatedCell(FixedLenCell):
     '''.. note:: Not Implemented.'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make CreatedCell yet.")
 
 
 class CreateFastCell(FixedLenCell):
     '''.. note:: Not Implemented.'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make CreateFastCell yet.")
 
 
 class CreateCell(FixedLenCell):
     '''.. note:: Not Implemented.'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make CreateCell yet.")
 
 
 REASON_LEN = 1
 
+DESTROY_SCHEMA = CellSchema([
+    Field('reason', 'B', oneOf(DEF.DESTROY_TRUNCATE_REASONS,
+                               "Unrecognized DESTROY reason: {}")),
+])
+
 
 class DestroyCell(FixedLenCell):
     '''.. note:: tor-spec, Section 5.4'''
 
+    __slots__ = ('reason',)
+
     def __init__(self, header, reason=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -407,8 +484,7 @@ class DestroyCell(FixedLenCell):
             according to Link Protocol version in use.
         :returns: **str** raw byte string this cell represents
         '''
-        ret = self.header.getBytes()
-        ret += struct.pack('!B', self.reason)
+        ret = self.header.getBytes() + DESTROY_SCHEMA.getBytes(self)
         if trimmed is True:
             return ret
         else:
@@ -421,11 +497,8 @@ class DestroyCell(FixedLenCell):
 
         :param str data: string to parse
         '''
-        start, _ = self.payloadRange()
-        self.reason = struct.unpack('!B', data[start:start + REASON_LEN])[0]
-        if self.reason not in DEF.DESTROY_TRUNCATE_REASONS:
-            msg = 'Unrecognized DESTROY reason: {}'.format(self.reason)
-            raise BadPayloadData(msg)
+        start, end = self.payloadRange()
+        DESTROY_SCHEMA.parseInto(self, data, start, end)
 
     def __repr__(self):
         fmt = '{}, reason={}'
@@ -442,6 +515,8 @@ class EncryptedCell(FixedLenCell):
         received from the network and have not been decrypted yet.
     '''
 
+    __slots__ = ('enc_payload',)
+
     def __init__(self, header, enc_payload=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -491,6 +566,53 @@ class EncryptedCell(FixedLenCell):
 
         return EncryptedCell(h, enc_payload=payload)
 
+    @staticmethod
+    def fromPayload(circ_id, cmd, enc_payload, link_version=3):
+        '''Build an EncryptedCell for an inbound RELAY or RELAY_EARLY cell
+        straight from its already decoded header fields.
+
+        This is the fast path used by
+        :meth:`~oppy.cell.cell.Cell.parse` and
+        :meth:`~oppy.cell.cell.Cell.parseMany` for encrypted relay cells.
+        It skips subclass lookup and the generic header and payload
+        parsing steps, so the caller is responsible for passing a *cmd*
+        in RELAY_CELL_CMD_IDS and a complete *enc_payload*.
+
+        If EncryptedCells are being pooled (see :mod:`oppy.cell.pool`),
+        the cell is taken from the pool instead of being created.
+
+        :param int circ_id: Circuit ID of this cell
+        :param int cmd: RELAY_CMD or RELAY_EARLY_CMD
+        :param str enc_payload: the cell's full (encrypted) payload
+        :param int link_version: Link Protocol version in use
+        :returns: :class:`~oppy.cell.fixedlen.EncryptedCell`
+        '''
+        cell_pool = pool.getPool(EncryptedCell)
+        if cell_pool is None:
+            return EncryptedCell(
+                FixedLenCell.Header(circ_id, cmd, link_version), enc_payload)
+
+        cell = cell_pool.acquire()
+        h = cell.header
+        h.circ_id = circ_id
+        h.cmd = cmd
+        h.link_version = link_version
+        cell.enc_payload = enc_payload
+        return cell
+
+    @staticmethod
+    def fromCache(headers, payload, early=False):
+        '''Build an outbound EncryptedCell around one of a circuit's
+        cached headers instead of creating a new header.
+
+        :param :class:`~oppy.cell.fixedlen.RelayHeaderCache` headers:
+            header cache of the circuit sending this cell
+        :param str payload: fully padded, encrypted payload
+        :param bool early: Dictate whether or not to use a RELAY_EARLY cell
+        :returns: :class:`~oppy.cell.fixedlen.EncryptedCell`
+        '''
+        return EncryptedCell(headers.getHeader(early), payload)
+
     def getBytes(self, trimmed=False):
         '''Construct and return the byte string represented by this cell.
 
@@ -500,6 +622,25 @@ class EncryptedCell(FixedLenCell):
         '''
         return self.header.getBytes() + self.enc_payload
 
+    def getPayload(self):
+        '''Return this cell's (still encrypted) payload bytes.
+
+        :returns: **str** encrypted payload
+        '''
+        return self.enc_payload
+
+    def writeInto(self, buf, offset=0):
+        '''Pack this cell into the bytearray *buf* at *offset*.
+
+        :param bytearray buf: buffer to write this cell into
+        :param int offset: position in *buf* to start writing at
+        :returns: **int** number of bytes written
+        '''
+        start = offset + self.header.writeInto(buf, offset)
+        end = start + len(self.enc_payload)
+        buf[start:end] = self.enc_payload
+        return end - offset
+
     def _parsePayload(self, data):
         '''Parse the string *data* and extract cell fields.
 
@@ -527,6 +668,9 @@ MAX_THIS_OR_ADDRESSES = 5
 class NetInfoCell(FixedLenCell):
     '''.. note:: tor-spec.txt, Section 4.5'''
 
+    __slots__ = ('timestamp', 'other_or_address', 'num_addresses',
+                 'this_or_addresses')
+
     def __init__(self, header, timestamp=None, other_or_address=None,
                  num_addresses=None, this_or_addresses=None):
         '''
@@ -660,6 +804,9 @@ class PaddingCell(FixedLenCell):
         fields.
 
     '''
+
+    __slots__ = ()
+
     @staticmethod
     def make(circ_id, link_version=3):
         '''Build and return a Padding cell, using default values where
@@ -0,0 +1,190 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Optional free-lists for the cell types on the data plane.
+
+    A bulk transfer builds and throws away an inbound EncryptedCell, a
+    decrypted RelayDataCell (with its two headers) and, every so often,
+    an outbound RelaySendMeCell for every 498 bytes of data. When pooling
+    is turned on (see enablePooling()), those cells are taken from a
+    CellPool instead and handed back with release() once the circuit is
+    done with them, so their objects are reused rather than left for the
+    garbage collector.
+
+    Pooling is off by default. While it's off, getPool() returns **None**
+    for every cell type, release() does nothing and cells are built
+    exactly as before.
+
+    .. warning:: A cell must not be used after it has been released,
+        since the same object will be handed out again for another cell.
+
+'''
+DEFAULT_POOL_SIZE = 1024
+
+
+class CellPool(object):
+    '''A bounded free-list of recycled cells of a single type.'''
+
+    __slots__ = ('max_size', 'hits', 'misses', 'releases', 'discards',
+                 '_factory', '_reset', '_free')
+
+    def __init__(self, factory, reset=None, max_size=DEFAULT_POOL_SIZE):
+        '''
+        :param factory: callable returning a new, blank cell (including
+            its header objects). Called whenever the pool is empty.
+        :param reset: callable taking a released cell that drops any
+            references it holds to its old data, or **None**
+        :param int max_size: maximum number of free cells kept around
+        '''
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.releases = 0
+        self.discards = 0
+        self._factory = factory
+        self._reset = reset
+        self._free = []
+
+    def acquire(self):
+        '''Return a recycled cell if one is available, otherwise a new one.
+
+        The caller is responsible for filling in every field of the
+        returned cell and its headers.
+
+        :returns: a blank or recycled cell
+        '''
+        if self._free:
+            self.hits += 1
+            return self._free.pop()
+        self.misses += 1
+        return self._factory()
+
+    def release(self, cell):
+        '''Return *cell* to this pool.
+
+        If the pool is already full, *cell* is left for the garbage
+        collector.
+
+        :param cell cell: cell the caller is done with
+        '''
+        if len(self._free) >= self.max_size:
+            self.discards += 1
+            return
+        if self._reset is not None:
+            self._reset(cell)
+        self.releases += 1
+        self._free.append(cell)
+
+    def hitRate(self):
+        '''
+        :returns: **float** fraction of acquire() calls that were served
+            by a recycled cell
+        '''
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def stats(self):
+        '''
+        :returns: **dict** counters for this pool
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'releases': self.releases,
+            'discards': self.discards,
+            'free': len(self._free),
+            'hit_rate': self.hitRate(),
+        }
+
+    def __len__(self):
+        return len(self._free)
+
+
+# cell type -> CellPool, only filled in while pooling is enabled
+_pools = {}
+
+
+def _newEncryptedCell():
+    from oppy.cell.fixedlen import EncryptedCell, FixedLenCell
+    return EncryptedCell(FixedLenCell.Header())
+
+
+def _resetEncryptedCell(cell):
+    cell.enc_payload = None
+
+
+def _relayCellFactory(cell_type):
+    def factory():
+        from oppy.cell.fixedlen import FixedLenCell
+        from oppy.cell.relay import RelayCell
+        return cell_type(FixedLenCell.Header(),
+                         RelayCell.RelayHeader(None, None, None, None, None))
+    return factory
+
+
+def _resetRelayCell(cell):
+    cell.rpayload = None
+
+
+def enablePooling(max_size=DEFAULT_POOL_SIZE):
+    '''Start pooling inbound EncryptedCells and RelayDataCells and
+    outbound RelaySendMeCells.
+
+    Any existing pools (and their counters) are replaced.
+
+    :param int max_size: maximum number of free cells kept per cell type
+    '''
+    from oppy.cell.fixedlen import EncryptedCell
+    from oppy.cell.relay import RelayDataCell, RelaySendMeCell
+
+    _pools.clear()
+    _pools[EncryptedCell] = CellPool(_newEncryptedCell, _resetEncryptedCell,
+                                     max_size)
+    _pools[RelayDataCell] = CellPool(_relayCellFactory(RelayDataCell),
+                                     _resetRelayCell, max_size)
+    _pools[RelaySendMeCell] = CellPool(_relayCellFactory(RelaySendMeCell),
+                                       _resetRelayCell, max_size)
+
+
+def disablePooling():
+    '''Stop pooling cells and drop every pool.'''
+    _pools.clear()
+
+
+def isPoolingEnabled():
+    '''
+    :returns: **bool** whether cells are currently being pooled
+    '''
+    return len(_pools) > 0
+
+
+def getPool(cell_type):
+    '''Return the pool for *cell_type*, or **None** if that type isn't
+    being pooled.
+
+    :param type cell_type: concrete cell class
+    :returns: :class:`~oppy.cell.pool.CellPool` or **None**
+    '''
+    return _pools.get(cell_type)
+
+
+def release(cell):
+    '''Hand *cell* back to its pool, if its type is being pooled.
+
+    :param cell cell: cell the caller is done with
+    '''
+    pool = _pools.get(type(cell))
+    if pool is not None:
+        pool.release(cell)
+
+
+def poolStats():
+    '''
+    :returns: **dict** mapping cell class names to their pool's counters
+    '''
+    return dict((cls.__name__, pool.stats()) for cls, pool in _pools.items())
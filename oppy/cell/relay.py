@@ -4,13 +4,29 @@
 import struct
 
 import oppy.cell.definitions as DEF
+import oppy.cell.pool as pool
 
 from oppy.cell.exceptions import BadRelayCellHeader, BadPayloadData
 from oppy.cell.fixedlen import FixedLenCell
+from oppy.cell.schema import CellSchema, Field, atMost, oneOf
 
 
 RELAY_HEADER_LEN = 11
 
+RELAY_HEADER_SCHEMA = CellSchema([
+    Field('cmd', 'B', oneOf(DEF.RELAY_CMD_IDS, "Unrecognized relay cmd {}",
+                            exc=BadRelayCellHeader)),
+    Field('recognized', '2s'),
+    Field('stream_id', 'H'),
+    Field('digest', '4s'),
+    Field('rpayload_len', 'H', atMost(DEF.MAX_RPAYLOAD_LEN, "rpayload_len "
+                                      "{} found, but max rpayload_len is {}",
+                                      exc=BadRelayCellHeader)),
+])
+
+# used to zero out the unused tail of a relay payload
+PADDING_BYTES = '\x00' * DEF.MAX_PAYLOAD_LEN
+
 
 class RelayCell(FixedLenCell):
     '''A container class for representing relay cells.
@@ -19,8 +35,8 @@ class RelayCell(FixedLenCell):
         Link Protocol version in use).
     '''
 
-    rheader = None
-    rpayload = None
+    __slots__ = ('rheader', 'rpayload')
+
     _subclass_map = None
 
     def __init__(self, header, rheader=None, rpayload=''):
@@ -46,6 +62,53 @@ class RelayCell(FixedLenCell):
         ret = self.header.getBytes() + self.rheader.getBytes() + self.rpayload
         return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def getPayload(self):
+        '''Return this cell's padded payload (relay header and relay
+        payload) without building the rest of the cell.
+
+        :returns: **str** cell payload bytes
+        '''
+        buf = bytearray(DEF.MAX_PAYLOAD_LEN)
+        self.writePayloadInto(buf)
+        return str(buf)
+
+    def writeInto(self, buf, offset=0):
+        '''Pack this cell, including padding, into the bytearray *buf* at
+        *offset*.
+
+        :param bytearray buf: buffer to write this cell into
+        :param int offset: position in *buf* to start writing at
+        :returns: **int** number of bytes written
+        '''
+        n = self.header.writeInto(buf, offset)
+        return n + self.writePayloadInto(buf, offset + n)
+
+    def writePayloadInto(self, buf, offset=0):
+        '''Pack this cell's payload (relay header, relay payload and
+        padding) into the bytearray *buf* at *offset*.
+
+        The padding is always written out explicitly, so *buf* may be
+        reused between cells.
+
+        :param bytearray buf: buffer to write this payload into
+        :param int offset: position in *buf* to start writing at
+        :returns: **int** number of bytes written
+        '''
+        start = offset + self.rheader.writeInto(buf, offset)
+        rpayload = self._getRelayPayload()
+        end = start + len(rpayload)
+        buf[start:end] = rpayload
+        pad_end = offset + DEF.MAX_PAYLOAD_LEN
+        buf[end:pad_end] = PADDING_BYTES[:pad_end - end]
+        return DEF.MAX_PAYLOAD_LEN
+
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        return self.rpayload
+
     def _parsePayload(self, data):
         self._parseRelayHeader(data)
         self._parseRelayPayload(data)
@@ -55,20 +118,9 @@ class RelayCell(FixedLenCell):
 
         :param str data: data string to parse and extract values from
         '''
-        start, end = self.relayHeaderRange()
-        rheader = struct.unpack(RelayCell.RelayHeader.FORMAT, data[start:end])
-        r = RelayCell.RelayHeader(*rheader)
-
-        if r.rpayload_len > DEF.MAX_RPAYLOAD_LEN:
-            msg = 'rpayload_len {} found, but max rpayload_len is {}'
-            msg = msg.format(r.rpayload_len, DEF.MAX_RPAYLOAD_LEN)
-            raise BadRelayCellHeader(msg)
-
-        if r.cmd not in DEF.RELAY_CMD_IDS:
-            msg = 'Unrecognized relay cmd {}'.format(r.cmd)
-            raise BadRelayCellHeader(msg)
-
-        self.rheader = r
+        start, _ = self.relayHeaderRange()
+        values, _ = RELAY_HEADER_SCHEMA.unpackFrom(data, start)
+        self.rheader = RelayCell.RelayHeader(*values)
 
     def _parseRelayPayload(self, data):
         '''Parse *data* and extract this cell's relay payload.
@@ -174,13 +226,10 @@ class RelayCell(FixedLenCell):
     class RelayHeader(object):
         '''A simple container for relay header information.'''
 
-        FORMAT = "!B2sH4sH"
+        FORMAT = RELAY_HEADER_SCHEMA.codec.format
 
-        cmd = None
-        recognized = None
-        stream_id = None
-        digest = None
-        rpayload_len = None
+        __slots__ = ('cmd', 'recognized', 'stream_id', 'digest',
+                     'rpayload_len')
 
         def __init__(self, cmd, recognized, stream_id, digest, rpayload_len):
             self.cmd = cmd
@@ -195,10 +244,22 @@ class RelayCell(FixedLenCell):
 
             :returns: **str** byte string represented by this cell.
             '''
-            fmt = RelayCell.RelayHeader.FORMAT
-            return struct.pack(fmt, self.cmd, self.recognized,
-                               self.stream_id, self.digest,
-                               self.rpayload_len)
+            return RELAY_HEADER_SCHEMA.codec.pack(
+                self.cmd, self.recognized, self.stream_id, self.digest,
+                self.rpayload_len)
+
+        def writeInto(self, buf, offset=0):
+            '''Pack this relay header into the bytearray *buf* at
+            *offset*.
+
+            :param bytearray buf: buffer to write this header into
+            :param int offset: position in *buf* to start writing at
+            :returns: **int** number of bytes written
+            '''
+            RELAY_HEADER_SCHEMA.codec.pack_into(
+                buf, offset, self.cmd, self.recognized, self.stream_id,
+                self.digest, self.rpayload_len)
+            return RELAY_HEADER_SCHEMA.size
 
         def __repr__(self):
             fmt = "RelayCell.RelayHeader(cmd={}, recognized={}, stream_id={}, "
@@ -207,9 +268,24 @@ class RelayCell(FixedLenCell):
                               repr(self.stream_id), repr(self.digest),
                               repr(self.rpayload_len))
 
+        def __eq__(self, other):
+            if type(other) is type(self):
+                return (self.cmd == other.cmd and
+                        self.recognized == other.recognized and
+                        self.stream_id == other.stream_id and
+                        self.digest == other.digest and
+                        self.rpayload_len == other.rpayload_len)
+            return False
+
+        def __ne__(self, other):
+            return not self == other
+
 
 class RelayBeginDirCell(RelayCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make RelayBeginDirCell yet.")
 
@@ -217,6 +293,8 @@ class RelayBeginDirCell(RelayCell):
 class RelayBeginCell(RelayCell):
     '''.. note:: tor-spec, Section 6.2'''
 
+    __slots__ = ('addr', 'flags')
+
     def __init__(self, header, rheader=None, addr=None, flags=None):
         '''
         :param :class:`~cell.fixedlen.FixedLenCell.Header` header:
@@ -282,13 +360,19 @@ class RelayBeginCell(RelayCell):
         :returns: **str** raw byte string represented by this cell
         '''
         ret = self.header.getBytes() + self.rheader.getBytes()
-        ret += self.addr
-        ret += self.flags
+        ret += self._getRelayPayload()
         if trimmed is True:
             return ret
         else:
             return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        return self.addr + self.flags
+
     def _parseRelayPayload(self, data):
         # Not yet implemented because of low-priority (OP does not receive
         # relay begin cells). In fact, we must immediately tear down a circuit
@@ -309,6 +393,8 @@ TTL_LEN        = 4
 class RelayConnectedCell(RelayCell):
     '''.. note:: tor-spec, Section 6.2'''
 
+    __slots__ = ('addr_type', 'addr', 'ttl')
+
     def __init__(self, header, rheader=None, addr_type=None, addr=None,
                  ttl=None):
         '''
@@ -333,12 +419,19 @@ class RelayConnectedCell(RelayCell):
         :returns: **str** raw bytes this cell represents
         '''
         ret = self.header.getBytes() + self.rheader.getBytes()
-        ret += self.addr + self.addr_type + self.ttl
+        ret += self._getRelayPayload()
         if trimmed is True:
             return ret
         else:
             return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        return self.addr + self.addr_type + self.ttl
+
     def _parseRelayPayload(self, data):
         '''Parse the string *data* and extract cell fields.
 
@@ -375,6 +468,8 @@ class RelayDataCell(RelayCell):
         and relay header, so the payload is just treated as a blob.
     '''
 
+    __slots__ = ()
+
     @staticmethod
     def make(circ_id, stream_id, rpayload, link_version=3):
         '''Construct and return a RelayData cell, using default values
@@ -399,6 +494,41 @@ class RelayDataCell(RelayCell):
                                   rpayload_len=len(rpayload))
         return RelayDataCell(h, rheader=r, rpayload=rpayload)
 
+    @staticmethod
+    def fromPayload(circ_id, cmd, payload, link_version=3):
+        '''Build a RelayDataCell for an inbound cell straight from its
+        decrypted, recognized payload.
+
+        This skips the generic subclass lookup done by
+        :meth:`~oppy.cell.cell.Cell.parse`, so the caller is responsible
+        for only passing payloads whose relay command is RELAY_DATA_CMD.
+        The relay header is still checked as usual.
+
+        If RelayDataCells are being pooled (see :mod:`oppy.cell.pool`),
+        the cell is taken from the pool instead of being created.
+
+        :param int circ_id: Circuit ID of this cell
+        :param int cmd: RELAY_CMD or RELAY_EARLY_CMD
+        :param str payload: the cell's full decrypted payload
+        :param int link_version: Link Protocol version in use
+        :returns: :class:`~oppy.cell.relay.RelayDataCell`
+        '''
+        cell_pool = pool.getPool(RelayDataCell)
+        if cell_pool is None:
+            h = FixedLenCell.Header(circ_id, cmd, link_version)
+            values, offset = RELAY_HEADER_SCHEMA.unpackFrom(payload)
+            return RelayDataCell(h, RelayCell.RelayHeader(*values),
+                                 payload[offset:offset + values[-1]])
+
+        cell = cell_pool.acquire()
+        h = cell.header
+        h.circ_id = circ_id
+        h.cmd = cmd
+        h.link_version = link_version
+        offset = RELAY_HEADER_SCHEMA.parseInto(cell.rheader, payload)
+        cell.rpayload = payload[offset:offset + cell.rheader.rpayload_len]
+        return cell
+
 
 class RelayDropCell(RelayCell):
     '''.. note:: tor-spec, Section 6.2
@@ -406,15 +536,24 @@ class RelayDropCell(RelayCell):
     .. note: RelayDropCell is a long-range dummy cell and they are immediately
         dropped upon receipt.
     '''
+
+    __slots__ = ()
+
     pass
 
 
 REASON_SIZE = 1
 
+REASON_SCHEMA = CellSchema([
+    Field('reason', 'B'),
+])
+
 
 class RelayEndCell(RelayCell):
     '''.. note:: tor-spec, Section 6.3'''
 
+    __slots__ = ('reason', 'reason_data')
+
     def __init__(self, header, rheader=None, reason=None, reason_data=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -465,13 +604,19 @@ class RelayEndCell(RelayCell):
         :returns: **str** raw byte string this cell represents
         '''
         ret = self.header.getBytes() + self.rheader.getBytes()
-        ret += struct.pack('!B', self.reason)
-        ret += self.reason_data
+        ret += self._getRelayPayload()
         if trimmed is True:
             return ret
         else:
             return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        return REASON_SCHEMA.getBytes(self) + self.reason_data
+
     def _parseRelayPayload(self, data):
         '''Parse the string *data* and extract RelayEndCell payload values.
 
@@ -481,8 +626,7 @@ class RelayEndCell(RelayCell):
         '''
         start, end = self.relayPayloadRange()
         offset = start
-        self.reason = struct.unpack('!B', data[offset:offset + REASON_SIZE])[0]
-        offset += REASON_SIZE
+        offset = REASON_SCHEMA.parseInto(self, data, offset, end)
 
         if self.reason == DEF.REASON_EXITPOLICY:
             self.reason_data = data[offset:end]
@@ -502,10 +646,22 @@ LSLEN_LEN   = 1
 HTYPE_LEN   = 2
 HLEN_LEN    = 2
 
+# the handshake part of an EXTEND2 cell, following its link specifiers
+EXTEND2_HANDSHAKE_SCHEMA = CellSchema([
+    Field('htype', 'H'),
+    Field('hlen', 'H'),
+], tail='hdata', tail_len='hlen')
+
+EXTENDED2_SCHEMA = CellSchema([
+    Field('hlen', 'H'),
+], tail='hdata', tail_len='hlen')
+
 
 class RelayExtend2Cell(RelayCell):
     '''.. note:: tor-spec, Section 5.1.2'''
 
+    __slots__ = ('nspec', 'lspecs', 'htype', 'hlen', 'hdata')
+
     def __init__(self, header, rheader=None, nspec=None, lspecs=None,
                  htype=None, hlen=None, hdata=None):
         '''
@@ -616,19 +772,25 @@ class RelayExtend2Cell(RelayCell):
         :returns: **str** raw byte string this cell represents
         '''
         ret = self.header.getBytes() + self.rheader.getBytes()
-        ret += struct.pack('!B', self.nspec)
-
-        for lspec in self.lspecs:
-            ret += lspec.getBytes()
-
-        ret += struct.pack('!H', self.htype)
-        ret += struct.pack('!H', self.hlen)
-        ret += self.hdata
+        ret += self._getRelayPayload()
         if trimmed is True:
             return ret
         else:
             return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        ret = struct.pack('!B', self.nspec)
+
+        for lspec in self.lspecs:
+            ret += lspec.getBytes()
+
+        ret += EXTEND2_HANDSHAKE_SCHEMA.getBytes(self)
+        return ret
+
     def _parseRelayPayload(self, data):
         '''Parse the string *data* and extract Extend2 fields.
 
@@ -636,7 +798,7 @@ class RelayExtend2Cell(RelayCell):
 
         :param str data: data string to parse
         '''
-        start, _ = self.relayPayloadRange()
+        start, end = self.relayPayloadRange()
         offset = start
 
         self.nspec = struct.unpack('!B', data[offset:offset + NSPEC_LEN])[0]
@@ -653,12 +815,7 @@ class RelayExtend2Cell(RelayCell):
         self.lspecs = data[lspecs_start:lspecs_end]
 
         # Parse each of the handshake fields.
-        self.htype = struct.unpack('!H', data[offset:offset + HTYPE_LEN])[0]
-        offset += HTYPE_LEN
-        self.hlen  = struct.unpack('!H', data[offset:offset + HLEN_LEN])[0]
-        offset += HLEN_LEN
-
-        self.hdata = data[offset:offset + self.hlen]
+        EXTEND2_HANDSHAKE_SCHEMA.parseInto(self, data, offset, end)
 
     def __repr__(self):
         fmt = '{}, rheader={}, nspec={}, lspecs={}, htype={}, hlen={}, '
@@ -673,6 +830,8 @@ class RelayExtend2Cell(RelayCell):
 class RelayExtended2Cell(RelayCell):
     '''.. note:: tor-spec, Section 5.1, 5.1.2'''
 
+    __slots__ = ('hlen', 'hdata')
+
     def __init__(self, header, rheader=None, hlen=None, hdata=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -694,13 +853,19 @@ class RelayExtended2Cell(RelayCell):
         :returns: **str** raw byte string this cell represents
         '''
         ret = self.header.getBytes() + self.rheader.getBytes()
-        ret += struct.pack('!H', self.hlen)
-        ret += self.hdata
+        ret += self._getRelayPayload()
         if trimmed is True:
             return ret
         else:
             return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        return EXTENDED2_SCHEMA.getBytes(self)
+
     def _parseRelayPayload(self, data):
         '''Parse the string *data* and extract Extended2 fields.
 
@@ -708,16 +873,8 @@ class RelayExtended2Cell(RelayCell):
 
         :param str data: data string to parse
         '''
-        start, _ = self.relayPayloadRange()
-        offset = start
-
-        self.hlen = struct.unpack('!H', data[offset:offset + HLEN_LEN])[0]
-        offset += HLEN_LEN
-
-        try:
-            self.hdata = data[offset:offset + self.hlen]
-        except IndexError:
-            raise BadPayloadData('Not enough hdata bytes.')
+        start, end = self.relayPayloadRange()
+        EXTENDED2_SCHEMA.parseInto(self, data, start, end)
 
     def __repr__(self):
         fmt = 'RelayExtended2Cell({}, rheader={}, hlen={}, hdata={})'
@@ -727,24 +884,36 @@ class RelayExtended2Cell(RelayCell):
 
 class RelayExtendedCell(RelayCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make RelayExtendedCell yet.")
 
 
 class RelayExtendCell(RelayCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make RelayExtendCell yet.")
 
 
 class RelayResolvedCell(RelayCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make RelayResolvedCell yet.")
 
 
 class RelayResolveCell(RelayCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make RelayResolveCell yet.")
 
@@ -756,6 +925,8 @@ class RelaySendMeCell(RelayCell):
         we just use parent class fields and methods.
     '''
 
+    __slots__ = ()
+
     # convenience function to simplify construction
     @staticmethod
     def make(circ_id, stream_id=0, link_version=3):
@@ -763,7 +934,8 @@ class RelaySendMeCell(RelayCell):
         where possible.
 
         Create a FixedLenCell.Header and a RelayCell.RelayHeader for use
-        in this cell.
+        in this cell, unless RelaySendMeCells are being pooled (see
+        :mod:`oppy.cell.pool`), in which case a pooled cell is reused.
 
         :param int circ_id: Circuit ID to use in this cell
         :param int stream_id: Stream ID to use in this cell. A Stream ID of
@@ -772,6 +944,22 @@ class RelaySendMeCell(RelayCell):
         :param int link_version: Link Protocol version in use
         :returns: :class:`~oppy.cell.relay.RelaySendMeCell`
         '''
+        cell_pool = pool.getPool(RelaySendMeCell)
+        if cell_pool is not None:
+            cell = cell_pool.acquire()
+            h = cell.header
+            h.circ_id = circ_id
+            h.cmd = DEF.RELAY_CMD
+            h.link_version = link_version
+            r = cell.rheader
+            r.cmd = DEF.RELAY_SENDME_CMD
+            r.recognized = DEF.RECOGNIZED
+            r.stream_id = stream_id
+            r.digest = DEF.EMPTY_DIGEST
+            r.rpayload_len = 0
+            cell.rpayload = ''
+            return cell
+
         h = FixedLenCell.Header(circ_id=circ_id,
                                 cmd=DEF.RELAY_CMD,
                                 link_version=link_version)
@@ -786,6 +974,8 @@ class RelaySendMeCell(RelayCell):
 class RelayTruncatedCell(RelayCell):
     '''.. note:: tor-spec, Section 5.4'''
 
+    __slots__ = ('reason',)
+
     def __init__(self, header, rheader=None, reason=None):
         '''
         :param :class:`~oppy.cell.fixedlen.FixedLenCell.Header` header:
@@ -806,12 +996,19 @@ class RelayTruncatedCell(RelayCell):
         :returns: **str** raw bytes this cell represents
         '''
         ret = self.header.getBytes() + self.rheader.getBytes()
-        ret += struct.pack('!B', self.reason)
+        ret += self._getRelayPayload()
         if trimmed is True:
             return ret
         else:
             return FixedLenCell.padCellBytes(ret, self.header.link_version)
 
+    def _getRelayPayload(self):
+        '''Return this cell's relay payload bytes (without padding).
+
+        :returns: **str** relay payload bytes
+        '''
+        return REASON_SCHEMA.getBytes(self)
+
     def _parseRelayPayload(self, data):
         '''Parse the string *data* and extract RelayTruncatedCell fields.
 
@@ -819,8 +1016,8 @@ class RelayTruncatedCell(RelayCell):
 
         :param str data: data string to parse
         '''
-        start, _ = self.relayPayloadRange()
-        self.reason = struct.unpack('!B', data[start:start + REASON_SIZE])[0]
+        start, end = self.relayPayloadRange()
+        REASON_SCHEMA.parseInto(self, data, start, end)
 
     def __repr__(self):
         fmt = 'RelayTruncatedCell=({}, rheader={}, reason={})'
@@ -830,5 +1027,8 @@ class RelayTruncatedCell(RelayCell):
 
 class RelayTruncateCell(RelayCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header, rheader=None, reason=None):
         raise NotImplementedError("Can't make RelayTruncateCell yet.")
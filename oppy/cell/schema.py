@@ -0,0 +1,202 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Declarative layouts for the fields of cells, relay headers and other
+    cell components.
+
+    A CellSchema is built once, at import time, from a sequence of
+    Fields. The fixed-size fields are compiled into a single
+    struct.Struct, so a whole layout is parsed with one unpack_from() and
+    serialized with one pack_into(), instead of one struct call per field
+    on a freshly sliced string. A layout may end with a variable-length
+    byte string (e.g. a handshake's HDATA) whose length is given by one of
+    its fixed fields.
+
+    Fields can carry a check that rejects malformed values; every parse
+    runs them, along with a bounds check on the variable-length tail.
+
+'''
+import struct
+
+from itertools import izip
+
+from oppy.cell.exceptions import BadPayloadData
+
+
+class Field(object):
+    '''A single fixed-size field in a CellSchema.'''
+
+    __slots__ = ('name', 'fmt', 'check')
+
+    def __init__(self, name, fmt, check=None):
+        '''
+        :param str name: attribute name this field is stored under
+        :param str fmt: struct format character(s) for this field
+            (without a byte order prefix)
+        :param check: callable taking the parsed value that raises an
+            exception if the value is invalid, or **None**
+        '''
+        self.name = name
+        self.fmt = fmt
+        self.check = check
+
+
+def equals(expected, msg, exc=BadPayloadData):
+    '''Return a Field check that requires a value equal to *expected*.
+
+    :param expected: the only valid value
+    :param str msg: error message, formatted with (value, expected)
+    :param type exc: exception type to raise
+    :returns: **function** check
+    '''
+    def check(value):
+        if value != expected:
+            raise exc(msg.format(value, expected))
+    return check
+
+
+def oneOf(allowed, msg, exc=BadPayloadData):
+    '''Return a Field check that requires a value in *allowed*.
+
+    :param allowed: container of valid values
+    :param str msg: error message, formatted with (value, allowed)
+    :param type exc: exception type to raise
+    :returns: **function** check
+    '''
+    def check(value):
+        if value not in allowed:
+            raise exc(msg.format(value, allowed))
+    return check
+
+
+def atMost(limit, msg, exc=BadPayloadData):
+    '''Return a Field check that requires a value no larger than *limit*.
+
+    :param int limit: largest valid value
+    :param str msg: error message, formatted with (value, limit)
+    :param type exc: exception type to raise
+    :returns: **function** check
+    '''
+    def check(value):
+        if value > limit:
+            raise exc(msg.format(value, limit))
+    return check
+
+
+class CellSchema(object):
+    '''A compiled layout of Fields, optionally followed by a
+    variable-length byte string.'''
+
+    __slots__ = ('names', 'codec', 'size', 'tail', 'tail_len', '_checks',
+                 '_all_names', '_tail_len_index')
+
+    def __init__(self, fields, tail=None, tail_len=None):
+        '''
+        :param list fields: Fields, in wire order
+        :param str tail: attribute name of a trailing variable-length byte
+            string, or **None**
+        :param str tail_len: name of the field holding the length of
+            *tail*. Required if *tail* is given.
+        '''
+        if (tail is None) != (tail_len is None):
+            raise ValueError("tail and tail_len must be given together.")
+
+        self.names = tuple(f.name for f in fields)
+        self.codec = struct.Struct('!' + ''.join(f.fmt for f in fields))
+        self.size = self.codec.size
+        self.tail = tail
+        self.tail_len = tail_len
+        self._checks = tuple((i, f.check) for i, f in enumerate(fields)
+                             if f.check is not None)
+        self._all_names = self.names
+        self._tail_len_index = None
+        if tail is not None:
+            self._all_names += (tail,)
+            self._tail_len_index = self.names.index(tail_len)
+
+    def unpackFrom(self, data, offset=0, end=None):
+        '''Parse this layout out of *data* starting at *offset*.
+
+        :param str data: data to parse (a **str** or **buffer**)
+        :param int offset: position in *data* to start parsing at
+        :param int end: position in *data* the layout must end by
+            (defaults to len(data))
+        :returns: **tuple** (values, offset) where *values* holds every
+            field (and the tail, if any) in order and *offset* is the
+            position just past the parsed data
+        '''
+        values = self.codec.unpack_from(data, offset)
+        offset += self.size
+
+        for i, check in self._checks:
+            check(values[i])
+
+        if self.tail is not None:
+            tail_end = offset + values[self._tail_len_index]
+            if end is None:
+                end = len(data)
+            if tail_end > end:
+                msg = "{} was specified to be {} bytes, but only {} "
+                msg += "bytes remain."
+                raise BadPayloadData(msg.format(
+                    self.tail_len, tail_end - offset, end - offset))
+            values += (data[offset:tail_end],)
+            offset = tail_end
+
+        return values, offset
+
+    def parseInto(self, obj, data, offset=0, end=None):
+        '''Parse this layout out of *data* and set the matching attributes
+        on *obj*.
+
+        :param obj: object to fill in
+        :param str data: data to parse
+        :param int offset: position in *data* to start parsing at
+        :param int end: position in *data* the layout must end by
+        :returns: **int** position just past the parsed data
+        '''
+        values, offset = self.unpackFrom(data, offset, end)
+        for name, value in izip(self._all_names, values):
+            setattr(obj, name, value)
+        return offset
+
+    def getBytes(self, obj):
+        '''Serialize the attributes of *obj* described by this layout.
+
+        :param obj: object to serialize
+        :returns: **str** packed bytes
+        '''
+        ret = self.codec.pack(*[getattr(obj, n) for n in self.names])
+        if self.tail is not None:
+            ret += getattr(obj, self.tail)
+        return ret
+
+    def writeInto(self, obj, buf, offset=0):
+        '''Pack the attributes of *obj* described by this layout into the
+        bytearray *buf* at *offset*.
+
+        :param obj: object to serialize
+        :param bytearray buf: buffer to write into
+        :param int offset: position in *buf* to start writing at
+        :returns: **int** number of bytes written
+        '''
+        self.codec.pack_into(buf, offset,
+                             *[getattr(obj, n) for n in self.names])
+        end = offset + self.size
+        if self.tail is not None:
+            tail = getattr(obj, self.tail)
+            buf[end:end + len(tail)] = tail
+            end += len(tail)
+        return end - offset
+
+    def length(self, obj):
+        '''
+        :param obj: object described by this layout
+        :returns: **int** number of bytes *obj* takes up on the wire
+        '''
+        if self.tail is None:
+            return self.size
+        return self.size + len(getattr(obj, self.tail))
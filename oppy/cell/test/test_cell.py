@@ -61,7 +61,7 @@ class CellEnoughDataForCellTestCase(BaseTestCase):
         self.mock_struct.unpack.side_effect = [(None, 7), (8, None)]
 
         result = AbstractCell.enoughDataForCell(
-            self.gen_data(8), link_version=4)
+            self.gen_data(15), link_version=4)
 
         self.assertTrue(result)
         self.mock_struct.unpack.assert_has_calls([
@@ -72,7 +72,7 @@ class CellEnoughDataForCellTestCase(BaseTestCase):
         self.mock_struct.unpack.side_effect = [(None, 7), (8, None)]
 
         result = AbstractCell.enoughDataForCell(
-            self.gen_data(7), link_version=4)
+            self.gen_data(14), link_version=4)
 
         self.assertFalse(result)
         self.mock_struct.unpack.assert_has_calls([
@@ -144,37 +144,31 @@ class CellParseTestCase(BaseTestCase):
         mock_relaycell._parse.assert_called_once_with(
             'abcdef', mock_relaycell.Header.return_value)
 
-    @patch_object(fixedlen, 'FixedLenCell')
-    def test_relay_cmd_encrypted(self, mock_fixedlencell):
+    @patch_object(fixedlen, 'EncryptedCell')
+    def test_relay_cmd_encrypted(self, mock_encryptedcell):
         self.mock_struct.unpack.return_value = ('circ id', 3)
+        data = self.gen_data(514)
 
-        result = AbstractCell.parse(
-            self.gen_data(6), link_version=4, encrypted=True)
+        result = AbstractCell.parse(data, link_version=4, encrypted=True)
 
-        self.assertEqual(result, mock_fixedlencell._parse.return_value)
+        self.assertEqual(result, mock_encryptedcell.fromPayload.return_value)
         self.mock_struct.calcsize.assert_called_once_with('!IB')
         self.mock_struct.unpack.assert_called_once_with('!IB', 'abcde')
-        mock_fixedlencell.Header.assert_called_once_with(
-            circ_id='circ id', cmd=3, link_version=4)
-
-        mock_fixedlencell._parse.assert_called_once_with(
-            'abcdef', mock_fixedlencell.Header.return_value)
+        mock_encryptedcell.fromPayload.assert_called_once_with(
+            'circ id', 3, data[5:514], 4)
 
-    @patch_object(fixedlen, 'FixedLenCell')
-    def test_relay_early_encrypted(self, mock_fixedlencell):
+    @patch_object(fixedlen, 'EncryptedCell')
+    def test_relay_early_encrypted(self, mock_encryptedcell):
         self.mock_struct.unpack.return_value = ('circ id', 9)
+        data = self.gen_data(514)
 
-        result = AbstractCell.parse(
-            self.gen_data(6), link_version=4, encrypted=True)
+        result = AbstractCell.parse(data, link_version=4, encrypted=True)
 
-        self.assertEqual(result, mock_fixedlencell._parse.return_value)
+        self.assertEqual(result, mock_encryptedcell.fromPayload.return_value)
         self.mock_struct.calcsize.assert_called_once_with('!IB')
         self.mock_struct.unpack.assert_called_once_with('!IB', 'abcde')
-        mock_fixedlencell.Header.assert_called_once_with(
-            circ_id='circ id', cmd=9, link_version=4)
-
-        mock_fixedlencell._parse.assert_called_once_with(
-            'abcdef', mock_fixedlencell.Header.return_value)
+        mock_encryptedcell.fromPayload.assert_called_once_with(
+            'circ id', 9, data[5:514], 4)
 
     @patch_object(fixedlen, 'FixedLenCell')
     def test_fixedlen(self, mock_fixedlencell):
@@ -541,11 +535,15 @@ class CellEqualTestCase(BaseTestCase):
     def test_equal(self):
         self.assertTrue(self.cell == Cell())
 
-    def test_not_equal_dicts(self):
-        expected = Cell()
+    def test_not_equal_slots(self):
+        class SlottedCell(Cell):
+            __slots__ = ('header',)
+
+        expected = SlottedCell()
         expected.header = 'header'
 
-        self.assertFalse(self.cell == expected)
+        self.assertFalse(SlottedCell() == expected)
+        self.assertTrue(SlottedCell() != expected)
 
     def test_not_equal_types(self):
         self.assertFalse(self.cell == 'cell')
@@ -8,12 +8,15 @@ import ipaddress
 import oppy.cell.definitions as DEF
 import oppy.util.tools as tools
 
-from oppy.cell.exceptions import BadLinkSpecifier, BadPayloadData
+from oppy.cell.exceptions import BadLinkSpecifier
+from oppy.cell.schema import CellSchema, Field, oneOf
 
 
 class LinkSpecifier(object):
     '''.. note:: tor-spec, Section 5.1.2'''
 
+    __slots__ = ('lstype', 'lslen', 'lspec')
+
     def __init__(self, relay, legacy=False):
         '''
         :param stem.descriptor.server_descriptor.RelayDescriptor relay:
@@ -75,7 +78,9 @@ class TLVTriple(object):
         don't know how to handle a TTL or the various errors that can
         occur.
     '''
-    
+
+    __slots__ = ('addr_type', 'addr_len', 'value')
+
     def __init__(self, addr):
         '''
         :param str addr: IP address for this TLVTriple
@@ -151,13 +156,24 @@ class TLVTriple(object):
 
     def __eq__(self, other):
         if type(other) is type(self):
-            return self.__dict__ == other.__dict__
+            return (self.addr_type == other.addr_type and
+                    self.addr_len == other.addr_len and
+                    self.value == other.value)
         return False
 
+    def __ne__(self, other):
+        return not self == other
+
 CERT_TYPE_LEN = 1
 CERT_LEN_LEN = 2
 SUPPORTED_CERT_TYPES = (1, 2, 3,)
 
+CERTS_ITEM_SCHEMA = CellSchema([
+    Field('cert_type', 'B', oneOf(SUPPORTED_CERT_TYPES, "Got cert type {}, "
+                                  "but oppy only supports cert types {}.")),
+    Field('cert_len', 'H'),
+], tail='cert', tail_len='cert_len')
+
 
 class CertsCellPayloadItem(object):
     
@@ -169,26 +185,12 @@ class CertsCellPayloadItem(object):
         self.cert = cert
 
     def getBytes(self):
-        ret = struct.pack('!B', self.cert_type)
-        ret += struct.pack('!H', self.cert_len)
-        ret += self.cert
-        return ret
+        return CERTS_ITEM_SCHEMA.getBytes(self)
 
     @staticmethod
     def parse(data, offset):
-        cert_type = struct.unpack('!B',
-                                  data[offset: offset + CERT_TYPE_LEN])[0]
-        offset += CERT_TYPE_LEN
-        if cert_type not in SUPPORTED_CERT_TYPES:
-            msg = "Got cert type {}, but oppy only supports cert types {}."
-            raise BadPayloadData(msg.format(cert_type, SUPPORTED_CERT_TYPES))
-
-        cert_len = struct.unpack('!H', data[offset: offset + CERT_LEN_LEN])[0]
-        offset += CERT_LEN_LEN
-
-        cert = data[offset: offset + cert_len]
-
-        return CertsCellPayloadItem(cert_type, cert_len, cert)
+        values, _ = CERTS_ITEM_SCHEMA.unpackFrom(data, offset)
+        return CertsCellPayloadItem(*values)
 
     def __repr__(self):
         fmt = "CertsCellPayloadItem(cert_type={}, cert_len={}, cert={})"
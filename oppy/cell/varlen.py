@@ -11,9 +11,15 @@ from oppy.cell.exceptions import BadCellHeader, BadPayloadData
 from oppy.cell.util import CertsCellPayloadItem
 
 
+V3_HEADER = struct.Struct("!HBH")
+V4_HEADER = struct.Struct("!IBH")
+
+
 class VarLenCell(Cell):
     '''A container class for representing a variable-length cell.'''
 
+    __slots__ = ('header', 'payload')
+
     _subclass_map = None
 
     def __init__(self, header, payload=None):
@@ -87,6 +93,8 @@ class VarLenCell(Cell):
         '''A simple container class for representing the header information of
         a variable-length cell.'''
 
+        __slots__ = ('circ_id', 'cmd', 'payload_len', 'link_version')
+
         def __init__(self, circ_id=None, cmd=None, payload_len=None,
                      link_version=3):
             '''
@@ -106,8 +114,20 @@ class VarLenCell(Cell):
 
             :returns: **str** raw byte string this header represents
             '''
-            fmt = "!HBH" if self.link_version <= 3 else "!IBH"
-            return struct.pack(fmt, self.circ_id, self.cmd, self.payload_len)
+            fmt = V3_HEADER if self.link_version <= 3 else V4_HEADER
+            return fmt.pack(self.circ_id, self.cmd, self.payload_len)
+
+        def writeInto(self, buf, offset=0):
+            '''Pack this header into the bytearray *buf* at *offset*.
+
+            :param bytearray buf: buffer to write this header into
+            :param int offset: position in *buf* to start writing at
+            :returns: **int** number of bytes written
+            '''
+            fmt = V3_HEADER if self.link_version <= 3 else V4_HEADER
+            fmt.pack_into(buf, offset, self.circ_id, self.cmd,
+                          self.payload_len)
+            return fmt.size
 
         def __repr__(self):
             fmt = "circ_id={}, cmd={}, payload_len={}, link_version={}"
@@ -117,9 +137,15 @@ class VarLenCell(Cell):
 
         def __eq__(self, other):
             if type(self) is type(other):
-                return self.__dict__ == other.__dict__
+                return (self.circ_id == other.circ_id and
+                        self.cmd == other.cmd and
+                        self.payload_len == other.payload_len and
+                        self.link_version == other.link_version)
             return False
 
+        def __ne__(self, other):
+            return not self == other
+
 
 CHALLENGE_LEN = 32
 N_METHODS_LEN = 2
@@ -130,6 +156,8 @@ SUPPORTED_METHODS = (struct.pack('!H', 1),)
 class AuthChallengeCell(VarLenCell):
     '''.. note:: tor-spec, Section 4.3'''
 
+    __slots__ = ('challenge', 'n_methods', 'methods')
+
     def __init__(self, header, challenge=None, n_methods=None, methods=None):
         '''
         :param :class:`~cell.varlen.VarLenCell.Header` header:
@@ -239,12 +267,18 @@ class AuthChallengeCell(VarLenCell):
 
 class AuthenticateCell(VarLenCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make AuthenticateCell yet.")
 
 
 class AuthorizeCell(VarLenCell):
     '''.. note:: Not Implemented'''
+
+    __slots__ = ()
+
     def __init__(self, header):
         raise NotImplementedError("Can't make AuthorizeCell yet.")
 
@@ -258,6 +292,8 @@ MAX_CERTS_PER_CELL = 3
 class CertsCell(VarLenCell):
     '''.. note:: tor-spec, Section 4.2'''
 
+    __slots__ = ('num_certs', 'cert_payload_items')
+
     def __init__(self, header, num_certs=None, cert_payload_items=None):
         '''
         :param :class:`~cell.varlen.VarLenCell.Header` header:
@@ -354,6 +390,8 @@ VERSIONS_LEN = 2
 class VersionsCell(VarLenCell):
     '''.. note:: tor-spec, Section 4.1'''
 
+    __slots__ = ('versions',)
+
     def __init__(self, header, versions=None):
         '''
         :param :class:`~cell.varlen.VarLenCell.Header` header:
@@ -438,6 +476,8 @@ class VPaddingCell(VarLenCell):
         parent class.
     '''
 
+    __slots__ = ()
+
     @staticmethod
     def make(circ_id, padding_len, link_version=3):
         '''Construct and return a VPaddingCell, using default values
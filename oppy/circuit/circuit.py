@@ -19,6 +19,8 @@
         - Initiate new stream connections
         - Process incoming data cells and pass data to associated streams
         - Do some flow-control management
+        - Stop taking data from streams while the connection's TLS transport
+          is congested (see pauseWriting())
         - Handle different ways of circuit tear-down depending on the
           current state and why a circuit is being torn down
 
@@ -26,13 +28,17 @@
 import logging
 
 from twisted.internet import defer
+from twisted.python import failure
 
+import oppy.cell.pool as pool
 import oppy.crypto.util as crypto
+import oppy.crypto.workers as workers
 
 from oppy.cell.definitions import (
     MAX_RPAYLOAD_LEN,
     BACKWARD_CELLS,
     DESTROY_CMD,
+    RELAY_CMD,
     RELAY_DATA_CMD,
     RELAY_END_CMD,
     RELAY_CONNECTED_CMD,
@@ -50,7 +56,7 @@ from oppy.circuit.handshake.exceptions import (
     UnexpectedCell,
 )
 
-from oppy.cell.fixedlen import DestroyCell
+from oppy.cell.fixedlen import DestroyCell, RelayHeaderCache
 from oppy.cell.relay import RelayBeginCell
 from oppy.cell.relay import RelayDataCell
 from oppy.cell.relay import RelayEndCell
@@ -95,6 +101,10 @@ class Circuit(object):
         self.circuit_id = cid
         self.path_constraints = path_constraints
         self.connection = None
+        # the circuit ID and Link Protocol version this circuit uses on its
+        # connection, known once the connection is open
+        self.link_circuit_id = None
+        self.link_version = None
         self._selector = PathSelector()
         # _read_queue handles incoming cells from the network
         self._read_queue = defer.DeferredQueue()
@@ -102,9 +112,18 @@ class Circuit(object):
         # _write_queue handles incoming data from local applications
         self._write_queue = defer.DeferredQueue()
         self._write_deferred = None
+        # True while our connection's transport can't take more data
+        self._write_paused = False
         self._stream_map = {}
         self._stream_ctr = 1
         self._crypt_path = []
+        self._headers = None
+        # queues for crypto done in worker threads, one per direction, or
+        # None if this circuit does its crypto on the reactor thread
+        self._outbound_crypto = None
+        self._inbound_crypto = None
+        # True once a DESTROY is waiting behind outbound crypto jobs
+        self._destroy_queued = False
         self._state = CState.PENDING
         # deliver window is incoming data cells
         self._deliver_window = CIRCUIT_WINDOW_THRESHOLD_INIT
@@ -165,6 +184,20 @@ class Circuit(object):
         msg = "Circuit {} got a connection to {}."
         logging.debug(msg.format(self.circuit_id, self.path.entry.address))
 
+        try:
+            self.link_circuit_id = self.connection.linkCircuitID(
+                self.circuit_id)
+        except ValueError as e:
+            logging.debug(str(e))
+            self.connection = None
+            self._closeCircuit()
+            return
+        self.link_version = self.connection.link_version
+        # RELAY and RELAY_EARLY headers are the same for every cell this
+        # circuit sends, so pack them once
+        self._headers = RelayHeaderCache(self.link_circuit_id,
+                                         self.link_version)
+
         # register ourselves with this circuit's connection
         self.connection.addNewCircuit(self)
         # start the handshaking process immediately
@@ -179,8 +212,8 @@ class Circuit(object):
         write the initiating cell to the entry node (for now, always a
         Create2 cell).
         '''
-        self._handshake = NTorFSM(self.circuit_id, self.path,
-                                  self._crypt_path)
+        self._handshake = NTorFSM(self.link_circuit_id, self.path,
+                                  self._crypt_path, self.link_version)
         cell = self._handshake.getInitiatingCell()
         self.connection.writeCell(cell)
         msg = "Circuit {} initiated NTor handshake with {}."
@@ -206,11 +239,16 @@ class Circuit(object):
         self._handshake = None
 
         self._state = CState.OPEN
+        # the handshake is done with the crypt path, so from here on its
+        # ciphers and digests may be used from worker threads
+        self._outbound_crypto = workers.makeQueue()
+        self._inbound_crypto = workers.makeQueue()
         # notify circuit manager we're open
         circuit_manager.circuitOpened(self)
         # notify each pending stream that we're now open
         # can now start listening for outgoing data
-        self._pollWriteQueue()
+        if self._write_paused is False:
+            self._pollWriteQueue()
 
     ##################################################################
     ###################### QUEUEING METHODS ##########################
@@ -265,22 +303,92 @@ class Circuit(object):
         Do the following:
 
             1. Package this data (with appropriate stream_id) into a
-               RelayDataCell.
-            2. Encrypt this cell.
-            3. Write this cell to this circuit's connection.
+               RelayDataCell, along with any other data that's already
+               waiting on this circuit's write_queue (up to the number of
+               cells the package window allows).
+            2. Encrypt these cells in one batch.
+            3. Write these cells to this circuit's connection.
             4. Decrement this circuit's packaging window (if we can't
                package anymore data, enter state CState.BUFFERING, otherwise
                begin polling from _write_queue again).
 
+        If this circuit encrypts in a worker thread, steps 3 and 4 happen
+        once the batch has been encrypted, so data written in the meantime
+        is packaged into the next batch.
+
+        If this circuit's connection has paused it in the meantime, put the
+        data back on the write_queue instead; it's written once the
+        connection resumes this circuit.
+
+        A tuple with **None** for data marks the end of a stream (see
+        unregisterStream()); the stream's RelayEndCell is sent once every
+        data cell ahead of it has been.
+
         :param tuple, str, int data_stream_id_tuple: tuple of (data, stream_id)
             to package into a RelayData cell
         '''
-        data, stream_id = data_stream_id_tuple
-        assert len(data) <= MAX_RPAYLOAD_LEN
-        cell = RelayDataCell.make(self.circuit_id, stream_id, data)
-        enc = crypto.encryptCellToTarget(cell, self._crypt_path)
-        self.writeCell(enc)
-        self._decPackageWindow()
+        if self._write_paused is True:
+            self._write_queue.pending.insert(0, data_stream_id_tuple)
+            self._write_deferred = None
+            return
+
+        if data_stream_id_tuple[0] is None:
+            self._endStream(data_stream_id_tuple[1])
+            self._decPackageWindow(0)
+            return
+
+        batch = [data_stream_id_tuple]
+        pending = self._write_queue.pending
+        while pending and pending[0][0] is not None and \
+                len(batch) < self._package_window:
+            batch.append(pending.pop(0))
+
+        cells = []
+        for data, stream_id in batch:
+            assert len(data) <= MAX_RPAYLOAD_LEN
+            cells.append(RelayDataCell.make(self.link_circuit_id, stream_id,
+                                            data, self.link_version))
+        d = self._sendRelayCells(cells)
+        d.addCallback(lambda _: self._decPackageWindow(len(cells)))
+
+    def _sendRelayCells(self, cells, release=False):
+        '''Encrypt *cells* to this circuit's exit and write them to this
+        circuit's connection.
+
+        If this circuit does its crypto in worker threads (see
+        :mod:`oppy.crypto.workers`), the cells are encrypted in a worker
+        thread and written once that's done. Either way, cells are written
+        in the order they were passed to _sendRelayCells().
+
+        :param list cells: relay cells to send, in order
+        :param bool release: if **True**, hand *cells* back to the cell pool
+            once they've been encrypted
+        :returns: **twisted.internet.defer.Deferred** that fires once the
+            cells have been written
+        '''
+        if self._outbound_crypto is None:
+            payloads = crypto.encryptPayloadsToTarget(cells, self._crypt_path)
+            self._writeEncrypted(payloads, cells, release)
+            return defer.succeed(None)
+        d = self._outbound_crypto.submit(crypto.encryptPayloadsToTarget,
+                                         cells, self._crypt_path)
+        d.addCallback(self._writeEncrypted, cells, release)
+        return d
+
+    def _writeEncrypted(self, payloads, cells, release):
+        '''Frame the encrypted *payloads* of *cells* and write them to this
+        circuit's connection.
+
+        :param str payloads: encrypted payloads, back to back
+        :param list cells: the relay cells that were encrypted
+        :param bool release: if **True**, hand *cells* back to the cell pool
+        '''
+        for enc in crypto.makeEncryptedCells(cells, payloads,
+                                             headers=self._headers):
+            self.writeCell(enc)
+        if release is True:
+            for cell in cells:
+                pool.release(cell)
 
     def _recvCell(self, cell):
         '''Pass *cell* to the appropriate handler depending on this circuit's
@@ -290,10 +398,50 @@ class Circuit(object):
         '''
         if self._state == CState.PENDING:
             self._recvHandshakeCell(cell)
+        elif self._inbound_crypto is not None and cell.header.cmd == RELAY_CMD:
+            # keep reading once this burst has been decrypted and handled,
+            # so cells arriving in the meantime make up the next burst
+            d = self._recvRelayCellsInWorker(self._drainRelayCells(cell))
+            d.addBoth(self._relayCellsHandled)
+            return
+        elif cell.header.cmd == RELAY_CMD and self._read_queue.pending:
+            self._recvRelayCells(self._drainRelayCells(cell))
         else:
             self._recvCircuitCell(cell)
         self._pollReadQueue()
 
+    def _relayCellsHandled(self, result):
+        '''Listen for more incoming cells once a burst of RELAY cells
+        decrypted in a worker thread has been handled, or destroy this
+        circuit if that failed.
+
+        :param result: result of handling the burst, or a
+            **twisted.python.failure.Failure**
+        '''
+        if isinstance(result, failure.Failure):
+            msg = "Circuit {} failed to handle incoming cells: {}. "
+            msg += "Destroying circuit."
+            logging.warning(msg.format(self.circuit_id,
+                                       result.getErrorMessage()))
+            self._sendDestroyCell()
+            self._closeCircuit()
+            return
+        self._pollReadQueue()
+
+    def _drainRelayCells(self, cell):
+        '''Take every RELAY cell waiting at the front of this circuit's
+        read_queue, so a burst of cells can be decrypted together.
+
+        :param cell cell: RELAY cell that was just taken from the read_queue
+        :returns: **list** *cell* followed by the RELAY cells that were
+            queued behind it, in the order they were received
+        '''
+        cells = [cell]
+        pending = self._read_queue.pending
+        while pending and pending[0].header.cmd == RELAY_CMD:
+            cells.append(pending.pop(0))
+        return cells
+
     def _recvHandshakeCell(self, cell):
         '''Called when this circuit is in state CState.PENDING and a cell
         is received from the network.
@@ -304,30 +452,60 @@ class Circuit(object):
         connection. If the handshake is complete with every node on this
         circuit's path, open the circuit (e.g. call self._openCircuit()).
 
+        The handshake may derive keys in a worker thread (see
+        :func:`oppy.crypto.ntorhandshake.enableThreadedDerivation`), in
+        which case its response is handled once the derivation finishes.
+
         :param cell cell: the cell received from the network.
         '''
-        try:
-            response = self._handshake.recvCell(cell)
-        except ReceivedDestroyCell as e:
-            logging.debug(str(e))
-            self.destroyCircuitFromRelay(cell)
-            return
-        except (BadHandshakeState, HandshakeFailed, UnexpectedCell) as e:
-            self.destroyCircuitProtocolViolation(cell)
-            logging.debug(str(e))
-            return
-        except KeyDerivationFailed:
-            msg = "NTor key derivation failed on circuit {}."
-            logging.debug(msg.format(self.circuit_id))
-            self.destroyCircuitProtocolViolation(cell)
+        handshake = self._handshake
+        d = defer.maybeDeferred(handshake.recvCell, cell)
+        d.addCallbacks(self._handshakeResponse, self._handshakeFailed,
+                       callbackArgs=(handshake,),
+                       errbackArgs=(handshake, cell))
+
+    def _handshakeResponse(self, response, handshake):
+        '''Write *response* (if any) to this circuit's connection and open
+        this circuit if *handshake* is done.
+
+        :param cell response: the handshake's next cell, or None
+        :param handshake: the handshake that produced *response*
+        '''
+        # this circuit was torn down while the handshake derived keys
+        if self._handshake is not handshake:
             return
-
         if response is not None:
             self.connection.writeCell(response)
-        if self._handshake.isDone():
+        if handshake.isDone():
             self._openCircuit()
             self._handshake = None
 
+    def _handshakeFailed(self, failure, handshake, cell):
+        '''Destroy this circuit because *handshake* failed while
+        processing *cell*.
+
+        :param twisted.python.failure.Failure failure: why the handshake
+            failed
+        :param handshake: the handshake that failed
+        :param cell cell: the cell the handshake was processing
+        '''
+        e = failure.trap(ReceivedDestroyCell, BadHandshakeState,
+                         HandshakeFailed, UnexpectedCell,
+                         KeyDerivationFailed)
+        # this circuit was torn down while the handshake derived keys
+        if self._handshake is not handshake:
+            return
+        if e is ReceivedDestroyCell:
+            logging.debug(failure.getErrorMessage())
+            self.destroyCircuitFromRelay(cell)
+        elif e is KeyDerivationFailed:
+            msg = "NTor key derivation failed on circuit {}."
+            logging.debug(msg.format(self.circuit_id))
+            self.destroyCircuitProtocolViolation(cell)
+        else:
+            self.destroyCircuitProtocolViolation(cell)
+            logging.debug(failure.getErrorMessage())
+
     def _recvCircuitCell(self, cell):
         '''Called when this circuit receives a cell and it's state is
         CState.OPEN.
@@ -359,18 +537,90 @@ class Circuit(object):
         :param cell cell: cell received from the network
         '''
         try:
-            cell, origin = crypto.decryptCellUntilRecognized(cell,
-                                                             self._crypt_path)
+            dec, origin = crypto.decryptCellUntilRecognized(cell,
+                                                            self._crypt_path)
         # drop unrecognized cells
         except UnrecognizedCell:
             msg = "Circuit {} received an unrecognized cell."
             logging.debug(msg.format(self.circuit_id))
             return
+        finally:
+            # the encrypted cell isn't needed once it's been decrypted
+            pool.release(cell)
+
+        cell = dec
 
         cmd = cell.rheader.cmd
         handler = Circuit._response_table[cmd].__get__(self, type(self))
         handler(cell, origin)
 
+    def _recvRelayCells(self, cells):
+        '''Called when this circuit has a burst of RELAY cells from the
+        network to process.
+
+        Decrypt all of *cells* in one batch, then handle each decrypted cell
+        in order, just as _recvRelayCell() would.
+
+        .. note:: oppy just drops any unrecognized cells.
+
+        :param list cells: RELAY cells received from the network
+        '''
+        try:
+            results = crypto.decryptCellsUntilRecognized(cells,
+                                                         self._crypt_path)
+        finally:
+            # the encrypted cells aren't needed once they've been decrypted
+            for cell in cells:
+                pool.release(cell)
+        self._dispatchDecrypted(results)
+
+    def _recvRelayCellsInWorker(self, cells):
+        '''Decrypt a burst of RELAY cells in a worker thread.
+
+        :param list cells: RELAY cells received from the network
+        :returns: **twisted.internet.defer.Deferred** that fires once the
+            decrypted cells have been handled
+        '''
+        data = ''.join(cell.getPayload() for cell in cells)
+        d = self._inbound_crypto.submit(crypto.decryptPayloadsUntilRecognized,
+                                        data, len(cells), self._crypt_path)
+        d.addCallback(self._handleDecrypted, cells)
+        return d
+
+    def _handleDecrypted(self, results, cells):
+        '''Build and handle the cells decrypted by a worker thread, in
+        order, just as _recvRelayCells() would.
+
+        :param list results: output of
+            :func:`oppy.crypto.util.decryptPayloadsUntilRecognized`
+        :param list cells: the encrypted cells that were decrypted
+        '''
+        try:
+            decrypted = crypto.parseDecryptedPayloads(cells, results)
+        finally:
+            for cell in cells:
+                pool.release(cell)
+        self._dispatchDecrypted(decrypted)
+
+    def _dispatchDecrypted(self, results):
+        '''Pass each decrypted cell in *results* to its handler, in order.
+
+        .. note:: oppy just drops any unrecognized cells.
+
+        :param list results: (cell, origin) tuples, or **None** for each
+            cell that wasn't recognized
+        '''
+        for result in results:
+            # drop unrecognized cells
+            if result is None:
+                msg = "Circuit {} received an unrecognized cell."
+                logging.debug(msg.format(self.circuit_id))
+                continue
+            cell, origin = result
+            cmd = cell.rheader.cmd
+            handler = Circuit._response_table[cmd].__get__(self, type(self))
+            handler(cell, origin)
+
     def writeCell(self, cell):
         '''Write a cell to this circuit's connection.
 
@@ -417,6 +667,8 @@ class Circuit(object):
             msg  = 'Got a RELAY_DATA cell for non-existent stream {} '
             msg += 'on circuit {}. Dropping cell.'
             logging.debug(msg.format(sid, self.circuit_id))
+        finally:
+            pool.release(cell)
 
     @dispatch(_response_table, RELAY_END_CMD)
     def _processRelayEnd(self, cell, origin):
@@ -616,26 +868,37 @@ class Circuit(object):
             stream.closeFromCircuit()
 
     def unregisterStream(self, stream):
-        '''Unregister *stream* from this circuit.
+        '''Unregister *stream* from this circuit once any data it already
+        wrote to this circuit has been sent.
 
-        Remove the stream from this circuit's stream map and send a
-        RelayEndCell. If the number of streams on this circuit drops to
-        zero, check with the circuit manager to see if this circuit should
-        be destroyed. If so, tear down the circuit.
+        Put an end-of-stream marker on this circuit's write_queue, behind
+        the stream's data; see _endStream().
 
         :param oppy.stream.stream.Stream stream: stream to unregister
         '''
+        self._write_queue.put((None, stream.stream_id))
+
+    def _endStream(self, stream_id):
+        '''Remove stream *stream_id* from this circuit's stream map and send
+        a RelayEndCell.
+
+        If the number of streams on this circuit drops to zero, check with
+        the circuit manager to see if this circuit should be destroyed. If
+        so, tear down the circuit.
+
+        :param int stream_id: id of the stream to unregister
+        '''
         from oppy.shared import circuit_manager
 
         try:
-            del self._stream_map[stream.stream_id]
-            cell = RelayEndCell.make(self.circuit_id, stream.stream_id)
-            enc = crypto.encryptCellToTarget(cell, self._crypt_path)
-            self.writeCell(enc)
+            del self._stream_map[stream_id]
+            cell = RelayEndCell.make(self.link_circuit_id, stream_id,
+                                     link_version=self.link_version)
+            self._sendRelayCells([cell])
         except KeyError:
             msg = "Circuit {} notified that stream {} was closed, but "
             msg += "circuit has no reference to this stream."
-            logging.debug(msg.format(self.circuit_id, stream.stream_id))
+            logging.debug(msg.format(self.circuit_id, stream_id))
 
         if len(self._stream_map) == 0:
             if circuit_manager.shouldDestroyCircuit(self) is True:
@@ -653,10 +916,10 @@ class Circuit(object):
         :param oppy.stream.stream.Stream stream: stream on behalf of which
             we're sending a RelayBeginCell
         '''
-        cell = RelayBeginCell.make(self.circuit_id, stream.stream_id,
-                                   stream.request)
-        enc = crypto.encryptCellToTarget(cell, self._crypt_path)
-        self.writeCell(enc)
+        cell = RelayBeginCell.make(self.link_circuit_id, stream.stream_id,
+                                   stream.request,
+                                   link_version=self.link_version)
+        self._sendRelayCells([cell])
 
     def registerStream(self, stream):
         '''Register the new *stream* on this circuit.
@@ -668,6 +931,8 @@ class Circuit(object):
         self._stream_map[self._stream_ctr] = stream
         stream.stream_id = self._stream_ctr
         self._stream_ctr += 1
+        if self._write_paused is True:
+            stream.pauseWriting()
 
     def sendStreamSendMe(self, stream_id):
         '''Send a stream-level RelaySendMe cell with its stream_id equal to
@@ -678,9 +943,9 @@ class Circuit(object):
 
         :param int stream_id: stream_id to use in the RelaySendMeCell
         '''
-        cell = RelaySendMeCell.make(self.circuit_id, stream_id=stream_id)
-        enc = crypto.encryptCellToTarget(cell, self._crypt_path)
-        self.writeCell(enc)
+        cell = RelaySendMeCell.make(self.link_circuit_id, stream_id=stream_id,
+                                    link_version=self.link_version)
+        self._sendRelayCells([cell], release=True)
 
     ##################################################################
     #################### FLOW CONTROL METHODS ########################
@@ -695,24 +960,30 @@ class Circuit(object):
         '''
         self._deliver_window -= 1
         if self._deliver_window <= SENDME_THRESHOLD:
-            cell = RelaySendMeCell.make(self.circuit_id)
-            enc = crypto.encryptCellToTarget(cell, self._crypt_path)
-            self.writeCell(enc)
+            cell = RelaySendMeCell.make(self.link_circuit_id,
+                                        link_version=self.link_version)
+            self._sendRelayCells([cell], release=True)
             self._deliver_window += WINDOW_SIZE
 
-    def _decPackageWindow(self):
-        '''Decrement this circuit's package window.
+    def _decPackageWindow(self, count=1):
+        '''Decrement this circuit's package window by *count* cells.
 
         If the package window is above zero, listen for more incoming local
-        data. Otherwise, enter a state CState.BUFFERING. In this buffering
-        state, this circuit will not accept any new streams and will not
-        write any data to its connection. It will leave it's buffering state
-        and become open again when it receives enough RelaySendMeCell's to
-        move its package window above zero again.
+        data (unless this circuit's connection has paused it). Otherwise,
+        enter a state CState.BUFFERING. In this buffering state, this
+        circuit will not accept any new streams and will not write any data
+        to its connection. It will leave it's buffering state and become
+        open again when it receives enough RelaySendMeCell's to move its
+        package window above zero again.
+
+        :param int count: number of cells just packaged
         '''
-        self._package_window -= 1
+        self._package_window -= count
         if self._package_window > 0:
-            self._pollWriteQueue()
+            if self._write_paused is False:
+                self._pollWriteQueue()
+            else:
+                self._write_deferred = None
         else:
             self._state = CState.BUFFERING
             self._write_deferred = None
@@ -730,9 +1001,33 @@ class Circuit(object):
         # if we're buffering, we can start writing again
         if self._state == CState.BUFFERING and self._package_window > 0:
             self._state = CState.OPEN
-            if self._write_deferred is None:
+            if self._write_deferred is None and self._write_paused is False:
                 self._pollWriteQueue()
 
+    def pauseWriting(self):
+        '''Stop taking data off this circuit's write_queue, and pause every
+        stream on this circuit.
+
+        Called by this circuit's connection when its transport's send
+        buffer is full. Control cells are still sent.
+        '''
+        self._write_paused = True
+        for stream in self._stream_map.values():
+            stream.pauseWriting()
+
+    def resumeWriting(self):
+        '''Start taking data off this circuit's write_queue again, and
+        resume every stream on this circuit.
+
+        Called by this circuit's connection once its transport's send
+        buffer has drained.
+        '''
+        self._write_paused = False
+        if self._state == CState.OPEN and self._write_deferred is None:
+            self._pollWriteQueue()
+        for stream in self._stream_map.values():
+            stream.resumeWriting()
+
     ##################################################################
     ################### CIRCUIT TEARDOWN METHODS #####################
     ##################################################################
@@ -775,7 +1070,7 @@ class Circuit(object):
         logging.debug(msg.format(self.circuit_id))
         self._sendDestroyCell()
         if self.connection is not None:
-            self.connection.circuitDestroyed(self.circuit_id)
+            self.connection.circuitDestroyed(self.link_circuit_id)
 
     def destroyCircuitFromConnection(self):
         '''Called when a connection closes this circuit (usually because
@@ -792,12 +1087,28 @@ class Circuit(object):
     def _sendDestroyCell(self):
         '''Send a destroy cell.
 
+        If this circuit encrypts in a worker thread, the destroy cell is
+        written once every cell already handed to the worker has been, and
+        the worker's queue is stopped after that.
+
         .. note:: reason NONE is always used when sending forward destroy
             cells to avoid leaking version information.
         '''
-        if self.connection is not None:
-            cell = DestroyCell.make(self.circuit_id)
+        if self.connection is None:
+            return
+        cell = DestroyCell.make(self.link_circuit_id,
+                                link_version=self.link_version)
+        if self._outbound_crypto is None:
             self.connection.writeCell(cell)
+            return
+        if self._destroy_queued is True:
+            return
+        self._destroy_queued = True
+        connection = self.connection
+        queue = self._outbound_crypto
+        d = queue.submit(lambda: None)
+        d.addCallback(lambda _: connection.writeCell(cell))
+        d.addBoth(lambda _: queue.stop())
 
     def _closeCircuit(self):
         '''Close this circuit.
@@ -808,7 +1119,16 @@ class Circuit(object):
         '''
         from oppy.shared import circuit_manager
 
+        # drop any handshake still deriving keys for this circuit
+        self._handshake = None
+        # and any crypto still queued for worker threads, unless a DESTROY
+        # is waiting for the outbound jobs (it stops that queue itself)
+        if self._outbound_crypto is not None and \
+                self._destroy_queued is False:
+            self._outbound_crypto.stop()
+        if self._inbound_crypto is not None:
+            self._inbound_crypto.stop()
         self._closeAllStreams()
         circuit_manager.circuitDestroyed(self)
         if self.connection is not None:
-            self.connection.circuitDestroyed(self.circuit_id)
+            self.connection.circuitDestroyed(self.link_circuit_id)
@@ -12,6 +12,12 @@
     NTorFSM's also derive key material and add RelayCrypto objects to the
     associated circuit's *crypt_path*.
 
+    If threaded derivation is enabled (see
+    :func:`oppy.crypto.ntorhandshake.enableThreadedDerivation`), key
+    material is derived in a worker thread and recvCell() returns a Deferred
+    that fires with the response instead. Until it fires, the NTorFSM is in
+    state DERIVING and any cell it receives fails the handshake.
+
 '''
 import logging
 
@@ -23,7 +29,6 @@ from oppy.cell.definitions import (
 )
 from oppy.cell.fixedlen import Create2Cell
 from oppy.cell.relay import RelayExtend2Cell
-from oppy.cell.util import LinkSpecifier
 from oppy.circuit.handshake.exceptions import (
     BadHandshakeState,
     HandshakeFailed,
@@ -31,8 +36,12 @@ from oppy.circuit.handshake.exceptions import (
     UnexpectedCell,
 )
 from oppy.crypto.exceptions import UnrecognizedCell
-from oppy.crypto.ntorhandshake import NTorHandshake
+from oppy.crypto.ntorhandshake import (
+    NTorHandshake,
+    isThreadedDerivationEnabled,
+)
 import oppy.crypto.util as crypto
+from oppy.netstatus.handshakematerial import getHandshakeMaterial
 from oppy.util.tools import dispatch, enum
 
 
@@ -42,6 +51,7 @@ State = enum(
     EXPECT_FIRST_EXTENDED2=2,
     EXPECT_SECOND_EXTENDED2=3,
     DONE=4,
+    DERIVING=5,
 )
 
 
@@ -52,18 +62,22 @@ class NTorFSM(object):
 
     _response_map = {}
 
-    def __init__(self, circuit_id, path, crypt_path):
+    def __init__(self, circuit_id, path, crypt_path, link_version=3):
         '''
-        :param int circuit_id: id of the circuit for this ntor fsm
+        :param int circuit_id: id the circuit for this ntor fsm uses on its
+            connection
         :param oppy.path.path.Path path: path for this circuit
         :param list, oppy.crypto.relaycrypto.RelayCrypto crypt_path: a list
             (to be filled in by this ntor fsm) of RelayCrypto objects
+        :param int link_version: Link Protocol version in use on the
+            circuit's connection
         '''
         assert len(crypt_path) == 0
         msg = "Creating NTorFSM for circuit {}."
         logging.debug(msg.format(circuit_id))
 
         self.circuit_id = circuit_id
+        self.link_version = link_version
         self._path = path
         self._crypt_path = crypt_path
 
@@ -82,7 +96,9 @@ class NTorFSM(object):
 
         :returns: **cell, None** may return either the next cell to send
             to step through handshakes with relays on this path or None if
-            no response is required
+            no response is required. If threaded derivation is enabled,
+            returns a **twisted.internet.defer.Deferred** that fires with
+            the cell (or None) instead.
         '''
         try:
             fn = NTorFSM._response_map[self._state].__get__(self, type(self))
@@ -101,7 +117,8 @@ class NTorFSM(object):
         :returns: **oppy.cell.fixedlen.Create2Cell**
         '''
         onion_skin = self._ntor_handshakes[0].createOnionSkin()
-        cell = Create2Cell.make(self.circuit_id, hdata=onion_skin)
+        cell = Create2Cell.make(self.circuit_id, hdata=onion_skin,
+                                link_version=self.link_version)
         self._state = State.EXPECT_CREATED2
 
         return cell
@@ -141,17 +158,27 @@ class NTorFSM(object):
         '''
         NTorFSM._verifyCellCmd(cell.header.cmd, CREATED2_CMD)
 
-        entry_crypto = self._ntor_handshakes[0].deriveRelayCrypto(cell)
+        return self._deriveThen(0, cell, self._extendToMiddle)
+
+    def _extendToMiddle(self, entry_crypto):
+        '''Add the entry node's RelayCrypto to crypt_path and build the
+        Extend2 cell for the middle node.
+
+        :param oppy.crypto.relaycrypto.RelayCrypto entry_crypto: crypto
+            derived from the entry node's Created2 cell
+        :returns: **oppy.cell.fixedlen.EncryptedCell**
+        '''
         self._crypt_path.append(entry_crypto)
 
         relay = self._path.middle
-        lspecs = [LinkSpecifier(relay), LinkSpecifier(relay, legacy=True)]
+        lspecs = list(getHandshakeMaterial(relay).link_specifiers)
         hdata = self._ntor_handshakes[1].createOnionSkin()
 
         cell = RelayExtend2Cell.make(self.circuit_id,
                                      nspec=len(lspecs),
                                      lspecs=lspecs,
-                                     hdata=hdata)
+                                     hdata=hdata,
+                                     link_version=self.link_version)
 
         response = crypto.encryptCellToTarget(cell, self._crypt_path,
                                               target=0, early=True)
@@ -189,18 +216,28 @@ class NTorFSM(object):
         NTorFSM._verifyCellCmd(rcmd, RELAY_EXTENDED2_CMD)
 
         # Generate crypto material from the received cell.
-        middle_crypto = self._ntor_handshakes[1].deriveRelayCrypto(cell)
+        return self._deriveThen(1, cell, self._extendToExit)
+
+    def _extendToExit(self, middle_crypto):
+        '''Add the middle node's RelayCrypto to crypt_path and build the
+        Extend2 cell for the exit node.
+
+        :param oppy.crypto.relaycrypto.RelayCrypto middle_crypto: crypto
+            derived from the middle node's Extended2 cell
+        :returns: **oppy.cell.fixedlen.EncryptedCell**
+        '''
         self._crypt_path.append(middle_crypto)
 
         relay = self._path.exit
-        lspecs = [LinkSpecifier(relay), LinkSpecifier(relay, legacy=True)]
+        lspecs = list(getHandshakeMaterial(relay).link_specifiers)
 
         hdata = self._ntor_handshakes[2].createOnionSkin()
 
         cell = RelayExtend2Cell.make(self.circuit_id,
                                      nspec=len(lspecs),
                                      lspecs=lspecs,
-                                     hdata=hdata)
+                                     hdata=hdata,
+                                     link_version=self.link_version)
         response = crypto.encryptCellToTarget(cell, self._crypt_path,
                                               target=1, early=True)
 
@@ -237,12 +274,55 @@ class NTorFSM(object):
         NTorFSM._verifyCellCmd(rcmd, RELAY_EXTENDED2_CMD)
 
         # Generate crypto material from the received cell.
-        exit_crypto = self._ntor_handshakes[2].deriveRelayCrypto(cell)
+        return self._deriveThen(2, cell, self._finish)
+
+    def _finish(self, exit_crypto):
+        '''Add the exit node's RelayCrypto to crypt_path and finish the
+        handshake.
+
+        :param oppy.crypto.relaycrypto.RelayCrypto exit_crypto: crypto
+            derived from the exit node's Extended2 cell
+        '''
         self._crypt_path.append(exit_crypto)
 
         self._state = State.DONE
         return None
 
+    @dispatch(_response_map, State.DERIVING)
+    def _processWhileDeriving(self, cell):
+        '''Called when this ntor fsm receives a cell while it's still
+        deriving keys from the previous one.
+
+        Relays don't send anything until we've answered, so any cell here
+        fails the handshake.
+
+        :param cell cell: the received cell
+        '''
+        NTorFSM._verifyCellCmd(cell.header.cmd, None)
+
+    def _deriveThen(self, hop, cell, next_step):
+        '''Derive the RelayCrypto for *hop* from *cell* and pass it to
+        *next_step*.
+
+        If threaded derivation is enabled, derive in a worker thread and
+        return a Deferred that fires with *next_step*'s result. Otherwise,
+        derive right away and return *next_step*'s result.
+
+        :param int hop: index of the relay in the path *cell* came from
+        :param cell cell: Created2 or Extended2 cell to derive keys from
+        :param next_step: function taking the derived RelayCrypto and
+            returning the response cell (or None)
+        :returns: **cell, None, twisted.internet.defer.Deferred**
+        '''
+        handshake = self._ntor_handshakes[hop]
+        if not isThreadedDerivationEnabled():
+            return next_step(handshake.deriveRelayCrypto(cell))
+
+        self._state = State.DERIVING
+        d = handshake.deriveRelayCryptoInThread(cell)
+        d.addCallback(next_step)
+        return d
+
     def isDone(self):
         '''Return **True** iff this ntor fsm's state is State.DONE
 
@@ -0,0 +1,239 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    An optional per-connection circuit scheduler, in the style of tor's
+    EWMA circuitmux.
+
+    Without a scheduler, a Connection writes cells in whatever order its
+    circuits happen to hand them over, so a circuit uploading a lot of data
+    can fill the TLS send buffer and leave an interactive circuit's cells
+    waiting behind it. When the scheduler is enabled (see
+    enableScheduler()), each open Connection gets an EWMACircuitMux
+    instead:
+
+        - Cells are queued per circuit rather than written right away.
+        - Each circuit has an exponentially weighted moving average of the
+          number of cells it has sent recently, which halves every
+          *halflife* seconds.
+        - Whenever the connection's transport can take more data, the
+          circuit with the lowest average sends its next cell, so quiet
+          circuits' cells go ahead of busy ones.
+
+    The mux is a push producer, paused and resumed along with its
+    Connection, so it stops writing as soon as the transport's send buffer
+    fills up and starts again once it has drained. Queued cells wait in the
+    mux, where the scheduler can still reorder them, instead of in the
+    transport's buffer, where it can't.
+
+    A mux can also be given a limit on how many bytes it may write at a
+    time, e.g. by KIST (see :mod:`oppy.connection.kist`). Cells past the
+    limit stay queued, and the mux tries again after the limit's
+    *run_interval*.
+
+    Cells of any one circuit are always written in order. The scheduler is
+    off by default.
+
+'''
+from collections import deque
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IPushProducer
+
+
+# seconds for a circuit's cell count average to decay by half (tor's
+# CircuitPriorityHalflife default)
+DEFAULT_HALFLIFE = 30.0
+
+_halflife = None
+
+
+class _CircuitQueue(object):
+    '''Cells waiting to be sent by one circuit, and its cell count
+    average.'''
+
+    __slots__ = ('cells', 'ewma', 'last_update', 'removed')
+
+    def __init__(self, now):
+        self.cells = deque()
+        self.ewma = 0.0
+        self.last_update = now
+        # circuit is gone; forget it once its last cell is sent
+        self.removed = False
+
+
+@implementer(IPushProducer)
+class EWMACircuitMux(object):
+    '''Schedules the cells of every circuit on one connection.'''
+
+    def __init__(self, send, halflife=DEFAULT_HALFLIFE, limit=None,
+                 callLater=None, seconds=None):
+        '''
+        :param send: function that writes a single cell to the transport
+        :param float halflife: seconds for a circuit's cell count average
+            to decay by half
+        :param limit: object whose writableBytes() returns how many bytes
+            may be written now (or **None** for no limit) and whose
+            *run_interval* is how long to wait before trying again once
+            they have been, such as a
+            :class:`~oppy.connection.kist.SocketLimit`. **None** writes
+            whenever the transport isn't paused.
+        :param callLater: function used to schedule sending, with the same
+            signature as reactor.callLater(). Defaults to the global
+            reactor's.
+        :param seconds: function returning the current time in seconds.
+            Defaults to the global reactor's.
+        '''
+        if callLater is None or seconds is None:
+            from twisted.internet import reactor
+            callLater = callLater or reactor.callLater
+            seconds = seconds or reactor.seconds
+        self.halflife = halflife
+        self._limit = limit
+        self._send = send
+        self._callLater = callLater
+        self._seconds = seconds
+        # circuit ID -> _CircuitQueue
+        self._queues = {}
+        # circuit IDs with cells waiting
+        self._active = set()
+        self._paused = False
+        self._stopped = False
+        self._pending = None
+
+    def writeCell(self, cell):
+        '''Queue *cell* on its circuit's queue; it's sent once the scheduler
+        picks that circuit.
+
+        :param cell cell: cell to write
+        '''
+        if self._stopped:
+            return
+        circ_id = cell.header.circ_id
+        queue = self._queues.get(circ_id)
+        if queue is None:
+            queue = _CircuitQueue(self._seconds())
+            self._queues[circ_id] = queue
+        queue.cells.append(cell)
+        self._active.add(circ_id)
+        if self._paused is False and self._pending is None:
+            self._pending = self._callLater(0, self.flush)
+
+    def flush(self):
+        '''Send queued cells, quietest circuit first, until every queue is
+        empty, the transport asks us to pause, or we reach our limit.'''
+        self._pending = None
+        if self._limit is None:
+            budget = None
+        else:
+            budget = self._limit.writableBytes()
+        now = self._seconds()
+        while self._active and self._paused is False:
+            if budget is not None and budget <= 0:
+                self._pending = self._callLater(self._limit.run_interval,
+                                                self.flush)
+                return
+            circ_id = self._pickCircuit(now)
+            queue = self._queues[circ_id]
+            cell = queue.cells.popleft()
+            queue.ewma += 1
+            if not queue.cells:
+                self._active.discard(circ_id)
+                if queue.removed is True:
+                    del self._queues[circ_id]
+            if budget is not None:
+                budget -= len(cell)
+            self._send(cell)
+
+    def _pickCircuit(self, now):
+        '''Bring the cell count average of every circuit with waiting cells
+        up to date and return the ID of the lowest one.'''
+        best = None
+        best_ewma = None
+        for circ_id in self._active:
+            queue = self._queues[circ_id]
+            if queue.last_update != now:
+                queue.ewma *= 0.5 ** ((now - queue.last_update) /
+                                      self.halflife)
+                queue.last_update = now
+            if best is None or queue.ewma < best_ewma:
+                best = circ_id
+                best_ewma = queue.ewma
+        return best
+
+    def removeCircuit(self, circ_id):
+        '''Forget the cell count average of circuit *circ_id*. Cells it
+        already queued are still sent.
+
+        :param int circ_id: link circuit ID of the circuit
+        '''
+        queue = self._queues.get(circ_id)
+        if queue is None:
+            return
+        if queue.cells:
+            queue.removed = True
+        else:
+            del self._queues[circ_id]
+
+    def pauseProducing(self):
+        self._paused = True
+        if self._pending is not None and self._pending.active():
+            self._pending.cancel()
+        self._pending = None
+
+    def resumeProducing(self):
+        if self._stopped:
+            return
+        self._paused = False
+        self.flush()
+
+    def stopProducing(self):
+        '''Drop every queued cell.'''
+        self.pauseProducing()
+        self._stopped = True
+        self._queues.clear()
+        self._active.clear()
+
+    def __len__(self):
+        return sum(len(self._queues[circ_id].cells)
+                   for circ_id in self._active)
+
+
+def enableScheduler(halflife=DEFAULT_HALFLIFE):
+    '''Schedule the circuits of every Connection that opens from now on.
+
+    :param float halflife: seconds for a circuit's cell count average to
+        decay by half
+    '''
+    global _halflife
+    _halflife = halflife
+
+
+def disableScheduler():
+    '''Write cells in arrival order on Connections that open from now
+    on.'''
+    global _halflife
+    _halflife = None
+
+
+def isSchedulerEnabled():
+    '''
+    :returns: **bool** whether new Connections schedule their circuits
+    '''
+    return _halflife is not None
+
+
+def makeMux(send, limit=None):
+    '''
+    :param send: function that writes a single cell to the transport
+    :param limit: limit on how many bytes may be written at a time, or
+        **None** (see :class:`~oppy.connection.circuitmux.EWMACircuitMux`)
+    :returns: :class:`~oppy.connection.circuitmux.EWMACircuitMux` for a
+        newly opened connection, or **None** if the scheduler isn't enabled
+    '''
+    if _halflife is None:
+        return None
+    return EWMACircuitMux(send, _halflife, limit)
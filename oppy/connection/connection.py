@@ -8,28 +8,49 @@
     objects have a few important jobs:
 
         - Do the initial handshake to authenticate the entry node and negotiate
-          a Link Protocl version (currently oppy only supports Link Protocol
-          Version 3)
+          a Link Protocol version (oppy supports Link Protocol Versions 3
+          and 4)
+        - Pick the circuit IDs circuits use on this connection (4-byte IDs
+          with Link Protocol 4, so many more circuits can share one
+          connection)
         - Extract cells from incoming data streams and pass them to the
           appropriate circuit (based on circuit ID)
         - Write cells from circuits to entry nodes
         - Notify all associated circuits when the connection goes down
+        - Tell circuits to stop writing while the TLS transport's send
+          buffer is full, and to start again once it has drained
+
+    A Connection registers itself as a streaming producer on its
+    transport, so the transport pauses it once too much data is waiting to
+    be sent. A paused Connection pauses each of its circuits, which stop
+    pulling data off their write queues and pause their streams in turn
+    (see :meth:`oppy.circuit.circuit.Circuit.pauseWriting`). That way a
+    slow entry relay holds up local applications instead of making oppy
+    buffer everything they send.
 
 '''
+import bisect
 import logging
 
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol
 
 from oppy.cell.cell import Cell
-from oppy.cell.definitions import PADDING_CMD_IDS
-from oppy.cell.exceptions import NotEnoughBytes
+from oppy.cell.definitions import FIXED_LEN_V4_LEN, PADDING_CMD_IDS
 
+from oppy.connection import circuitmux, kist, writecoalescer
+from oppy.connection.definitions import MAX_V3_CIRC_ID, V4_CIRC_ID_MSB
+from oppy.connection.exceptions import RecvBufferOverflow
 from oppy.connection.handshake.v3 import V3FSM
 from oppy.connection.handshake.exceptions import (
     BadHandshakeState,
     HandshakeFailed,
     UnexpectedCell,
 )
+from oppy.connection.recvbuffer import RecvBuffer
 from oppy.util.tools import enum
 
 
@@ -39,6 +60,7 @@ ConnState = enum(
 )
 
 
+@implementer(IPushProducer)
 class Connection(Protocol):
     '''A TLS connection to an entry node.'''
 
@@ -50,11 +72,25 @@ class Connection(Protocol):
         logging.debug('Creating connection to {0}'.format(relay.address))
         # map all circuits using this connections
         self._circuit_map = {}
-        self._buffer = ''
+        self._buffer = RecvBuffer()
         self._relay = relay
         self._handshake = None
         self._state = ConnState.PENDING
         self._cell_queue = []
+        # deferreds waiting for the link handshake to finish
+        self._open_deferreds = []
+        # Link Protocol version, updated once one has been negotiated
+        self.link_version = 3
+        # reused to serialize every outgoing cell on this connection
+        self._out_buffer = bytearray(FIXED_LEN_V4_LEN)
+        # batches outgoing cells once we're open, if coalescing is enabled
+        self._coalescer = None
+        # schedules circuits' cells once we're open, if enabled
+        self._mux = None
+        # True while our transport has asked us to stop writing
+        self._paused = False
+        # link circuit ID of the circuit to resume first next time
+        self._resume_from = 0
 
     def writeCell(self, cell):
         '''Write a cell to this connections transport.
@@ -62,42 +98,87 @@ class Connection(Protocol):
         If this connection is not yet open, append to the cell_queue to be
         written when the connection opens up.
 
+        Cells are packed into this connection's reusable outbound buffer,
+        so the only new string built per cell is the one handed to the
+        transport. If write coalescing is enabled (see
+        :mod:`oppy.connection.writecoalescer`), cells are packed into the
+        coalescer's buffer instead and written in batches. If the circuit
+        scheduler is enabled (see :mod:`oppy.connection.circuitmux`), cells
+        are queued on the scheduler first, which decides which circuit's
+        cell goes next and, with KIST (see :mod:`oppy.connection.kist`),
+        how many cells the socket is given at a time.
+
         :param cell cell: cell to write
         '''
         if self._state == ConnState.OPEN:
-            self.transport.write(cell.getBytes())
+            if self._mux is not None:
+                self._mux.writeCell(cell)
+            else:
+                self._sendCell(cell)
         else:
             self._cell_queue.append(cell)
 
+    def _sendCell(self, cell):
+        '''Write *cell* to this connection's transport (or its coalescer)
+        right away.
+
+        :param cell cell: cell to write
+        '''
+        if self._coalescer is not None:
+            self._coalescer.writeCell(cell)
+            return
+        if len(cell) > len(self._out_buffer):
+            self._out_buffer = bytearray(len(cell))
+        n = cell.writeInto(self._out_buffer)
+        self.transport.write(str(buffer(self._out_buffer, 0, n)))
+
     def dataReceived(self, data):
         '''We received data from the remote connection.
 
         Extract cells from the data stream and send them along to be
         processed.
 
+        Incoming data is appended to this connection's receive buffer and
+        cells are parsed directly out of a view of that buffer, so bytes
+        are only copied once on their way to the cell parser. Once the
+        connection is open, every complete cell in the buffer is framed in
+        a single pass. If the buffer grows past its high-water mark, close
+        the connection.
+
         :param str data: data received from remote end
         '''
-        self._buffer += data
+        try:
+            self._buffer.append(data)
+        except RecvBufferOverflow as e:
+            logging.warning(e)
+            self.closeConnection()
+            self._buffer.clear()
+            return
 
-        while Cell.enoughDataForCell(self._buffer):
+        while len(self._buffer) > 0:
+            view = self._buffer.view()
+            # during the handshake, each cell may change how the next one
+            # should be handled, so only pull one cell out at a time
+            max_cells = None if self._state == ConnState.OPEN else 1
             try:
-                cell = Cell.parse(self._buffer, encrypted=True)
-                self._deliverCell(cell)
-                self._buffer = self._buffer[len(cell):]
-            # this shouldn't happen and if it does, it's probably a bug
-            except NotEnoughBytes as e:
-                logging.debug(str(e))
-                break
+                cells, consumed = Cell.parseMany(
+                    view, link_version=self.link_version, encrypted=True,
+                    max_cells=max_cells)
+                if consumed == 0:
+                    break
+                self._buffer.consume(consumed)
+                for cell in cells:
+                    self._deliverCell(cell)
             # XXX remove len(unimplemented cell bytes) from buffer
             except NotImplementedError:
                 logging.debug("Received a cell we can't handle yet.")
                 logging.debug('buffer contents:\n')
-                logging.debug([ord(i) for i in self._buffer])
+                logging.debug([ord(i) for i in view[:]])
                 raise
             except (BadHandshakeState, HandshakeFailed, UnexpectedCell) as e:
                 logging.warning(e)
                 self.closeConnection()
-                self._buffer = ''
+                self._buffer.clear()
                 break
 
     def _deliverCell(self, cell):
@@ -153,17 +234,27 @@ class Connection(Protocol):
             self.closeConnection()
             return
 
+        # every following cell uses the negotiated Link Protocol version
+        self.link_version = self._handshake.link_version
+
         # send a handshake response if required
         if response is not None:
             self.transport.write(response.getBytes())
         # empty our queue if we're finished with the handshake
         if self._handshake.isDone():
             self._state = ConnState.OPEN
-            msg = 'Completed handshake on connection: {0}'
-            msg = msg.format(self._relay.address)
+            msg = 'Completed handshake on connection: {0}, link version {1}'
+            msg = msg.format(self._relay.address, self.link_version)
             logging.debug(msg)
+            self._coalescer = writecoalescer.makeCoalescer(
+                self.transport.write)
+            self._mux = circuitmux.makeMux(
+                self._sendCell, kist.makeSocketLimit(self.transport))
+            if self._mux is not None and self._paused is True:
+                self._mux.pauseProducing()
             self._emptyQueue()
             self._handshake = None
+            self._fireOpenDeferreds()
 
     def _emptyQueue(self):
         '''Write any cells in this connection's queue to this connection's
@@ -178,24 +269,121 @@ class Connection(Protocol):
         handshake.
         '''
         logging.debug('Connection made to {0}.'.format(self._relay.address))
+        self.transport.registerProducer(self, True)
         self._handshake = V3FSM(self.transport)
         cell = self._handshake.getInitiatingCell()
         self.transport.write(cell.getBytes())
 
+    def pauseProducing(self):
+        '''Our transport's send buffer is full; stop every circuit on this
+        connection from writing until it has drained.
+        '''
+        if self._paused is True:
+            return
+        self._paused = True
+        if self._mux is not None:
+            self._mux.pauseProducing()
+        for circuit in self._circuit_map.values():
+            circuit.pauseWriting()
+
+    def resumeProducing(self):
+        '''Our transport's send buffer has drained; let circuits write
+        again.
+        '''
+        if self._paused is False:
+            return
+        self._paused = False
+        if self._mux is not None:
+            self._mux.resumeProducing()
+        # resume circuits round-robin, starting where the last resume left
+        # off, so the first ones can't keep the rest from ever writing
+        circ_ids = sorted(self._circuit_map)
+        start = bisect.bisect_left(circ_ids, self._resume_from)
+        circ_ids = circ_ids[start:] + circ_ids[:start]
+        if circ_ids:
+            self._resume_from = circ_ids[0] + 1
+        for circ_id in circ_ids:
+            # writing may have filled the send buffer up again
+            if self._paused is True:
+                self._resume_from = circ_id
+                break
+            circuit = self._circuit_map.get(circ_id)
+            if circuit is not None:
+                circuit.resumeWriting()
+
+    def stopProducing(self):
+        '''Our transport is going away; drop any cells still waiting to be
+        scheduled.
+        '''
+        if self._mux is not None:
+            self._mux.stopProducing()
+
+    def isPaused(self):
+        '''
+        :returns: **bool** whether circuits on this connection should hold
+            off writing
+        '''
+        return self._paused
+
+    def whenOpen(self):
+        '''Return a deferred that fires with this connection once its link
+        handshake has finished, or fails if the connection closes first.
+
+        :returns: **twisted.internet.defer.Deferred**
+        '''
+        if self._state == ConnState.OPEN:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._open_deferreds.append(d)
+        return d
+
+    def _fireOpenDeferreds(self):
+        deferreds, self._open_deferreds = self._open_deferreds, []
+        for d in deferreds:
+            d.callback(self)
+
+    def _failOpenDeferreds(self, reason):
+        deferreds, self._open_deferreds = self._open_deferreds, []
+        for d in deferreds:
+            d.errback(reason)
+
+    def linkCircuitID(self, circuit_id):
+        '''Return the circuit ID a circuit with id *circuit_id* uses in the
+        cells it sends and receives on this connection.
+
+        With Link Protocol 4, circuit IDs are 4 bytes long and have their
+        most significant bit set, since we opened the connection. With Link
+        Protocol 3, circuit IDs are used as they are but must fit in 2
+        bytes, so raise a ValueError if *circuit_id* is too large.
+
+        :param int circuit_id: id of the circuit
+        :returns: **int** circuit ID to use on this connection
+        '''
+        if self.link_version >= 4:
+            return circuit_id | V4_CIRC_ID_MSB
+        if circuit_id > MAX_V3_CIRC_ID:
+            msg = "Circuit id {} does not fit in Link Protocol {} cells."
+            raise ValueError(msg.format(circuit_id, self.link_version))
+        return circuit_id
+
     def addNewCircuit(self, circuit):
         '''Add new a new circuit to the circuit map for this connection.
 
-        Raise a ValueError if *circuit.circuit_id* already exists in
-        self._circuit_map - that means something went very wrong.
+        Circuits are mapped by the circuit ID they use on this connection
+        (see linkCircuitID()). Raise a ValueError if
+        *circuit.link_circuit_id* already exists in self._circuit_map - that
+        means something went very wrong.
 
         :param oppy.circuit.circuit.Circuit circuit: circuit to add to this
             connection's circuit map
         '''
-        if circuit.circuit_id in self._circuit_map:
+        if circuit.link_circuit_id in self._circuit_map:
             msg = "Circuit with id {} already exists on connection to {}"
-            msg = msg.format(circuit.circuit_id, self._relay.address)
+            msg = msg.format(circuit.link_circuit_id, self._relay.address)
             raise ValueError(msg)
-        self._circuit_map[circuit.circuit_id] = circuit
+        self._circuit_map[circuit.link_circuit_id] = circuit
+        if self._paused is True:
+            circuit.pauseWriting()
 
     def closeConnection(self):
         '''Close this connection and all associated circuits; notify the
@@ -204,8 +392,15 @@ class Connection(Protocol):
         from oppy.shared import connection_pool
 
         logging.debug("Closing connection to {}.".format(self._relay.address))
+        self._failOpenDeferreds(HandshakeFailed("Connection closed before "
+                                                "the link handshake finished."))
         self._destroyAllCircuits()
         connection_pool.removeConnection(self._relay.fingerprint)
+        # cells still waiting would be thrown away by abortConnection()
+        if self._mux is not None:
+            self._mux.stopProducing()
+        if self._coalescer is not None:
+            self._coalescer.stop()
         self.transport.abortConnection()
 
     def connectionLost(self, reason):
@@ -218,6 +413,11 @@ class Connection(Protocol):
 
         msg = "Connection to {} lost: {}."
         logging.warning(msg.format(self._relay.address, reason))
+        if self._mux is not None:
+            self._mux.stopProducing()
+        if self._coalescer is not None:
+            self._coalescer.stop()
+        self._failOpenDeferreds(reason)
         self._destroyAllCircuits()
         connection_pool.removeConnection(self._relay.fingerprint)
 
@@ -235,7 +435,8 @@ class Connection(Protocol):
         ask the connection pool if this connection should be closed and, if
         so, close this connection.
 
-        :param int circuit_id: id of the circuit that was destroyed
+        :param int circuit_id: link circuit id (see linkCircuitID()) of the
+            circuit that was destroyed
         '''
         from oppy.shared import connection_pool
 
@@ -246,6 +447,8 @@ class Connection(Protocol):
             msg += ", but connection has no reference to circuit {}."
             msg = msg.format(self._relay.address, circuit_id, circuit_id)
             logging.debug(msg)
+        if self._mux is not None:
+            self._mux.removeCircuit(circuit_id)
 
         if len(self._circuit_map) == 0:
             fprint = self._relay.fingerprint
@@ -9,9 +9,19 @@
     requesting circuits and keep track of all the open connections. TLS
     connections to the same entry nodes are shared among circuits.
 
+    When the last circuit on a connection closes, the pool keeps the
+    connection open for *idle_timeout* seconds, so the next circuit
+    through the same entry node doesn't have to do a new TCP, TLS and link
+    handshake. At most *max_idle* connections are kept idle at once; past
+    that, the least recently used idle connection is closed. An idle
+    timeout of 0 closes connections as soon as their last circuit closes.
+    See setIdlePolicy().
+
 '''
 import logging
 
+from collections import OrderedDict
+
 from twisted.internet import defer, endpoints
 from twisted.internet.ssl import ClientContextFactory
 
@@ -21,6 +31,14 @@ from oppy.connection.connection import Connection
 from oppy.connection.definitions import V3_CIPHER_STRING
 
 
+# seconds to keep a connection without circuits open
+DEFAULT_IDLE_TIMEOUT = 180
+# most connections without circuits to keep open at once
+DEFAULT_MAX_IDLE = 8
+
+_idle_policy = (DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_IDLE)
+
+
 class TLSClientContextFactory(ClientContextFactory):
     
     isClient = 1
@@ -36,10 +54,39 @@ class TLSClientContextFactory(ClientContextFactory):
 class ConnectionPool(object):
     '''A pool of TLS connections to entry nodes.'''
 
-    def __init__(self):
+    def __init__(self, idle_timeout=None, max_idle=None, callLater=None):
+        '''
+        :param float idle_timeout: seconds to keep a connection without
+            circuits open. Defaults to the value set with setIdlePolicy().
+        :param int max_idle: most connections without circuits to keep open
+            at once. Defaults to the value set with setIdlePolicy().
+        :param callLater: function used to schedule idle timeouts, with the
+            same signature as reactor.callLater(). Defaults to the global
+            reactor's.
+        '''
         logging.debug('Connection pool created.')
+        if idle_timeout is None:
+            idle_timeout = _idle_policy[0]
+        if max_idle is None:
+            max_idle = _idle_policy[1]
+        if callLater is None:
+            from twisted.internet import reactor
+            callLater = reactor.callLater
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._callLater = callLater
         self._connection_map = {}
         self._pending_map = {}
+        # fingerprint -> idle timeout DelayedCall, least recently used first
+        self._idle = OrderedDict()
+        # getConnection() calls served by an open connection, by a
+        # connection that was already being made, and by a new connection
+        self.hits = 0
+        self.pending_hits = 0
+        self.misses = 0
+        # idle connections closed by their timeout or to make room
+        self.idle_timeouts = 0
+        self.idle_evictions = 0
 
     def getConnection(self, relay):
         '''Return a deferred which will fire (if connection attempt is
@@ -63,6 +110,11 @@ class ConnectionPool(object):
                appropriate callback and errback. If the request is successful,
                callback all pending requests with the open connection when
                it opens; errback all pending requests on failure.
+
+        A connection only counts as open once its link handshake has
+        finished, so circuits always know which Link Protocol version (and
+        so which circuit ID size) a connection uses before they write
+        anything to it.
         
         :param stem.descriptor.server_descriptor.RelayDescriptor relay:
             relay to make a TLS connection to
@@ -75,12 +127,16 @@ class ConnectionPool(object):
         d = defer.Deferred()
         # case 1
         if relay.fingerprint in self._connection_map:
+            self.hits += 1
+            self._cancelIdle(relay.fingerprint)
             d.callback(self._connection_map[relay.fingerprint])
         # case 2
         elif relay.fingerprint in self._pending_map:
+            self.pending_hits += 1
             self._pending_map[relay.fingerprint].append(d)
         # case 3
         else:
+            self.misses += 1
             connection_defer = endpoints.connectProtocol(
                         endpoints.SSL4ClientEndpoint(reactor, relay.address,
                                                      relay.or_port,
@@ -97,12 +153,28 @@ class ConnectionPool(object):
         return d
 
     def _connectionSucceeded(self, result, fingerprint):
+        '''Wait for the link handshake on a newly made connection to finish.
+
+        Called when the TLS connection to the IP of relay with
+        *fingerprint* opens successfully.
+
+        :param oppy.connection.connection.Connection result: the successfully
+            made connection
+        :param str fingerprint: fingerprint of relay we have connected to
+        :returns: **twisted.internet.defer.Deferred** that fires once the
+            link handshake has finished
+        '''
+        d = result.whenOpen()
+        d.addCallback(self._connectionOpened, fingerprint)
+        return d
+
+    def _connectionOpened(self, result, fingerprint):
         '''For every pending request for this connection, callback the request
         deferred with this open connection, then remove this connection
         from the pending map and add to the connection map.
-        
-        Called when the TLS connection to the IP of relay with
-        *fingerprint* opens successfully.
+
+        Called when the link handshake on the connection to relay with
+        *fingerprint* has finished.
 
         :param oppy.connection.connection.Connection result: the successfully
             opened connection
@@ -136,6 +208,7 @@ class ConnectionPool(object):
 
         :param str fingerprint: fingerprint of connection to remove
         '''
+        self._cancelIdle(fingerprint)
         if fingerprint in self._connection_map:
             del self._connection_map[fingerprint]
 
@@ -144,13 +217,89 @@ class ConnectionPool(object):
         TLS connection to relay with *fingerprint*.
 
         Called when the number of circuits on a connection drops to zero.
-
-        .. note:: For now, we always return True. Eventually, we may
-            want to maintain a connection to any guards, even if there are
-            no currently open circuits.
+        Unless idle connections are disabled, keep the connection open
+        until it has been idle for *idle_timeout* seconds, closing the
+        least recently used idle connection if there are now more than
+        *max_idle*.
 
         :param str fingerprint: fingerprint of connection to check
         :returns: **bool** **True** if we think this connection should be
             destroyed
         '''
-        return True
+        if self.idle_timeout <= 0 or self.max_idle <= 0:
+            return True
+        if fingerprint not in self._connection_map:
+            return True
+        self._cancelIdle(fingerprint)
+        self._idle[fingerprint] = self._callLater(self.idle_timeout,
+                                                  self._idleTimedOut,
+                                                  fingerprint)
+        while len(self._idle) > self.max_idle:
+            oldest = next(iter(self._idle))
+            msg = "Closing least recently used idle connection to {}."
+            logging.debug(msg.format(oldest))
+            self.idle_evictions += 1
+            self._closeIdle(oldest)
+        return False
+
+    def _idleTimedOut(self, fingerprint):
+        '''Close the connection to relay with *fingerprint*, which has had
+        no circuits for *idle_timeout* seconds.
+
+        :param str fingerprint: fingerprint of the idle connection
+        '''
+        del self._idle[fingerprint]
+        msg = "Connection to {} idle for {}s, closing."
+        logging.debug(msg.format(fingerprint, self.idle_timeout))
+        self.idle_timeouts += 1
+        self._closeIdle(fingerprint)
+
+    def _closeIdle(self, fingerprint):
+        self._cancelIdle(fingerprint)
+        connection = self._connection_map.pop(fingerprint, None)
+        if connection is not None:
+            connection.closeConnection()
+
+    def _cancelIdle(self, fingerprint):
+        timeout = self._idle.pop(fingerprint, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+
+    def hitRate(self):
+        '''
+        :returns: **float** fraction of getConnection() calls that didn't
+            need a new connection
+        '''
+        total = self.hits + self.pending_hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits + self.pending_hits) / total
+
+    def stats(self):
+        '''
+        :returns: **dict** counters for this pool
+        '''
+        return {
+            'hits': self.hits,
+            'pending_hits': self.pending_hits,
+            'misses': self.misses,
+            'hit_rate': self.hitRate(),
+            'open': len(self._connection_map),
+            'idle': len(self._idle),
+            'idle_timeouts': self.idle_timeouts,
+            'idle_evictions': self.idle_evictions,
+        }
+
+
+def setIdlePolicy(idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                  max_idle=DEFAULT_MAX_IDLE):
+    '''Set how ConnectionPools created from now on treat connections
+    without circuits.
+
+    :param float idle_timeout: seconds to keep a connection without
+        circuits open; 0 closes it right away
+    :param int max_idle: most connections without circuits to keep open at
+        once
+    '''
+    global _idle_policy
+    _idle_policy = (idle_timeout, max_idle)
@@ -10,4 +10,16 @@ V3_KEY_BITS = 1024
 OPENSSL_RSA_KEY_TYPE = 6
 
 KNOWN_LINK_PROTOCOLS = (1, 2, 3, 4)
-SUPPORTED_LINK_PROTOCOLS = (3,)
+SUPPORTED_LINK_PROTOCOLS = (3, 4)
+
+# circuit IDs are 2 bytes long in Link Protocol 3 and 4 bytes long in Link
+# Protocol 4. with 4-byte IDs, the node that opened the connection sets the
+# most significant bit of every circuit ID it picks (tor-spec, Section 5.1.1)
+MAX_V3_CIRC_ID = 0xFFFF
+V4_CIRC_ID_MSB = 0x80000000
+
+# the largest partial cell we might legitimately need to hold is a
+# variable-length cell with a 65535 byte payload, so leave plenty of room
+# for that plus a burst of reads on top of it
+RECV_BUFFER_HIGH_WATER = 2 ** 20
+RECV_BUFFER_COMPACT_THRESHOLD = 2 ** 16
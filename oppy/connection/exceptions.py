@@ -0,0 +1,6 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+
+class RecvBufferOverflow(Exception):
+    pass
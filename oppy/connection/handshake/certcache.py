@@ -0,0 +1,132 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    A cache of certificate pairs from Certs cells that have already passed
+    every check in the V3 link handshake that only depends on the
+    certificates themselves:
+
+        - both certificates are inside their validity periods
+        - the ID certificate's key is a 1024-bit RSA key
+        - the ID certificate signed the Link certificate
+        - the ID certificate is properly self-signed
+
+    Reconnecting to a relay we've already verified (usually a guard)
+    presents the same certificates again, so V3FSM looks the pair up here
+    first and skips the signature and date work on a hit. The check that
+    the Link certificate's key matches the key used for the TLS connection
+    is different for every connection, so it's never cached; entries keep
+    the Link certificate's key around for it.
+
+    Entries are keyed by the SHA-256 hashes of the DER encoded ID and Link
+    certificates. An entry is only valid while both certificates are, and
+    expired entries are dropped when they're looked up. The cache holds at
+    most *max_entries* pairs and evicts the least recently used one when
+    it's full.
+
+'''
+import hashlib
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+
+DEFAULT_MAX_ENTRIES = 128
+
+
+CertCacheEntry = namedtuple('CertCacheEntry', ('link_key',
+                                               'valid_after',
+                                               'valid_until'))
+
+
+def _cacheKey(id_der, link_der):
+    return hashlib.sha256(id_der).digest() + hashlib.sha256(link_der).digest()
+
+
+class CertCache(object):
+    '''A bounded, expiry-aware cache of verified ID and Link certificate
+    pairs.'''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, now=datetime.now):
+        '''
+        :param int max_entries: maximum number of certificate pairs to keep
+        :param now: function returning the current time as a
+            **datetime.datetime**, on the same clock as
+            :func:`oppy.crypto.util.validCertTime`
+        '''
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._now = now
+        self._entries = OrderedDict()
+
+    def lookup(self, id_der, link_der):
+        '''Return the entry for a verified certificate pair, or **None** if
+        the pair hasn't been verified or has expired.
+
+        :param str id_der: DER encoded ID certificate
+        :param str link_der: DER encoded Link certificate
+        :returns: :class:`~oppy.connection.handshake.certcache.CertCacheEntry`
+            or **None**
+        '''
+        key = _cacheKey(id_der, link_der)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            if entry.valid_after < self._now() < entry.valid_until:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+            self.expired += 1
+        self.misses += 1
+        return None
+
+    def add(self, id_der, link_der, link_key, valid_after, valid_until):
+        '''Remember a certificate pair that has passed verification.
+
+        :param str id_der: DER encoded ID certificate
+        :param str link_der: DER encoded Link certificate
+        :param str link_key: ASN1 encoded key from the Link certificate
+        :param datetime.datetime valid_after: latest of both certificates'
+            notBefore times
+        :param datetime.datetime valid_until: earliest of both certificates'
+            notAfter times
+        '''
+        key = _cacheKey(id_der, link_der)
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+        self._entries[key] = CertCacheEntry(link_key, valid_after,
+                                            valid_until)
+
+    def clear(self):
+        '''Forget every certificate pair.'''
+        self._entries.clear()
+
+    def stats(self):
+        '''
+        :returns: **dict** counters for this cache
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = CertCache()
+
+
+def getCertCache():
+    '''
+    :returns: :class:`~oppy.connection.handshake.certcache.CertCache` the
+        cache used by V3 link handshakes
+    '''
+    return _cache
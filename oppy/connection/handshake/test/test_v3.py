@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from mock import call, Mock, patch
 patch('oppy.util.tools.dispatch', lambda d, k: lambda f: f).start()
 patch('oppy.connection.handshake.v3.dispatch', lambda d, k: lambda f: f).start()
@@ -34,7 +36,8 @@ class V3FSMProcessVersionsTestCase(BaseTestCase):
 
         self.assertRaisesRegexp(
             v3.HandshakeFailed,
-            '^Relay does not support Link Protocol 3$',
+            '^Relay does not support Link Protocol 3 or 4 '
+            '\\(it offered none\\)$',
             self.v3fsm._response_map[1],
             self.v3fsm,
             cell)
@@ -48,7 +51,7 @@ class V3FSMProcessVersionsTestCase(BaseTestCase):
 
         self.assertRaisesRegexp(
             v3.HandshakeFailed,
-            '^Relay does not support Link Protocol 3$',
+            '^TLS connection does not support a V3 handshake$',
             self.v3fsm._response_map[1],
             self.v3fsm,
             cell)
@@ -66,17 +69,18 @@ class V3FSMProcessCertsHelperTestCase(BaseTestCase):
         self.mock_verify_cell_cmd = patch.object(
             V3FSM, '_verifyCellCmd').start()
 
-        self.mock_der_cert_to_pem_cert = patch_object(
-            v3.ssl, 'DER_cert_to_PEM_cert').start()
-
         self.mock_load_certificate = patch_object(
             v3.SSLCrypto, 'load_certificate').start()
 
         self.mock_get_peer_certificate = patch_object(
             self.transport, 'getPeerCertificate').start()
 
-        self.mock_valid_cert_time = patch_object(
-            v3.crypto_util, 'validCertTime').start()
+        self.mock_cert_validity_times = patch_object(
+            v3.crypto_util, 'certValidityTimes').start()
+        self.mock_cert_validity_times.return_value = (
+            datetime.min, datetime.max)
+
+        patch.object(v3.certcache, '_cache', v3.certcache.CertCache()).start()
 
         self.mock_dump_privatekey = patch_object(
             v3.SSLCrypto, 'dump_privatekey').start()
@@ -87,7 +91,7 @@ class V3FSMProcessCertsHelperTestCase(BaseTestCase):
         self.mock_link_cert = Mock()
         self.mock_id_cert = Mock()
         self.mock_load_certificate.side_effect = iter([
-            self.mock_link_cert, self.mock_id_cert])
+            self.mock_id_cert, self.mock_link_cert])
 
         self.mock_conn_cert = self.mock_get_peer_certificate.return_value
         self.mock_id_key = self.mock_id_cert.get_pubkey.return_value
@@ -109,18 +113,14 @@ class V3FSMProcessCertsHelperTestCase(BaseTestCase):
         self.assertIsNone(result)
         self.assertEqual(self.v3fsm._state, 3)
         self.mock_verify_cell_cmd.assert_called_once_with(cell.header.cmd, 129)
-        self.mock_der_cert_to_pem_cert.assert_has_calls([
-            call('cert1'), call('cert2')])
-
         self.mock_load_certificate.assert_has_calls([
-            call(1, self.mock_der_cert_to_pem_cert.return_value),
-            call(1, self.mock_der_cert_to_pem_cert.return_value)])
+            call(2, 'cert2'), call(2, 'cert1')])
 
         self.mock_get_peer_certificate.assert_called_once_with()
         self.mock_id_cert.get_pubkey.assert_called_once_with()
         self.mock_link_cert.get_pubkey.assert_called_once_with()
         self.mock_conn_cert.get_pubkey.assert_called_once_with()
-        self.mock_valid_cert_time.assert_has_calls([
+        self.mock_cert_validity_times.assert_has_calls([
             call(self.mock_link_cert), call(self.mock_id_cert)])
 
         self.mock_dump_privatekey.assert_has_calls([
@@ -146,12 +146,11 @@ class V3FSMProcessCertsHelperTestCase(BaseTestCase):
             cell)
 
         self.mock_verify_cell_cmd.assert_called_once_with(cell.header.cmd, 129)
-        self.assertFalse(self.mock_der_cert_to_pem_cert.called)
         self.assertFalse(self.mock_load_certificate.called)
         self.assertFalse(self.mock_get_peer_certificate.called)
         self.assertFalse(self.mock_id_cert.get_pubkey.called)
         self.assertFalse(self.mock_link_cert.get_pubkey.called)
         self.assertFalse(self.mock_conn_cert.get_pubkey.called)
-        self.assertFalse(self.mock_valid_cert_time.called)
+        self.assertFalse(self.mock_cert_validity_times.called)
         self.assertFalse(self.mock_dump_privatekey.called)
         self.assertFalse(self.mock_id_key.type.called)
@@ -10,10 +10,15 @@
     returned, or an exception is raised and the associated Connection object
     is destroyed.
 
+    The same handshake is used to negotiate Link Protocol Version 4. Both
+    versions are offered in our VersionsCell and the highest version both
+    sides support is used for the rest of the connection.
+
 '''
-import ssl
 import struct
 
+from datetime import datetime
+
 import OpenSSL.crypto as SSLCrypto
 
 from oppy.cell.definitions import (
@@ -26,7 +31,13 @@ from oppy.cell.definitions import (
 from oppy.cell.fixedlen import NetInfoCell
 from oppy.cell.varlen import VersionsCell
 
-from oppy.connection.definitions import V3_KEY_BITS, OPENSSL_RSA_KEY_TYPE
+from oppy.connection.definitions import (
+    OPENSSL_RSA_KEY_TYPE,
+    SUPPORTED_LINK_PROTOCOLS,
+    V3_KEY_BITS,
+)
+from oppy.connection.handshake import certcache
+from oppy.connection.handshake.certcache import CertCacheEntry
 from oppy.connection.handshake.exceptions import (
     BadHandshakeState,
     HandshakeFailed,
@@ -59,6 +70,9 @@ class V3FSM(object):
         # need the transport so we can call getPeerCertificate()
         self._state = V3State.INIT
         self.transport = transport
+        # VersionsCells always use 2-byte circuit IDs, so act like Link
+        # Protocol 3 until a version has been negotiated
+        self.link_version = 3
 
     @staticmethod
     def _verifyCellCmd(test_cmd, cmd):
@@ -128,7 +142,7 @@ class V3FSM(object):
         :returns: **oppy.cell.varlen.VersionsCell**
         '''
         self._state = V3State.EXPECT_VERSIONS
-        return VersionsCell.make([3])
+        return VersionsCell.make(list(SUPPORTED_LINK_PROTOCOLS))
 
     @dispatch(_response_map, V3State.EXPECT_VERSIONS)
     def _processVersions(self, cell):
@@ -136,8 +150,9 @@ class V3FSM(object):
         state.
 
         Verify that we did receive a valid Versions cell and both our relay
-        and the current TLS connection support V3 handshakes. Advance
-        fsm state on success.
+        and the current TLS connection support V3 handshakes. Use the
+        highest Link Protocol version both sides support from now on and
+        advance fsm state on success.
 
         .. note:: See tor-spec, Section 2 for more details.
 
@@ -145,9 +160,17 @@ class V3FSM(object):
         '''
         V3FSM._verifyCellCmd(cell.header.cmd, VERSIONS_CMD)
 
-        if 3 not in cell.versions or self.handshakeSupported() is False:
-            msg = 'Relay does not support Link Protocol 3'
+        common = set(cell.versions) & set(SUPPORTED_LINK_PROTOCOLS)
+        if len(common) == 0:
+            msg = 'Relay does not support Link Protocol {} (it offered {})'
+            msg = msg.format(
+                ' or '.join(str(v) for v in SUPPORTED_LINK_PROTOCOLS),
+                ', '.join(str(v) for v in cell.versions) or 'none')
             raise HandshakeFailed(msg)
+        if self.handshakeSupported() is False:
+            msg = 'TLS connection does not support a V3 handshake'
+            raise HandshakeFailed(msg)
+        self.link_version = max(common)
         self._state = V3State.EXPECT_CERTS
         return None
 
@@ -157,7 +180,10 @@ class V3FSM(object):
         state.
 
         Verify that we did receive a valid Certs cell and the certificates
-        satisfy V3 criteria.
+        satisfy V3 criteria. Certificate pairs that have already been
+        verified on an earlier connection are found in the
+        :mod:`~oppy.connection.handshake.certcache` and only have their
+        Link key checked against this connection's TLS key.
 
         .. note:: See tor-spec, Section 4.2 for details.
 
@@ -169,8 +195,8 @@ class V3FSM(object):
             msg = 'Unexpected number of certificates in Certs cell: {0}'
             raise HandshakeFailed(msg.format(cell.num_certs))
 
-        id_cert = None
-        link_cert = None
+        id_der = None
+        link_der = None
 
         # The CERTS cell contains exactly one CertType 1 "Link" certificate.
         # The CERTS cell contains exactly one CertType 2 "ID" certificate.
@@ -181,52 +207,69 @@ class V3FSM(object):
             cert_item = cell.cert_payload_items[i]
             ctype = cert_item.cert_type
 
-            if ctype != LINK_CERT_TYPE and ctype != ID_CERT_TYPE:
+            if ctype == LINK_CERT_TYPE:
+                link_der = cert_item.cert
+            elif ctype == ID_CERT_TYPE:
+                id_der = cert_item.cert
+            else:
                 msg = 'Unexpected certificate type in Certs cell: {0}'
                 raise HandshakeFailed(msg.format(ctype))
 
-            cert = ssl.DER_cert_to_PEM_cert(cert_item.cert)
+        if id_der is None:
+            raise HandshakeFailed('Certs cell missing ID certificate')
+        if link_der is None:
+            raise HandshakeFailed('Certs cell missing Link certificate')
 
-            if ctype == LINK_CERT_TYPE:
-                link_cert = SSLCrypto.load_certificate(SSLCrypto.FILETYPE_PEM,
-                                                       cert)
-            else:
-                id_cert = SSLCrypto.load_certificate(SSLCrypto.FILETYPE_PEM,
-                                                     cert)
+        cache = certcache.getCertCache()
+        entry = cache.lookup(id_der, link_der)
+        if entry is None:
+            entry = V3FSM._verifyCerts(id_der, link_der)
+            cache.add(id_der, link_der, *entry)
 
-        if id_cert is None:
-            raise HandshakeFailed('Certs cell missing ID certificate')
-        if link_cert is None:
-            raise HandshakeFailed('Certs cell missing ID certificate')
+        # The certified key in the Link certificate matches the
+        # link key that was used to negotiate the TLS connection.
+        connKey = self.transport.getPeerCertificate().get_pubkey()
+        connASN1Key = SSLCrypto.dump_privatekey(SSLCrypto.FILETYPE_ASN1,
+                                                connKey)
+        if entry.link_key != connASN1Key:
+            msg = 'Public key from Link certificate is different from the key'
+            msg += 'used to initiate the TLS connection'
+            raise HandshakeFailed(msg)
 
-        conn_cert = self.transport.getPeerCertificate()
+        self._state = V3State.EXPECT_AUTH_CHALLENGE
+        return None
+
+    @staticmethod
+    def _verifyCerts(id_der, link_der):
+        '''Run every check on the ID and Link certificates from a Certs cell
+        that doesn't depend on the TLS connection they arrived on.
+
+        :param str id_der: DER encoded ID certificate
+        :param str link_der: DER encoded Link certificate
+        :returns: :class:`~oppy.connection.handshake.certcache.CertCacheEntry`
+            for the verified certificates
+        '''
+        id_cert = SSLCrypto.load_certificate(SSLCrypto.FILETYPE_ASN1, id_der)
+        link_cert = SSLCrypto.load_certificate(SSLCrypto.FILETYPE_ASN1,
+                                               link_der)
 
         idKey = id_cert.get_pubkey()
         linkKey = link_cert.get_pubkey()
-        connKey = conn_cert.get_pubkey()
 
         # Both certificates have good validAfter and validUntil dates
-        if crypto_util.validCertTime(link_cert) is False:
+        now = datetime.now()
+        linkAfter, linkUntil = crypto_util.certValidityTimes(link_cert)
+        if not linkAfter < now < linkUntil:
             msg = "Link certificate has an invalid 'validAfter' or "
             msg += "'validUntil' time."
             raise HandshakeFailed(msg)
 
-        if crypto_util.validCertTime(id_cert) is False:
+        idAfter, idUntil = crypto_util.certValidityTimes(id_cert)
+        if not idAfter < now < idUntil:
             msg = "ID certificate has an invalid 'validAfter' or "
             msg += "'validUntil' time."
             raise HandshakeFailed(msg)
 
-        # The certified key in the Link certificate matches the
-        # link key that was used to negotiate the TLS connection.
-        linkASN1Key = SSLCrypto.dump_privatekey(SSLCrypto.FILETYPE_ASN1,
-                                                linkKey)
-        connASN1Key = SSLCrypto.dump_privatekey(SSLCrypto.FILETYPE_ASN1,
-                                                connKey)
-        if linkASN1Key != connASN1Key:
-            msg = 'Public key from Link certificate is different from the key'
-            msg += 'used to initiate the TLS connection'
-            raise HandshakeFailed(msg)
-
         # The certified key in the ID certificate is a 1024-bit RSA key.
         if idKey.type() != OPENSSL_RSA_KEY_TYPE:
             msg = 'ID certificate key is not RSA. Type: {0}'
@@ -244,8 +287,10 @@ class V3FSM(object):
             msg = 'ID certificate is not properly self-signed.'
             raise HandshakeFailed(msg)
 
-        self._state = V3State.EXPECT_AUTH_CHALLENGE
-        return None
+        linkASN1Key = SSLCrypto.dump_privatekey(SSLCrypto.FILETYPE_ASN1,
+                                                linkKey)
+        return CertCacheEntry(linkASN1Key, max(linkAfter, idAfter),
+                              min(linkUntil, idUntil))
 
     @dispatch(_response_map, V3State.EXPECT_AUTH_CHALLENGE)
     def _processAuthChallenge(self, cell):
@@ -284,7 +329,8 @@ class V3FSM(object):
         self._state = V3State.DONE
         return NetInfoCell.make(cell.header.circ_id,
                                 other_or_address=cell.this_or_addresses[0],
-                                this_or_addresses=[cell.other_or_address])
+                                this_or_addresses=[cell.other_or_address],
+                                link_version=self.link_version)
 
     def isDone(self):
         '''Return **True** iff this V3 fsm's state is V3State.DONE
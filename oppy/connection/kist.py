@@ -0,0 +1,194 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Optional kernel-informed socket write limits (KIST) for the circuit
+    scheduler, on Linux.
+
+    The circuit scheduler (:mod:`oppy.connection.circuitmux`) can only
+    reorder cells that are still waiting in oppy. Without a limit it
+    writes cells as soon as the transport will take them, so most of them
+    end up queued in the kernel's socket send buffer, where an interactive
+    circuit's cell waits behind everything a bulk circuit wrote before
+    it.
+
+    When KIST is enabled (see enableKIST()), each open Connection's
+    scheduler asks a SocketLimit how many bytes the kernel could put on
+    the wire soon, and writes no more than that. Cells past the limit stay
+    in the scheduler's per-circuit queues, and the scheduler tries again
+    every *run_interval* seconds. The limit is computed the way tor's KIST
+    scheduler computes it, from the socket's TCP_INFO and its SIOCOUTQNSD
+    (bytes not yet sent) count::
+
+        tcp_space = (cwnd - unacked) * mss
+        extra_space = cwnd * mss * sock_buf_factor - notsent
+        limit = tcp_space + extra_space
+
+    i.e. enough to fill the congestion window, plus up to
+    *sock_buf_factor* congestion windows of data waiting in the kernel.
+
+    KIST only works on Linux; elsewhere, or if a connection's socket can't
+    be found, connections fall back to scheduling without a limit.
+
+'''
+import fcntl
+import logging
+import socket
+import struct
+import sys
+
+
+# seconds between scheduler runs while cells are held back
+# (tor's KISTSchedRunInterval default)
+DEFAULT_RUN_INTERVAL = 0.01
+# congestion windows' worth of data allowed to wait in the kernel
+# (tor's KISTSockBufSizeFactor default)
+DEFAULT_SOCK_BUF_FACTOR = 1.0
+
+# from linux/sockios.h and linux/tcp.h
+SIOCOUTQNSD = 0x894B
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+# tcpi_state through tcpi_snd_cwnd of struct tcp_info
+TCP_INFO_FORMAT = '8B19I'
+TCP_INFO_LEN = struct.calcsize(TCP_INFO_FORMAT)
+# indexes of the fields we need in the unpacked struct
+TCPI_SND_MSS = 8 + 2
+TCPI_UNACKED = 8 + 4
+TCPI_SND_CWND = 8 + 18
+
+_settings = None
+
+
+def readSocketInfo(sock):
+    '''Read the congestion state of TCP socket *sock* from the kernel.
+
+    :param socket.socket sock: connected TCP socket
+    :returns: **tuple, int** (cwnd, unacked, mss, notsent): the congestion
+        window and number of unacknowledged segments, the sender's maximum
+        segment size and the number of bytes in the send queue that haven't
+        been sent yet
+    '''
+    info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_LEN)
+    info = struct.unpack(TCP_INFO_FORMAT, info[:TCP_INFO_LEN])
+    notsent = fcntl.ioctl(sock.fileno(), SIOCOUTQNSD, struct.pack('i', 0))
+    notsent = struct.unpack('i', notsent)[0]
+    return (info[TCPI_SND_CWND], info[TCPI_UNACKED], info[TCPI_SND_MSS],
+            notsent)
+
+
+def computeLimit(cwnd, unacked, mss, notsent, sock_buf_factor):
+    '''Return the number of bytes KIST lets a socket write now.
+
+    :param int cwnd: congestion window, in segments
+    :param int unacked: segments sent but not yet acknowledged
+    :param int mss: sender's maximum segment size
+    :param int notsent: bytes in the send queue not sent yet
+    :param float sock_buf_factor: congestion windows' worth of data
+        allowed to wait in the kernel
+    :returns: **int** bytes
+    '''
+    tcp_space = max(0, (cwnd - unacked) * mss)
+    extra_space = int(cwnd * mss * sock_buf_factor) - notsent
+    return max(0, tcp_space + extra_space)
+
+
+class SocketLimit(object):
+    '''Tells a connection's circuit scheduler how many bytes its socket
+    should be given right now.'''
+
+    def __init__(self, sock, sock_buf_factor=DEFAULT_SOCK_BUF_FACTOR,
+                 run_interval=DEFAULT_RUN_INTERVAL):
+        '''
+        :param socket.socket sock: the connection's TCP socket
+        :param float sock_buf_factor: congestion windows' worth of data
+            allowed to wait in the kernel
+        :param float run_interval: seconds the scheduler should wait before
+            trying again once it has reached the limit
+        '''
+        self.sock = sock
+        self.sock_buf_factor = sock_buf_factor
+        self.run_interval = run_interval
+
+    def writableBytes(self):
+        '''
+        :returns: **int** bytes the scheduler may write now, or **None** if
+            the socket's state can't be read (in which case there's no
+            limit)
+        '''
+        try:
+            cwnd, unacked, mss, notsent = readSocketInfo(self.sock)
+        except (IOError, OSError, socket.error, struct.error):
+            return None
+        return computeLimit(cwnd, unacked, mss, notsent, self.sock_buf_factor)
+
+
+def findSocket(transport):
+    '''Find the TCP socket under *transport*, looking through any TLS
+    layers wrapped around it.
+
+    :param transport: a connection's transport
+    :returns: **socket.socket**, or **None** if there isn't one
+    '''
+    while transport is not None:
+        sock = getattr(transport, 'socket', None)
+        if isinstance(sock, socket.socket):
+            return sock
+        transport = getattr(transport, 'transport', None)
+    return None
+
+
+def isKISTAvailable():
+    '''
+    :returns: **bool** whether this platform can read the socket state KIST
+        needs
+    '''
+    return sys.platform.startswith('linux')
+
+
+def enableKIST(sock_buf_factor=DEFAULT_SOCK_BUF_FACTOR,
+               run_interval=DEFAULT_RUN_INTERVAL):
+    '''Limit writes on every Connection that opens from now on to what its
+    socket can send soon.
+
+    Only has an effect on Connections with a circuit scheduler (see
+    :func:`oppy.connection.circuitmux.enableScheduler`).
+
+    :param float sock_buf_factor: congestion windows' worth of data allowed
+        to wait in the kernel
+    :param float run_interval: seconds between scheduler runs while cells
+        are held back
+    '''
+    global _settings
+    _settings = (sock_buf_factor, run_interval)
+
+
+def disableKIST():
+    '''Stop limiting writes on Connections that open from now on.'''
+    global _settings
+    _settings = None
+
+
+def isKISTEnabled():
+    '''
+    :returns: **bool** whether new Connections limit their writes
+    '''
+    return _settings is not None
+
+
+def makeSocketLimit(transport):
+    '''
+    :param transport: a newly opened connection's transport
+    :returns: :class:`~oppy.connection.kist.SocketLimit` for the
+        connection, or **None** if KIST isn't enabled or the connection's
+        socket can't be found
+    '''
+    if _settings is None:
+        return None
+    sock = findSocket(transport)
+    if sock is None:
+        logging.debug("Can't find a socket to limit writes on.")
+        return None
+    sock_buf_factor, run_interval = _settings
+    return SocketLimit(sock, sock_buf_factor, run_interval)
@@ -0,0 +1,95 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    A RecvBuffer holds the raw bytes a Connection has received from the
+    network but not yet turned into cells. RecvBuffers:
+
+        - Copy incoming data into a single growable bytearray exactly once
+        - Hand out read-only views starting at the current read offset, so
+          cells can be parsed without first slicing the buffer
+        - Advance a read offset as cells are consumed, only compacting the
+          underlying bytearray periodically instead of after every cell
+        - Enforce a high-water mark so a misbehaving relay can't make a
+          connection's buffer grow without bound
+
+'''
+from oppy.connection.definitions import (
+    RECV_BUFFER_COMPACT_THRESHOLD,
+    RECV_BUFFER_HIGH_WATER,
+)
+from oppy.connection.exceptions import RecvBufferOverflow
+
+
+class RecvBuffer(object):
+    '''An append-only receive buffer with a movable read offset.'''
+
+    def __init__(self, high_water=RECV_BUFFER_HIGH_WATER,
+                 compact_threshold=RECV_BUFFER_COMPACT_THRESHOLD):
+        '''
+        :param int high_water: maximum number of unconsumed bytes this
+            buffer will hold before refusing more data
+        :param int compact_threshold: number of consumed bytes allowed to
+            accumulate at the front of the buffer before they are discarded
+        '''
+        self._buf = bytearray()
+        self._offset = 0
+        self._high_water = high_water
+        self._compact_threshold = compact_threshold
+
+    def append(self, data):
+        '''Append *data* to the end of this buffer.
+
+        Raise RecvBufferOverflow (and leave the buffer unchanged) if
+        appending *data* would push the number of unconsumed bytes above
+        this buffer's high-water mark.
+
+        :param str data: raw bytes received from the network
+        '''
+        if len(self) + len(data) > self._high_water:
+            msg = "Receive buffer would hold {} bytes, but high-water mark "
+            msg += "is {} bytes."
+            msg = msg.format(len(self) + len(data), self._high_water)
+            raise RecvBufferOverflow(msg)
+        self._buf += data
+
+    def view(self):
+        '''Return a read-only view of the unconsumed bytes in this buffer.
+
+        Slicing the view returns a **str** without copying the rest of the
+        buffer. The view is only valid until the next call to append(),
+        consume(), or clear().
+
+        :returns: **buffer** over the unconsumed bytes
+        '''
+        return buffer(self._buf, self._offset)
+
+    def consume(self, n):
+        '''Mark the next *n* unconsumed bytes as read.
+
+        If every byte has been consumed, reset the buffer. Otherwise, only
+        compact the underlying bytearray once the consumed prefix grows
+        past the compaction threshold.
+
+        :param int n: number of bytes to consume
+        '''
+        if n > len(self):
+            msg = "Tried to consume {} bytes, but only {} bytes are buffered."
+            raise ValueError(msg.format(n, len(self)))
+
+        self._offset += n
+        if self._offset == len(self._buf):
+            self.clear()
+        elif self._offset >= self._compact_threshold:
+            del self._buf[:self._offset]
+            self._offset = 0
+
+    def clear(self):
+        '''Discard all buffered bytes.'''
+        del self._buf[:]
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buf) - self._offset
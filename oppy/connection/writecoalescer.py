@@ -0,0 +1,171 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Optional write coalescing for Connections.
+
+    Without coalescing, every cell a Connection writes is its own
+    transport.write() call, so a circuit flushing a window's worth of data
+    makes hundreds of tiny TLS writes, each with its own TLS record and
+    syscall. When coalescing is enabled (see enableWriteCoalescing()), each
+    open Connection packs outgoing cells into a WriteCoalescer's buffer
+    instead, and the buffer goes to the transport in one write:
+
+        - at the end of the current reactor turn (or after *max_delay*
+          seconds, if that's set), or
+        - as soon as *max_bytes* bytes are waiting, whichever comes first.
+
+    Cells are always written in the order they were passed to
+    writeCell().
+
+    Coalescing is off by default. Counters for every coalescer are kept
+    together and can be read with coalescingStats().
+
+'''
+from oppy.cell.definitions import FIXED_LEN_V4_LEN
+
+
+# flush as soon as this many bytes are waiting
+DEFAULT_MAX_BYTES = 32 * 1024
+# seconds to wait before flushing; 0 flushes at the end of the reactor turn
+DEFAULT_MAX_DELAY = 0
+
+_settings = None
+_totals = {
+    'cells': 0,
+    'bytes': 0,
+    'flushes': 0,
+    'max_cells_per_flush': 0,
+}
+
+
+class WriteCoalescer(object):
+    '''Collects a connection's outgoing cells and writes them to its
+    transport in batches.'''
+
+    def __init__(self, write, max_bytes=DEFAULT_MAX_BYTES,
+                 max_delay=DEFAULT_MAX_DELAY, callLater=None):
+        '''
+        :param write: function taking a string to write to the transport
+        :param int max_bytes: number of waiting bytes that triggers an
+            immediate flush
+        :param float max_delay: seconds to wait before flushing
+        :param callLater: function used to schedule flushes, with the same
+            signature as reactor.callLater(). Defaults to the global
+            reactor's.
+        '''
+        if callLater is None:
+            from twisted.internet import reactor
+            callLater = reactor.callLater
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._write = write
+        self._callLater = callLater
+        # room for max_bytes plus the largest fixed-length cell, so a flush
+        # is only ever needed after a cell has been packed
+        self._buf = bytearray(max_bytes + FIXED_LEN_V4_LEN)
+        self._end = 0
+        self._cells = 0
+        self._pending = None
+
+    def writeCell(self, cell):
+        '''Pack *cell* into the buffer, flushing if it's full enough.
+
+        :param cell cell: cell to write
+        '''
+        n = len(cell)
+        if self._end + n > len(self._buf):
+            self.flush()
+            if n > len(self._buf):
+                # a variable-length cell bigger than the whole buffer
+                self._write(cell.getBytes())
+                self._count(1, n)
+                return
+        self._end += cell.writeInto(self._buf, self._end)
+        self._cells += 1
+        if self._end >= self.max_bytes:
+            self.flush()
+        elif self._pending is None:
+            self._pending = self._callLater(self.max_delay, self.flush)
+
+    def flush(self):
+        '''Write every waiting cell to the transport now.'''
+        if self._pending is not None:
+            if self._pending.active():
+                self._pending.cancel()
+            self._pending = None
+        if self._end == 0:
+            return
+        self._write(str(buffer(self._buf, 0, self._end)))
+        self._count(self._cells, self._end)
+        self._end = 0
+        self._cells = 0
+
+    def _count(self, cells, nbytes):
+        _totals['cells'] += cells
+        _totals['bytes'] += nbytes
+        _totals['flushes'] += 1
+        if cells > _totals['max_cells_per_flush']:
+            _totals['max_cells_per_flush'] = cells
+
+    def stop(self):
+        '''Drop every waiting cell and cancel any scheduled flush.'''
+        if self._pending is not None and self._pending.active():
+            self._pending.cancel()
+        self._pending = None
+        self._end = 0
+        self._cells = 0
+
+    def __len__(self):
+        return self._cells
+
+
+def enableWriteCoalescing(max_bytes=DEFAULT_MAX_BYTES,
+                          max_delay=DEFAULT_MAX_DELAY):
+    '''Coalesce writes on every Connection that opens from now on.
+
+    :param int max_bytes: number of waiting bytes that triggers an
+        immediate flush
+    :param float max_delay: seconds to wait before flushing
+    '''
+    global _settings
+    _settings = (max_bytes, max_delay)
+
+
+def disableWriteCoalescing():
+    '''Write each cell separately on Connections that open from now on.'''
+    global _settings
+    _settings = None
+
+
+def isWriteCoalescingEnabled():
+    '''
+    :returns: **bool** whether new Connections coalesce their writes
+    '''
+    return _settings is not None
+
+
+def makeCoalescer(write):
+    '''
+    :param write: function taking a string to write to the transport
+    :returns: :class:`~oppy.connection.writecoalescer.WriteCoalescer` for a
+        newly opened connection, or **None** if coalescing isn't enabled
+    '''
+    if _settings is None:
+        return None
+    max_bytes, max_delay = _settings
+    return WriteCoalescer(write, max_bytes, max_delay)
+
+
+def coalescingStats():
+    '''
+    :returns: **dict** counters summed over every WriteCoalescer
+    '''
+    stats = dict(_totals)
+    if stats['flushes'] == 0:
+        stats['cells_per_flush'] = 0.0
+    else:
+        stats['cells_per_flush'] = float(stats['cells']) / stats['flushes']
+    return stats
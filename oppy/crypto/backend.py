@@ -0,0 +1,363 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Crypto backends provide the primitives that oppy's circuit and link
+    crypto is built on:
+
+        - AES128-CTR ciphers for the RelayCrypto objects in a crypt_path
+        - HMAC-SHA256 and HKDF-SHA256 for ntor key derivation
+        - Curve25519 key generation and scalar multiplication for ntor
+          handshakes
+        - Verifying RSA signatures on link and identity certificates
+
+    Two backends are available:
+
+        - **pycrypto** (the default) uses PyCrypto, the *hkdf* package,
+          PyNaCl and pyOpenSSL, and is what oppy has always used.
+        - **openssl** uses the *cryptography* package, so AES-CTR and
+          Curve25519 run in OpenSSL (with AES-NI where the CPU has it).
+          *cryptography* is only imported when this backend is selected.
+
+    The backend is chosen once at startup with setBackend() (see the
+    --crypto-backend option). Everything in :mod:`oppy.crypto` asks
+    getBackend() for the current one when it needs a primitive, so
+    handshakes and ciphers made after a switch use the new backend.
+
+'''
+import abc
+import hashlib
+import hmac
+import hkdf
+
+import OpenSSL
+
+from Crypto.Cipher import AES
+from Crypto.Util import asn1, Counter
+from nacl import bindings
+from nacl.public import PrivateKey, PublicKey
+
+from oppy.crypto.exceptions import CryptoBackendUnavailable
+
+
+CURVE25519_KEY_LEN = 32
+
+
+class CryptoBackend(object):
+    '''Interface shared by all crypto backends.'''
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+
+    @abc.abstractmethod
+    def makeAES128CTRCipher(self, key, initial_value=0):
+        '''Create and return a new AES128-CTR cipher.
+
+        The returned object has *encrypt()* and *decrypt()* methods that
+        take and return byte strings. Successive calls continue the same
+        keystream.
+
+        :param str key: key to use for this cipher
+        :param int initial_value: initial counter value
+        :returns: AES128-CTR cipher
+        '''
+        pass
+
+    @abc.abstractmethod
+    def makeHMACSHA256(self, msg, key):
+        '''Return the HMAC-SHA256 digest of *msg* with *key*.
+
+        :param str msg: msg
+        :param str key: key to use
+        :returns: **str** HMAC digest
+        '''
+        pass
+
+    @abc.abstractmethod
+    def hkdfSHA256(self, input_key_material, salt, info, length):
+        '''Run HKDF-SHA256 (RFC 5869) extract and expand.
+
+        :param str input_key_material: input key material
+        :param str salt: salt for the extract step
+        :param str info: info string for the expand step
+        :param int length: number of bytes of key material to return
+        :returns: **str** derived key material
+        '''
+        pass
+
+    @abc.abstractmethod
+    def generateCurve25519Keypair(self):
+        '''Generate a new Curve25519 keypair.
+
+        :returns: **tuple, str** (secret_key, public_key) as raw 32-byte
+            strings
+        '''
+        pass
+
+    def loadCurve25519Key(self, secret_key):
+        '''Prepare *secret_key* for use with curve25519().
+
+        The result can be passed to curve25519() in place of the raw key,
+        so a handshake doing several exchanges with one secret key only
+        loads it once. Backends that work on raw keys return *secret_key*
+        as-is.
+
+        :param str secret_key: raw 32-byte secret key
+        :returns: secret key to pass to curve25519()
+        '''
+        return secret_key
+
+    @abc.abstractmethod
+    def curve25519(self, secret_key, public_key):
+        '''Compute the Curve25519 shared secret of *secret_key* and
+        *public_key*.
+
+        An all-zero result is returned as-is (never raised as an error),
+        so the ntor handshake can check for it in constant time.
+
+        :param str secret_key: our raw 32-byte secret key, or the result of
+            loadCurve25519Key()
+        :param str public_key: the other party's raw 32-byte public key
+        :returns: **str** raw 32-byte shared secret
+        '''
+        pass
+
+    @abc.abstractmethod
+    def verifyCertSig(self, id_cert, cert_to_verify, algo='sha1'):
+        '''Verify that *id_cert* has signed *cert_to_verify*.
+
+        :param OpenSSL.crypto.X509 id_cert: Identification Certificate
+        :param OpenSSL.crypto.X509 cert_to_verify: certificate to verify
+            signature on
+        :param str algo: digest algorithm used for the signature
+        :returns: **bool** **True** if the signature verifies, **False**
+            otherwise
+        '''
+        pass
+
+
+class PyCryptoBackend(CryptoBackend):
+    '''Crypto backend built on PyCrypto, hkdf, PyNaCl and pyOpenSSL.'''
+
+    name = 'pycrypto'
+
+    def makeAES128CTRCipher(self, key, initial_value=0):
+        ctr = Counter.new(128, initial_value=initial_value)
+        return AES.new(key, AES.MODE_CTR, counter=ctr)
+
+    def makeHMACSHA256(self, msg, key):
+        t = hmac.new(msg=msg, key=key, digestmod=hashlib.sha256)
+        return t.digest()
+
+    def hkdfSHA256(self, input_key_material, salt, info, length):
+        prk = hkdf.hkdf_extract(salt=salt,
+                                input_key_material=input_key_material,
+                                hash=hashlib.sha256)
+        return hkdf.hkdf_expand(pseudo_random_key=prk, info=info,
+                                length=length, hash=hashlib.sha256)
+
+    def generateCurve25519Keypair(self):
+        secret_key = PrivateKey.generate()
+        return bytes(secret_key), bytes(secret_key.public_key)
+
+    def curve25519(self, secret_key, public_key):
+        # args are: exponent, base
+        try:
+            return bindings.crypto_scalarmult(secret_key,
+                                              bytes(PublicKey(public_key)))
+        # newer PyNaCl versions refuse to return an all-zero shared secret
+        except RuntimeError:
+            return '\x00' * CURVE25519_KEY_LEN
+
+    def verifyCertSig(self, id_cert, cert_to_verify, algo='sha1'):
+        cert_to_verify_ASN1 = OpenSSL.crypto.dump_certificate(
+                                OpenSSL.crypto.FILETYPE_ASN1, cert_to_verify)
+
+        der = asn1.DerSequence()
+        der.decode(cert_to_verify_ASN1)
+        cert_to_verify_DER = der[0]
+        cert_to_verify_SIG = der[2]
+
+        sig_DER = asn1.DerObject()
+        sig_DER.decode(cert_to_verify_SIG)
+
+        sig = sig_DER.payload
+
+        # first byte is number of unused bytes. should be zero
+        assert sig[0] == '\x00'
+        sig = sig[1:]
+
+        try:
+            OpenSSL.crypto.verify(id_cert, sig, cert_to_verify_DER, algo)
+            return True
+        except OpenSSL.crypto.Error:
+            return False
+
+
+class OpenSSLCTRCipher(object):
+    '''AES128-CTR cipher backed by an OpenSSL cipher context.'''
+
+    __slots__ = ('encrypt', 'decrypt')
+
+    def __init__(self, context):
+        '''
+        :param context: a *cryptography* CipherContext for AES-CTR
+        '''
+        # CTR encryption and decryption are the same operation, so both
+        # go straight to the context with no wrapper in between
+        self.encrypt = context.update
+        self.decrypt = context.update
+
+
+class OpenSSLBackend(CryptoBackend):
+    '''Crypto backend built on the *cryptography* package's OpenSSL
+    bindings.
+    '''
+
+    name = 'openssl'
+
+    def __init__(self):
+        try:
+            from cryptography.hazmat.backends import default_backend
+        except ImportError:
+            msg = "The openssl crypto backend needs the cryptography package."
+            raise CryptoBackendUnavailable(msg)
+        self._backend = default_backend()
+        if not self._backend.x25519_supported():
+            msg = "The installed OpenSSL does not support X25519."
+            raise CryptoBackendUnavailable(msg)
+
+    def makeAES128CTRCipher(self, key, initial_value=0):
+        from cryptography.hazmat.primitives.ciphers import (
+            Cipher,
+            algorithms,
+            modes,
+        )
+
+        nonce = '{:032x}'.format(initial_value).decode('hex')
+        cipher = Cipher(algorithms.AES(key), modes.CTR(nonce),
+                        backend=self._backend)
+        return OpenSSLCTRCipher(cipher.encryptor())
+
+    def makeHMACSHA256(self, msg, key):
+        # the stdlib's hmac already runs on OpenSSL's SHA-256
+        t = hmac.new(msg=msg, key=key, digestmod=hashlib.sha256)
+        return t.digest()
+
+    def hkdfSHA256(self, input_key_material, salt, info, length):
+        # cryptography's HKDF drives OpenSSL's HMAC one call at a time
+        # through cffi, which is slower than the stdlib's hmac (also
+        # backed by OpenSSL's SHA-256) for the 72 bytes ntor needs
+        prk = self.makeHMACSHA256(input_key_material, salt)
+        okm = ''
+        block = ''
+        counter = 1
+        while len(okm) < length:
+            block = self.makeHMACSHA256(block + info + chr(counter), prk)
+            okm += block
+            counter += 1
+        return okm[:length]
+
+    def generateCurve25519Keypair(self):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric.x25519 import (
+            X25519PrivateKey,
+        )
+
+        key = X25519PrivateKey.generate()
+        secret_key = key.private_bytes(serialization.Encoding.Raw,
+                                       serialization.PrivateFormat.Raw,
+                                       serialization.NoEncryption())
+        public_key = key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        return secret_key, public_key
+
+    def loadCurve25519Key(self, secret_key):
+        # loading raw key bytes into OpenSSL costs about as much as an
+        # exchange, and each ntor handshake does two
+        from cryptography.hazmat.primitives.asymmetric.x25519 import (
+            X25519PrivateKey,
+        )
+
+        return X25519PrivateKey.from_private_bytes(secret_key)
+
+    def curve25519(self, secret_key, public_key):
+        from cryptography.hazmat.primitives.asymmetric.x25519 import (
+            X25519PublicKey,
+        )
+
+        if isinstance(secret_key, str):
+            secret_key = self.loadCurve25519Key(secret_key)
+        try:
+            return secret_key.exchange(
+                X25519PublicKey.from_public_bytes(public_key))
+        # OpenSSL refuses to return an all-zero shared secret
+        except ValueError:
+            return '\x00' * CURVE25519_KEY_LEN
+
+    def verifyCertSig(self, id_cert, cert_to_verify, algo='sha1'):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        cert = self._loadCert(cert_to_verify)
+        public_key = self._loadCert(id_cert).public_key()
+        hash_algo = getattr(hashes, algo.upper())()
+        try:
+            public_key.verify(cert.signature, cert.tbs_certificate_bytes,
+                              padding.PKCS1v15(), hash_algo)
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+
+    def _loadCert(self, cert):
+        '''Convert a pyOpenSSL certificate to a *cryptography* one.
+
+        :param OpenSSL.crypto.X509 cert: certificate to convert
+        :returns: **cryptography.x509.Certificate**
+        '''
+        from cryptography import x509
+
+        der = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_ASN1,
+                                              cert)
+        return x509.load_der_x509_certificate(der, self._backend)
+
+
+BACKENDS = {
+    PyCryptoBackend.name:   PyCryptoBackend,
+    OpenSSLBackend.name:    OpenSSLBackend,
+}
+
+DEFAULT_BACKEND = PyCryptoBackend.name
+
+_backend = None
+
+
+def getBackend():
+    '''Return the crypto backend currently in use, creating the default
+    one if none has been chosen yet.
+
+    :returns: :class:`~oppy.crypto.backend.CryptoBackend`
+    '''
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[DEFAULT_BACKEND]()
+    return _backend
+
+
+def setBackend(name):
+    '''Switch to the crypto backend called *name*.
+
+    :param str name: one of the keys of BACKENDS
+    :returns: :class:`~oppy.crypto.backend.CryptoBackend` the new backend
+    '''
+    global _backend
+    try:
+        backend_type = BACKENDS[name]
+    except KeyError:
+        msg = "Unknown crypto backend: {}.".format(name)
+        raise ValueError(msg)
+    _backend = backend_type()
+    return _backend
@@ -2,6 +2,10 @@
 # See LICENSE for licensing information
 
 
+class CryptoBackendUnavailable(Exception):
+    pass
+
+
 class KeyDerivationFailed(Exception):
     pass
 
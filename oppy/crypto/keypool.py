@@ -0,0 +1,170 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    An optional pool of pre-generated ephemeral Curve25519 keypairs for
+    ntor handshakes.
+
+    Every NTorHandshake needs a fresh keypair, and a circuit makes three
+    of them as soon as it's created. When the pool is enabled (see
+    enableKeypairPool()), NTorHandshakes take their keypair from the pool
+    instead. Each keypair is handed out exactly once and then forgotten
+    by the pool. Whenever the pool drops below its target size, it's
+    topped up a few keypairs at a time in reactor.callLater(0) calls, so
+    key generation happens in idle reactor time rather than while a
+    circuit is being built. If the pool is empty, a keypair is generated
+    on the spot and counted as a miss.
+
+    The pool is off by default. While it's off, takeKeypair() just asks
+    the current crypto backend for a new keypair.
+
+    .. warning:: Pooled secret keys sit in memory until they're used.
+        Like NTorHandshakes, the pool doesn't safely erase them.
+
+'''
+from oppy.crypto import backend
+
+
+DEFAULT_TARGET_SIZE = 30
+# number of keypairs generated per idle-time refill call
+REFILL_BATCH = 3
+
+
+def _generateKeypair():
+    return backend.getBackend().generateCurve25519Keypair()
+
+
+class KeypairPool(object):
+    '''A pool of unused Curve25519 keypairs that refills itself.'''
+
+    def __init__(self, target_size=DEFAULT_TARGET_SIZE, callLater=None,
+                 generate=_generateKeypair):
+        '''
+        :param int target_size: number of keypairs the pool tries to keep
+            ready
+        :param callLater: function used to schedule refills, with the same
+            signature as reactor.callLater(). Defaults to the global
+            reactor's.
+        :param generate: callable returning a new (secret_key, public_key)
+            tuple
+        '''
+        if callLater is None:
+            from twisted.internet import reactor
+            callLater = reactor.callLater
+        self.target_size = target_size
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._callLater = callLater
+        self._generate = generate
+        self._keypairs = []
+        self._pending = None
+        self._scheduleRefill()
+
+    def take(self):
+        '''Remove and return a keypair from the pool, generating one right
+        away if the pool is empty.
+
+        :returns: **tuple, str** (secret_key, public_key)
+        '''
+        if self._keypairs:
+            self.hits += 1
+            keypair = self._keypairs.pop()
+        else:
+            self.misses += 1
+            keypair = self._generate()
+        self._scheduleRefill()
+        return keypair
+
+    def refill(self):
+        '''Generate up to REFILL_BATCH keypairs, and schedule another refill
+        if the pool is still below its target size.
+        '''
+        self._pending = None
+        for _ in xrange(min(REFILL_BATCH,
+                            self.target_size - len(self._keypairs))):
+            self._keypairs.append(self._generate())
+            self.generated += 1
+        self._scheduleRefill()
+
+    def _scheduleRefill(self):
+        if len(self._keypairs) < self.target_size and self._pending is None:
+            self._pending = self._callLater(0, self.refill)
+
+    def stop(self):
+        '''Cancel any scheduled refill and drop every unused keypair.'''
+        if self._pending is not None and self._pending.active():
+            self._pending.cancel()
+        self._pending = None
+        del self._keypairs[:]
+
+    def hitRate(self):
+        '''
+        :returns: **float** fraction of take() calls that were served by a
+            pre-generated keypair
+        '''
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def stats(self):
+        '''
+        :returns: **dict** counters for this pool
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'generated': self.generated,
+            'size': len(self._keypairs),
+            'target_size': self.target_size,
+            'hit_rate': self.hitRate(),
+        }
+
+    def __len__(self):
+        return len(self._keypairs)
+
+
+_pool = None
+
+
+def enableKeypairPool(target_size=DEFAULT_TARGET_SIZE):
+    '''Start handing out pre-generated keypairs, and start filling the
+    pool.
+
+    Any existing pool (and its counters) is replaced.
+
+    :param int target_size: number of keypairs to keep ready
+    '''
+    global _pool
+    disableKeypairPool()
+    _pool = KeypairPool(target_size)
+
+
+def disableKeypairPool():
+    '''Stop pooling keypairs and drop any that haven't been used.'''
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+    _pool = None
+
+
+def getKeypairPool():
+    '''
+    :returns: :class:`~oppy.crypto.keypool.KeypairPool` or **None** if
+        keypairs aren't being pooled
+    '''
+    return _pool
+
+
+def takeKeypair():
+    '''Return a new, never used Curve25519 keypair, from the pool if it's
+    enabled.
+
+    :returns: **tuple, str** (secret_key, public_key)
+    '''
+    if _pool is None:
+        return _generateKeypair()
+    return _pool.take()
@@ -0,0 +1,157 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Optional keystream prefetching for the AES128-CTR ciphers in a
+    circuit's crypt_path.
+
+    Encrypting or decrypting a single 509-byte payload with a PyCrypto
+    CTR cipher pays for a Python-level call and a short run of AES blocks
+    every time. A PrefetchCipher instead asks its cipher for keystream in
+    large blocks (by encrypting runs of zero bytes) and applies it to each
+    payload with Crypto.Util.strxor, so encrypting or decrypting a cell is
+    just an XOR and an offset bump.
+
+    When the unused keystream drops below a low-water mark, the next block
+    is generated in a reactor.callLater(0) call, i.e. once the reactor has
+    finished with the data it's currently handling. If a payload ever needs
+    more keystream than is buffered, the buffer is extended right away, so
+    the output is always byte-for-byte the same as the wrapped cipher's.
+
+    Prefetching is off by default. While it's off, wrapCipher() returns
+    ciphers unchanged.
+
+'''
+from Crypto.Util.strxor import strxor
+
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+
+
+# keystream is generated this many cell payloads at a time
+DEFAULT_BLOCK_CELLS = 64
+DEFAULT_BLOCK_SIZE = DEFAULT_BLOCK_CELLS * MAX_PAYLOAD_LEN
+
+
+class PrefetchCipher(object):
+    '''Wraps an AES128-CTR cipher and serves its keystream from a buffer.'''
+
+    __slots__ = ('block_size', 'low_water', '_cipher', '_keystream',
+                 '_offset', '_end', '_refill_at', '_callLater', '_pending')
+
+    def __init__(self, cipher, block_size=DEFAULT_BLOCK_SIZE, callLater=None):
+        '''
+        :param Crypto.Cipher.AES.AESCipher cipher: CTR mode cipher to
+            prefetch keystream from. It must not be used directly once
+            it's been wrapped.
+        :param int block_size: number of keystream bytes generated at a time
+        :param callLater: function used to schedule prefetching, with the
+            same signature as reactor.callLater(). Defaults to the global
+            reactor's.
+        '''
+        if callLater is None:
+            from twisted.internet import reactor
+            callLater = reactor.callLater
+        self.block_size = block_size
+        self.low_water = block_size // 2
+        self._cipher = cipher
+        self._keystream = ''
+        self._offset = 0
+        self._end = 0
+        # offset past which another block should be prefetched
+        self._refill_at = -self.low_water
+        self._callLater = callLater
+        self._pending = None
+
+    def encrypt(self, data):
+        '''Encrypt (or decrypt) *data* with the next len(*data*) bytes of
+        keystream.
+
+        :param str data: data to encrypt
+        :returns: **str** encrypted data
+        '''
+        # strxor() can't handle empty strings
+        if not data:
+            return data
+        start = self._offset
+        end = start + len(data)
+        if end > self._end:
+            self._extend(len(data))
+            start = 0
+            end = len(data)
+        self._offset = end
+        if end > self._refill_at and self._pending is None:
+            self._pending = self._callLater(0, self.prefetch)
+        return strxor(data, self._keystream[start:end])
+
+    decrypt = encrypt
+
+    def available(self):
+        '''
+        :returns: **int** number of keystream bytes buffered and not yet
+            used
+        '''
+        return self._end - self._offset
+
+    def prefetch(self):
+        '''Generate another block of keystream if the buffer has dropped
+        below its low-water mark.
+        '''
+        self._pending = None
+        if self.available() < self.low_water:
+            self._extend(self.block_size)
+
+    def _extend(self, needed):
+        '''Drop used keystream and generate enough new keystream that at
+        least *needed* bytes are available.
+
+        :param int needed: number of unused keystream bytes required
+        '''
+        blocks = max(1, -(-(needed - self.available()) // self.block_size))
+        zeros = '\x00' * (blocks * self.block_size)
+        self._keystream = (self._keystream[self._offset:] +
+                           self._cipher.encrypt(zeros))
+        self._offset = 0
+        self._end = len(self._keystream)
+        self._refill_at = self._end - self.low_water
+
+
+_block_size = None
+
+
+def enablePrefetch(block_size=DEFAULT_BLOCK_SIZE):
+    '''Wrap ciphers made from now on in PrefetchCiphers.
+
+    :param int block_size: number of keystream bytes each cipher generates
+        at a time
+    '''
+    global _block_size
+    _block_size = block_size
+
+
+def disablePrefetch():
+    '''Stop wrapping new ciphers. Ciphers that are already wrapped keep
+    prefetching.
+    '''
+    global _block_size
+    _block_size = None
+
+
+def isPrefetchEnabled():
+    '''
+    :returns: **bool** whether new ciphers are being wrapped
+    '''
+    return _block_size is not None
+
+
+def wrapCipher(cipher):
+    '''Return *cipher* wrapped in a PrefetchCipher if prefetching is
+    enabled, otherwise return *cipher* unchanged.
+
+    :param Crypto.Cipher.AES.AESCipher cipher: CTR mode cipher to wrap
+    :returns: **PrefetchCipher** or *cipher*
+    '''
+    if _block_size is None:
+        return cipher
+    return PrefetchCipher(cipher, _block_size)
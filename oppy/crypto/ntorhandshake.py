@@ -8,7 +8,8 @@
     key derivations and crypto operations. NTorHandshakes objects do the
     following jobs:
 
-        - Create temporary public/private Curve 25519 keys
+        - Create temporary public/private Curve 25519 keys (or take them
+          from the keypair pool, see :mod:`oppy.crypto.keypool`)
         - Create the initial onion skin
         - Derive key material from a Created2 or Extended2 cell
         - Create and initialize a RelayCrypto object, ready for use by
@@ -16,21 +17,26 @@
           ciphers and SHA-1 running digests, initialized with the derived key
           material)
 
+    Key derivation normally runs on the reactor thread. When threaded
+    derivation is enabled (see enableThreadedDerivation()), NTorFSMs call
+    deriveRelayCryptoInThread() instead, which runs the derivation in the
+    reactor's thread pool and returns a Deferred. Both crypto backends do
+    their Curve25519 work through cffi, which releases the GIL, so
+    derivations for several circuits can run at once while the reactor
+    keeps forwarding cells.
+
 
 .. warning:: NTorHandshakes do not safely erase/clear memory of private keys.
 
 '''
-import base64
 import hashlib
-import hkdf
 
-from nacl import bindings
-from nacl.public import PrivateKey, PublicKey
+from twisted.internet import threads
 
-from oppy.crypto import util
+from oppy.crypto import backend, keypool, keystream, util
 from oppy.crypto.exceptions import KeyDerivationFailed
 from oppy.crypto.relaycrypto import RelayCrypto
-from oppy.util import tools
+from oppy.netstatus.handshakematerial import getHandshakeMaterial
 
 
 PROTOID     = "ntor-curve25519-sha256-1"
@@ -46,6 +52,30 @@ KEY_LEN                 = 16
 NTOR_ONIONSKIN_LEN      = (2 * CURVE25519_PUBKEY_LEN + DIGEST_LEN)
 
 
+_threaded_derivation = False
+
+
+def enableThreadedDerivation():
+    '''Run ntor key derivations made from now on in the reactor's thread
+    pool.
+    '''
+    global _threaded_derivation
+    _threaded_derivation = True
+
+
+def disableThreadedDerivation():
+    '''Run ntor key derivations on the reactor thread.'''
+    global _threaded_derivation
+    _threaded_derivation = False
+
+
+def isThreadedDerivationEnabled():
+    '''
+    :returns: **bool** whether ntor key derivations run in worker threads
+    '''
+    return _threaded_derivation
+
+
 class NTorHandshake(object):
 
     def __init__(self, relay):
@@ -53,10 +83,13 @@ class NTorHandshake(object):
         :param stem.descriptor.server_descriptor.RelayDescriptor relay:
             the relay that we're doing an ntor handshake with
         '''
-        self._signing_key = tools.signingKeyToSHA1(relay.signing_key)
-        self._ntor_onion_key = base64.b64decode(relay.ntor_onion_key)
-        self._secret_key = PrivateKey.generate()
-        self._public_key = self._secret_key.public_key
+        material = getHandshakeMaterial(relay)
+        self._signing_key = material.identity_digest
+        self._ntor_onion_key = material.ntor_onion_key
+        self._backend = backend.getBackend()
+        secret_key, self._public_key = keypool.takeKeypair()
+        # kept only by this handshake, and gone along with it
+        self._secret_key = self._backend.loadCurve25519Key(secret_key)
         self.is_bad = False
 
     def createOnionSkin(self):
@@ -68,7 +101,7 @@ class NTorHandshake(object):
         '''
         b  = self._signing_key
         b += self._ntor_onion_key
-        b += bytes(self._public_key)
+        b += self._public_key
 
         assert len(b) == NTOR_ONIONSKIN_LEN
         return b
@@ -91,9 +124,9 @@ class NTorHandshake(object):
         AUTH = hdata[CURVE25519_PUBKEY_LEN: CURVE25519_PUBKEY_LEN + DIGEST_LEN]
 
         secret_input = self._buildSecretInput(relay_pubkey)
-        verify = util.makeHMACSHA256(msg=secret_input, key=T_VERIFY)
+        verify = self._backend.makeHMACSHA256(msg=secret_input, key=T_VERIFY)
         auth_input = self._buildAuthInput(verify, relay_pubkey)
-        auth_input = util.makeHMACSHA256(msg=auth_input, key=T_MAC)
+        auth_input = self._backend.makeHMACSHA256(msg=auth_input, key=T_MAC)
 
         self.is_bad |= util.constantStrEqual(AUTH, auth_input)
 
@@ -105,16 +138,25 @@ class NTorHandshake(object):
 
         return ret
 
+    def deriveRelayCryptoInThread(self, cell):
+        '''Run deriveRelayCrypto() on *cell* in the reactor's thread pool.
+
+        :param cell cell: Created2 cell or Extended2 cell used to derive
+            shared keys
+        :returns: **twisted.internet.defer.Deferred** which fires with an
+            **oppy.crypto.relaycrypto.RelayCrypto** object, or errbacks with
+            KeyDerivationFailed
+        '''
+        return threads.deferToThread(self.deriveRelayCrypto, cell)
+
     def _makeRelayCrypto(self, secret_input):
         '''Derive shared key material using HKDF from secret_input.
 
         :returns: **oppy.crypto.relaycrypto.RelayCrypto** initialized with
             shared key data
         '''
-        prk = hkdf.hkdf_extract(salt=T_KEY, input_key_material=secret_input,
-                                hash=hashlib.sha256)
-        km = hkdf.hkdf_expand(pseudo_random_key=prk, info=M_EXPAND,
-                              length=72, hash=hashlib.sha256)
+        km = self._backend.hkdfSHA256(secret_input, salt=T_KEY,
+                                      info=M_EXPAND, length=72)
 
         df = km[: DIGEST_LEN]
         db = km[DIGEST_LEN : DIGEST_LEN * 2]
@@ -123,8 +165,10 @@ class NTorHandshake(object):
 
         f_digest = hashlib.sha1(df)
         b_digest = hashlib.sha1(db)
-        f_cipher = util.makeAES128CTRCipher(kf)
-        b_cipher = util.makeAES128CTRCipher(kb)
+        f_cipher = self._backend.makeAES128CTRCipher(kf)
+        b_cipher = self._backend.makeAES128CTRCipher(kb)
+        f_cipher = keystream.wrapCipher(f_cipher)
+        b_cipher = keystream.wrapCipher(b_cipher)
 
         return RelayCrypto(forward_digest=f_digest,
                            backward_digest=b_digest,
@@ -145,7 +189,7 @@ class NTorHandshake(object):
         b += self._signing_key
         b += self._ntor_onion_key
         b += relay_pubkey
-        b += bytes(self._public_key)
+        b += self._public_key
         b += PROTOID
         b += SERVER_STR
         return b
@@ -163,7 +207,7 @@ class NTorHandshake(object):
         b += self._scalarMult(self._ntor_onion_key)
         b += self._signing_key
         b += self._ntor_onion_key
-        b += bytes(self._public_key)
+        b += self._public_key
         b += relay_pubkey
         b += PROTOID
         return b
@@ -179,8 +223,6 @@ class NTorHandshake(object):
 
         :returns: **str** result
         '''
-        # args are: exponent, base
-        ret = bindings.crypto_scalarmult(bytes(self._secret_key),
-                                         bytes(PublicKey(base)))
+        ret = self._backend.curve25519(self._secret_key, base)
         self.is_bad |= util.constantStrAllZero(ret)
         return ret
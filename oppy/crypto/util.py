@@ -7,30 +7,37 @@
     Crypto utility functions. Includes:
 
         - Constant time string comparisons
-        - Wrappers around encryption/decryption operations
+        - Wrappers around encryption/decryption operations (the primitives
+          themselves come from the current crypto backend, see
+          :mod:`oppy.crypto.backend`)
         - The "recognized" check for incoming cells
         - A couple methods for verifying TLS certificate properties (signatures
           and times)
 
 '''
-import hashlib
-import hmac
 import struct
 
 from datetime import datetime
 from itertools import izip
 
-import OpenSSL
-
-from Crypto.Cipher import AES
-from Crypto.Util import asn1, Counter
-
 from oppy.cell.cell import Cell
-from oppy.cell.definitions import RECOGNIZED, EMPTY_DIGEST
+from oppy.cell.definitions import (
+    EMPTY_DIGEST,
+    MAX_PAYLOAD_LEN,
+    RECOGNIZED,
+    RELAY_DATA_CMD,
+)
 from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.relay import RelayDataCell
+from oppy.crypto import backend
 from oppy.crypto.exceptions import UnrecognizedCell
 
 
+# position of the digest field in a relay cell's payload
+DIGEST_START = 5
+DIGEST_END = 9
+
+
 def constantStrEqual(str1, str2):
     '''Do a constant-time comparison of str1 and str2, returning **True**
     if they are equal, **False** otherwise.
@@ -77,14 +84,15 @@ def constantStrAllZero(s):
 
 
 def makeAES128CTRCipher(key, initial_value=0):
-    '''Create and return a new AES128-CTR cipher instance.
+    '''Create and return a new AES128-CTR cipher instance from the
+    current crypto backend.
 
     :param str key: key to use for this cipher
     :param initial_value: initial_value to use
-    :returns: **Crypto.Cipher.AES.AES**
+    :returns: AES128-CTR cipher (see
+        :meth:`~oppy.crypto.backend.CryptoBackend.makeAES128CTRCipher`)
     '''
-    ctr = Counter.new(128, initial_value=initial_value)
-    return AES.new(key, AES.MODE_CTR, counter=ctr)
+    return backend.getBackend().makeAES128CTRCipher(key, initial_value)
 
 
 def makeHMACSHA256(msg, key):
@@ -95,8 +103,7 @@ def makeHMACSHA256(msg, key):
     :param str key: key to use
     :returns: **str** HMAC digest
     '''
-    t = hmac.new(msg=msg, key=key, digestmod=hashlib.sha256)
-    return t.digest()
+    return backend.getBackend().makeHMACSHA256(msg, key)
 
 
 def makePayloadWithDigest(payload, digest=EMPTY_DIGEST):
@@ -106,12 +113,11 @@ def makePayloadWithDigest(payload, digest=EMPTY_DIGEST):
     :param str digest: digest to insert
     :returns: **str** payload with digest inserted into correct position
     '''
-    DIGEST_START = 5
-    DIGEST_END = 9
     return payload[:DIGEST_START] + digest + payload[DIGEST_END:]
 
 
-def encryptCellToTarget(cell, crypt_path, target=2, early=False):
+def encryptCellToTarget(cell, crypt_path, target=2, early=False,
+                        headers=None):
     '''Encrypt *cell* to the *target* relay in *crypt_path* and update
     the appropriate forward digest.
 
@@ -121,21 +127,118 @@ def encryptCellToTarget(cell, crypt_path, target=2, early=False):
     :param int target: target node to encrypt to
     :param bool early: if **True**, use a RELAY_EARLY cmd instead of a
         RELAY cmd
+    :param oppy.cell.fixedlen.RelayHeaderCache headers: the sending
+        circuit's cached headers. If **None**, a new header is built.
     :returns: **oppy.cell.fixedlen.EncryptedCell**
     '''
     assert target >= 0 and target < len(crypt_path)
     assert cell.rheader.digest == EMPTY_DIGEST
 
     # 1) update f_digest with cell payload bytes
-    crypt_path[target].forward_digest.update(cell.getPayload())
+    payload = bytearray(MAX_PAYLOAD_LEN)
+    cell.writePayloadInto(payload)
+    crypt_path[target].forward_digest.update(payload)
     # 2) insert first four bytes into new digest position
     cell.rheader.digest = crypt_path[target].forward_digest.digest()[:4]
+    payload[DIGEST_START:DIGEST_END] = cell.rheader.digest
     # 3) encrypt payload
-    payload = cell.getPayload()
+    payload = str(payload)
     for node in xrange(target + 1):
         payload = crypt_path[node].forward_cipher.encrypt(payload)
     # 4) return encrypted relay cell with new payload
-    return EncryptedCell.make(cell.header.circ_id, payload, early=early)
+    if headers is not None:
+        return EncryptedCell.fromCache(headers, payload, early=early)
+    return EncryptedCell.make(cell.header.circ_id, payload,
+                              link_version=cell.header.link_version,
+                              early=early)
+
+
+def encryptCellsToTarget(cells, crypt_path, target=2, early=False,
+                         headers=None):
+    '''Encrypt each cell in *cells* to the *target* relay in *crypt_path*,
+    in order, and update the appropriate forward digest.
+
+    The result is byte-for-byte the same as calling encryptCellToTarget()
+    on each cell in turn. Digests still have to be computed one cell at a
+    time, but since each hop's forward cipher is a continuous AES-CTR
+    keystream, the payloads are joined and each layer of encryption is
+    applied with a single encrypt() call per hop.
+
+    :param list cells: cells to encrypt, in the order they will be sent
+    :param list crypt_path: list of RelayCrypto instances available for
+        encryption
+    :param int target: target node to encrypt to
+    :param bool early: if **True**, use a RELAY_EARLY cmd instead of a
+        RELAY cmd
+    :param oppy.cell.fixedlen.RelayHeaderCache headers: the sending
+        circuit's cached headers. If **None**, new headers are built.
+    :returns: **list, oppy.cell.fixedlen.EncryptedCell** encrypted cells,
+        in the same order as *cells*
+    '''
+    payloads = encryptPayloadsToTarget(cells, crypt_path, target)
+    return makeEncryptedCells(cells, payloads, early, headers)
+
+
+def encryptPayloadsToTarget(cells, crypt_path, target=2):
+    '''Set the digest of each cell in *cells* and return all of their
+    payloads, joined and encrypted to the *target* relay in *crypt_path*.
+
+    This is the crypto half of encryptCellsToTarget(). It only touches
+    *cells*, the strings it builds and the forward ciphers and digests in
+    *crypt_path*, so it's safe to run outside the reactor thread as long
+    as nothing else uses those at the same time.
+
+    :param list cells: cells to encrypt, in the order they will be sent
+    :param list crypt_path: list of RelayCrypto instances available for
+        encryption
+    :param int target: target node to encrypt to
+    :returns: **str** the encrypted payloads, back to back
+    '''
+    assert target >= 0 and target < len(crypt_path)
+
+    forward_digest = crypt_path[target].forward_digest
+    # 1) write every payload into one buffer, updating f_digest and
+    #    inserting each cell's digest as we go
+    buf = bytearray(MAX_PAYLOAD_LEN * len(cells))
+    for i, cell in enumerate(cells):
+        assert cell.rheader.digest == EMPTY_DIGEST
+        start = i * MAX_PAYLOAD_LEN
+        cell.writePayloadInto(buf, start)
+        forward_digest.update(buffer(buf, start, MAX_PAYLOAD_LEN))
+        cell.rheader.digest = forward_digest.digest()[:4]
+        buf[start + DIGEST_START:start + DIGEST_END] = cell.rheader.digest
+    # 2) encrypt all payloads at once, one hop at a time
+    payloads = str(buf)
+    for node in xrange(target + 1):
+        payloads = crypt_path[node].forward_cipher.encrypt(payloads)
+    return payloads
+
+
+def makeEncryptedCells(cells, payloads, early=False, headers=None):
+    '''Split the output of encryptPayloadsToTarget() back into encrypted
+    relay cells.
+
+    :param list cells: the cells that were encrypted
+    :param str payloads: their encrypted payloads, back to back
+    :param bool early: if **True**, use a RELAY_EARLY cmd instead of a
+        RELAY cmd
+    :param oppy.cell.fixedlen.RelayHeaderCache headers: the sending
+        circuit's cached headers. If **None**, new headers are built.
+    :returns: **list, oppy.cell.fixedlen.EncryptedCell** encrypted cells,
+        in the same order as *cells*
+    '''
+    encrypted = []
+    for i, cell in enumerate(cells):
+        start = i * MAX_PAYLOAD_LEN
+        payload = payloads[start:start + MAX_PAYLOAD_LEN]
+        if headers is not None:
+            encrypted.append(EncryptedCell.fromCache(headers, payload,
+                                                     early=early))
+        else:
+            encrypted.append(EncryptedCell.make(
+                cell.header.circ_id, payload,
+                link_version=cell.header.link_version, early=early))
+    return encrypted
 
 
 def cellRecognized(payload, relay_crypto):
@@ -150,19 +253,7 @@ def cellRecognized(payload, relay_crypto):
     :returns: **bool** **True** if this payload is recognized, **False**
         otherwise
     '''
-    test_payload = payload
-    recognized = test_payload[2:4]
-    digest = test_payload[5:9]
-    test_payload = makePayloadWithDigest(test_payload)
-
-    if recognized != RECOGNIZED:
-        return False
-
-    test_digest = relay_crypto.backward_digest.copy()
-    test_digest.update(test_payload)
-    # no danger of timing attack here since we just
-    # drop the cell if it's not recognized
-    return test_digest.digest()[:4] == digest
+    return _testDigest(payload, 0, relay_crypto.backward_digest) is not None
 
 
 def decryptCellUntilRecognized(cell, crypt_path, origin=2):
@@ -180,34 +271,188 @@ def decryptCellUntilRecognized(cell, crypt_path, origin=2):
     '''
     assert 0 <= origin <= 2, 'We can only handle 3-hop paths'
 
-    recognized = False
     payload = cell.getPayload()
     for node in xrange(len(crypt_path)):
-        relay_crypto = crypt_path[node]
-        payload = relay_crypto.backward_cipher.decrypt(payload)
-        if cellRecognized(payload, relay_crypto):
-            recognized = True
-            origin = node
-            break
+        payload = crypt_path[node].backward_cipher.decrypt(payload)
+        if _recognizedAt(payload, 0, crypt_path, node):
+            return (_parseDecrypted(cell, payload, 0), node)
+
+    raise UnrecognizedCell()
+
+
+def decryptCellsUntilRecognized(cells, crypt_path):
+    '''Decrypt each cell in *cells* until it is recognized or we've tried
+    all RelayCrypto's in *crypt_path*.
+
+    The result is the same as calling decryptCellUntilRecognized() on each
+    cell in turn, and the ciphers and digests in *crypt_path* are left in
+    the same state. Instead of decrypting one cell at a time, every cell
+    that's still unrecognized is decrypted by the next hop in one call over
+    a single buffer. Recognized payloads are checked and parsed in place,
+    without building zero-digest copies or reconstructed cell strings
+    (except for relay cells other than RELAY_DATA, which still go through
+    :meth:`~oppy.cell.cell.Cell.parse`).
+
+    :param list cells: encrypted cells to decrypt, in the order they were
+        received
+    :param list, oppy.crypto.relaycrypto.RelayCrypto crypt_path: list of
+        RelayCrypto instances to use for decryption
+    :returns: **list** with a (cell, origin) tuple for each recognized
+        cell, or **None** for each cell that wasn't recognized by any
+        hop, in the same order as *cells*
+    '''
+    data = ''.join(cell.getPayload() for cell in cells)
+    results = decryptPayloadsUntilRecognized(data, len(cells), crypt_path)
+    return parseDecryptedPayloads(cells, results)
+
+
+def decryptPayloadsUntilRecognized(data, count, crypt_path):
+    '''Decrypt the *count* back to back payloads in *data* until each is
+    recognized or we've tried all RelayCrypto's in *crypt_path*.
+
+    This is the crypto half of decryptCellsUntilRecognized(). It only
+    touches strings and the backward ciphers and digests in *crypt_path*,
+    so it's safe to run outside the reactor thread as long as nothing else
+    uses those at the same time.
 
-    if recognized:
-        updated_payload = makePayloadWithDigest(payload)
-        crypt_path[origin].backward_digest.update(updated_payload)
-        if cell.header.link_version < 4:
-            cid = struct.pack('!H', cell.header.circ_id)
+    :param str data: encrypted payloads, back to back
+    :param int count: number of payloads in *data*
+    :param list, oppy.crypto.relaycrypto.RelayCrypto crypt_path: list of
+        RelayCrypto instances to use for decryption
+    :returns: **list** with a (decrypted_data, start, origin) tuple for
+        each recognized payload, where the payload is at *start* in
+        *decrypted_data*, or **None** for each payload that wasn't
+        recognized by any hop
+    '''
+    results = [None] * count
+    pending = range(count)
+    for node in xrange(len(crypt_path)):
+        if not pending:
+            break
+        data = crypt_path[node].backward_cipher.decrypt(data)
+        remaining = []
+        for k, i in enumerate(pending):
+            start = k * MAX_PAYLOAD_LEN
+            if _recognizedAt(data, start, crypt_path, node):
+                results[i] = (data, start, node)
+            else:
+                remaining.append(k)
+        # only payloads that are still unrecognized go on to the next hop
+        if len(remaining) < len(pending):
+            data = ''.join(data[k * MAX_PAYLOAD_LEN:(k + 1) * MAX_PAYLOAD_LEN]
+                           for k in remaining)
+            pending = [pending[k] for k in remaining]
+    return results
+
+
+def parseDecryptedPayloads(cells, results):
+    '''Build the decrypted relay cells for the output of
+    decryptPayloadsUntilRecognized().
+
+    :param list cells: the encrypted cells the payloads came from
+    :param list results: output of decryptPayloadsUntilRecognized()
+    :returns: **list** with a (cell, origin) tuple for each recognized
+        cell, or **None** for each cell that wasn't recognized
+    '''
+    parsed = []
+    for cell, result in izip(cells, results):
+        if result is None:
+            parsed.append(None)
         else:
-            cid = struct.pack('!I', cell.header.circ_id)
-        cmd = struct.pack('!B', cell.header.cmd)
+            data, start, origin = result
+            parsed.append((_parseDecrypted(cell, data, start), origin))
+    return parsed
+
+
+def _testDigest(data, start, backward_digest):
+    '''Return a copy of *backward_digest* updated with the decrypted
+    payload at *start* in *data* if that payload is recognized, or **None**
+    if it isn't.
+
+    The recognized field is checked before any digest or string work is
+    done, since most payloads fail that check at every hop but one. The
+    digest is computed over the payload in pieces rather than over a copy
+    with its digest field zeroed.
+
+    .. note:: See tor-spec Section 6.1 for details about what it means for a
+        cell to be *recognized*.
+
+    :param str data: decrypted payload(s)
+    :param int start: offset of the payload to check in *data*
+    :param backward_digest: running backward digest of the hop that may
+        have sent this payload
+    :returns: updated copy of *backward_digest*, or **None**
+    '''
+    if data[start + 2:start + 4] != RECOGNIZED:
+        return None
+
+    test_digest = backward_digest.copy()
+    test_digest.update(buffer(data, start, DIGEST_START))
+    test_digest.update(EMPTY_DIGEST)
+    test_digest.update(buffer(data, start + DIGEST_END,
+                              MAX_PAYLOAD_LEN - DIGEST_END))
+    # no danger of timing attack here since we just
+    # drop the cell if it's not recognized
+    if test_digest.digest()[:4] != data[start + DIGEST_START:
+                                        start + DIGEST_END]:
+        return None
+    return test_digest
 
-        dec = Cell.parse(cid + cmd + payload)
-        return (dec, origin)
+
+def _recognizedAt(data, start, crypt_path, node):
+    '''Check whether the decrypted payload at *start* in *data* is
+    recognized by hop *node*, and if it is, advance that hop's backward
+    digest past it.
+
+    The digest that proved the payload recognized already includes it, so
+    it replaces the hop's running digest in *crypt_path* instead of the
+    payload being hashed a second time.
+
+    :param str data: decrypted payload(s)
+    :param int start: offset of the payload to check in *data*
+    :param list, oppy.crypto.relaycrypto.RelayCrypto crypt_path: list of
+        RelayCrypto instances used for decryption
+    :param int node: index of the hop that may have sent this payload
+    :returns: **bool** **True** if this payload is recognized, **False**
+        otherwise
+    '''
+    relay_crypto = crypt_path[node]
+    test_digest = _testDigest(data, start, relay_crypto.backward_digest)
+    if test_digest is None:
+        return False
+    crypt_path[node] = relay_crypto._replace(backward_digest=test_digest)
+    return True
+
+
+def _parseDecrypted(cell, data, start):
+    '''Build the concrete RelayCell for the recognized payload at *start*
+    in *data*.
+
+    :param oppy.cell.fixedlen.EncryptedCell cell: the encrypted cell this
+        payload came from
+    :param str data: decrypted payload(s)
+    :param int start: offset of the payload in *data*
+    :returns: the concrete RelayCell type of this decrypted cell
+    '''
+    header = cell.header
+    # data cells are by far the most common, so skip the generic
+    # parsing path for them
+    if ord(data[start]) == RELAY_DATA_CMD:
+        return RelayDataCell.fromPayload(header.circ_id, header.cmd,
+                                         buffer(data, start, MAX_PAYLOAD_LEN),
+                                         header.link_version)
+    if header.link_version < 4:
+        cid = struct.pack('!H', header.circ_id)
     else:
-        raise UnrecognizedCell()
+        cid = struct.pack('!I', header.circ_id)
+    cmd = struct.pack('!B', header.cmd)
+    payload = data[start:start + MAX_PAYLOAD_LEN]
+    return Cell.parse(cid + cmd + payload, link_version=header.link_version)
 
 
 def verifyCertSig(id_cert, cert_to_verify, algo='sha1'):
     '''Verify that the SSL certificate *id_cert* has signed the TLS cert
-    *cert_to_verify*.
+    *cert_to_verify*, using the current crypto backend.
 
     :param id_cert: Identification Certificate
     :type id_cert: OpenSSL.crypto.X509
@@ -219,29 +464,18 @@ def verifyCertSig(id_cert, cert_to_verify, algo='sha1'):
     :returns: **bool** **True** if the signature of *cert_to_verify* can be
         verified from *id_cert*, **False** otherwise
     '''
-    cert_to_verify_ASN1 = OpenSSL.crypto.dump_certificate(
-                                OpenSSL.crypto.FILETYPE_ASN1, cert_to_verify)
-
-    der = asn1.DerSequence()
-    der.decode(cert_to_verify_ASN1)
-    cert_to_verify_DER = der[0]
-    cert_to_verify_ALGO = der[1]
-    cert_to_verify_SIG = der[2]
+    return backend.getBackend().verifyCertSig(id_cert, cert_to_verify, algo)
 
-    sig_DER = asn1.DerObject()
-    sig_DER.decode(cert_to_verify_SIG)
 
-    sig = sig_DER.payload
+def certValidityTimes(cert):
+    '''Return the notBefore and notAfter times of TLS certificate *cert*.
 
-    # first byte is number of unused bytes. should be zero
-    assert sig[0] == '\x00'
-    sig = sig[1:]
-
-    try:
-        OpenSSL.crypto.verify(id_cert, sig, cert_to_verify_DER, algo)
-        return True
-    except OpenSSL.crypto.Error:
-        return False
+    :param OpenSSL.crypto.X509 cert: TLS Certificate to get times of
+    :returns: **tuple, datetime.datetime** (notBefore, notAfter)
+    '''
+    validAfter = datetime.strptime(cert.get_notBefore(), '%Y%m%d%H%M%SZ')
+    validUntil = datetime.strptime(cert.get_notAfter(), '%Y%m%d%H%M%SZ')
+    return validAfter, validUntil
 
 
 # XXX should we check that the time is not later than the current time?
@@ -254,6 +488,5 @@ def validCertTime(cert):
         **False** otherwise
     '''
     now = datetime.now()
-    validAfter = datetime.strptime(cert.get_notBefore(), '%Y%m%d%H%M%SZ')
-    validUntil = datetime.strptime(cert.get_notAfter(), '%Y%m%d%H%M%SZ')
+    validAfter, validUntil = certValidityTimes(cert)
     return validAfter < now < validUntil
@@ -0,0 +1,161 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    An optional pipeline that moves circuits' bulk cell crypto off the
+    reactor thread.
+
+    Normally every circuit encrypts and decrypts its cells on the reactor
+    thread, so a busy oppy process can only ever use one core. When worker
+    crypto is enabled (see enableWorkerCrypto()), each open circuit sends
+    batches of outbound cells and bursts of inbound cells to a dedicated
+    thread pool instead. The reactor still builds the cells, frames the
+    encrypted payloads and dispatches decrypted cells; the worker threads
+    only run AES-CTR and the running SHA-1 digests.
+
+    A circuit's ciphers and digests are sequential, so a circuit never has
+    more than one job in flight in each direction. Each direction gets an
+    OrderedCryptoQueue, which runs its jobs one at a time in the order they
+    were submitted and hands the results back to the reactor in that same
+    order. Different circuits (and the two directions of one circuit) run
+    in parallel.
+
+    This only helps when the crypto releases the GIL while it runs, which
+    the *openssl* crypto backend does and the *pycrypto* one does not (see
+    :mod:`oppy.crypto.backend`).
+
+    .. warning:: Worker crypto can't be used together with keystream
+        prefetching (:mod:`oppy.crypto.keystream`), since prefetched
+        ciphers are topped up from the reactor thread.
+
+'''
+import functools
+
+from collections import deque
+
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+
+DEFAULT_THREADS = 4
+
+_threadpool = None
+
+
+class OrderedCryptoQueue(object):
+    '''Runs crypto jobs for one direction of one circuit in a worker
+    thread, one at a time and in order.'''
+
+    def __init__(self, runInThread=None):
+        '''
+        :param runInThread: function that runs func(\*args) in a worker
+            thread and returns a Deferred that fires with its result.
+            Defaults to running jobs on the worker crypto thread pool that's
+            running when the queue is made.
+        '''
+        if runInThread is None:
+            runInThread = functools.partial(_runInThread, _threadpool)
+        self._runInThread = runInThread
+        self._jobs = deque()
+        self._running = False
+        self._stopped = False
+
+    def submit(self, func, *args):
+        '''Run func(\*args) in a worker thread after every job submitted
+        before it has finished.
+
+        :param func: function to run
+        :returns: **twisted.internet.defer.Deferred** that fires in the
+            reactor thread with func's result
+        '''
+        d = defer.Deferred()
+        if self._stopped:
+            return d
+        self._jobs.append((func, args, d))
+        if self._running is False:
+            self._runNext()
+        return d
+
+    def _runNext(self):
+        if not self._jobs or self._stopped:
+            self._running = False
+            return
+        self._running = True
+        func, args, d = self._jobs.popleft()
+        job = self._runInThread(func, *args)
+        job.addBoth(self._jobDone, d)
+
+    def _jobDone(self, result, d):
+        # a stopped queue's circuit is gone, so its results are dropped
+        if self._stopped is False:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        self._runNext()
+
+    def stop(self):
+        '''Drop every job that hasn't started yet, and never fire the
+        Deferred of a job that's still running.'''
+        self._stopped = True
+        self._jobs.clear()
+
+    def __len__(self):
+        return len(self._jobs) + (1 if self._running else 0)
+
+
+def _runInThread(threadpool, func, *args):
+    # a stopped pool would never run the job, so the circuits that were
+    # using it finish their crypto on the reactor thread
+    if threadpool is None or threadpool.joined is True:
+        return defer.maybeDeferred(func, *args)
+    from twisted.internet import reactor
+    return threads.deferToThreadPool(reactor, threadpool, func, *args)
+
+
+def enableWorkerCrypto(num_threads=DEFAULT_THREADS):
+    '''Start moving circuits' bulk cell crypto to a pool of *num_threads*
+    worker threads.
+
+    Only circuits that open after this is called use the worker threads.
+
+    :param int num_threads: number of worker threads
+    '''
+    global _threadpool
+    from twisted.internet import reactor
+    from twisted.python.threadpool import ThreadPool
+
+    disableWorkerCrypto()
+    _threadpool = ThreadPool(num_threads, num_threads, name='oppy-crypto')
+    _threadpool.start()
+    reactor.addSystemEventTrigger('during', 'shutdown', _threadpool.stop)
+
+
+def disableWorkerCrypto():
+    '''Stop the worker threads. Circuits that open after this is called do
+    all of their crypto on the reactor thread, and so do circuits that were
+    already using the worker threads, once their running jobs finish.'''
+    global _threadpool
+    if _threadpool is not None:
+        _threadpool.stop()
+    _threadpool = None
+
+
+def isWorkerCryptoEnabled():
+    '''
+    :returns: **bool** **True** if new circuits should do their bulk cell
+        crypto in worker threads
+    '''
+    return _threadpool is not None
+
+
+def makeQueue():
+    '''
+    :returns: :class:`~oppy.crypto.workers.OrderedCryptoQueue` for a new
+        circuit, or **None** if worker crypto isn't enabled
+    '''
+    if _threadpool is None:
+        return None
+    return OrderedCryptoQueue()
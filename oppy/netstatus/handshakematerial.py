@@ -0,0 +1,61 @@
+# Copyright 2014, 2015, Nik Kinkel
+# See LICENSE for licensing information
+
+'''
+.. topic:: Details
+
+    Every circuit through a relay needs the same few values from the
+    relay's descriptor: the SHA-1 digest of its identity (signing) key,
+    its decoded ntor onion key, and the IPv4/IPv6 and legacy link
+    specifiers that go in the Extend2 cells extending to it.
+
+    NetStatus computes these once per descriptor, when descriptors are
+    loaded, and attaches them to each RelayDescriptor as its
+    *handshake_material* attribute. NTorHandshakes and NTorFSMs ask
+    getHandshakeMaterial() for them, so building a circuit through a relay
+    NetStatus already knows about is just attribute lookups. Relays
+    without precomputed material (e.g. descriptors that didn't come from
+    NetStatus) have theirs computed on the spot.
+
+'''
+import base64
+
+from collections import namedtuple
+
+from oppy.cell.util import LinkSpecifier
+
+
+HandshakeMaterial = namedtuple('HandshakeMaterial', ('identity_digest',
+                                                     'ntor_onion_key',
+                                                     'link_specifiers'))
+
+
+def makeHandshakeMaterial(relay):
+    '''Compute the handshake material for *relay*.
+
+    :param stem.descriptor.server_descriptor.RelayDescriptor relay: relay
+        to compute handshake material for
+    :returns: :class:`~oppy.netstatus.handshakematerial.HandshakeMaterial`
+    '''
+    legacy = LinkSpecifier(relay, legacy=True)
+    if relay.ntor_onion_key is None:
+        ntor_onion_key = None
+    else:
+        ntor_onion_key = base64.b64decode(relay.ntor_onion_key)
+    return HandshakeMaterial(identity_digest=legacy.lspec,
+                             ntor_onion_key=ntor_onion_key,
+                             link_specifiers=(LinkSpecifier(relay), legacy))
+
+
+def getHandshakeMaterial(relay):
+    '''Return the handshake material for *relay*, precomputed if NetStatus
+    has attached it.
+
+    :param stem.descriptor.server_descriptor.RelayDescriptor relay: relay
+        to get handshake material for
+    :returns: :class:`~oppy.netstatus.handshakematerial.HandshakeMaterial`
+    '''
+    material = getattr(relay, 'handshake_material', None)
+    if isinstance(material, HandshakeMaterial):
+        return material
+    return makeHandshakeMaterial(relay)
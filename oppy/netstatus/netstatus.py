@@ -41,7 +41,9 @@ from stem.descriptor import DocumentHandler
 from stem.descriptor.networkstatus import NetworkStatusDocumentV3
 from stem.descriptor.remote import get_authorities
 
+from oppy.cell.exceptions import BadLinkSpecifier
 from oppy.netstatus import definitions as DEF
+from oppy.netstatus.handshakematerial import makeHandshakeMaterial
 
 
 # how long we'll wait before downloading fresh network status documents
@@ -220,6 +222,11 @@ class NetStatus(object):
         adding them here simplifies path selection. 'flags' is a set of
         unicode strings.
 
+        Each RelayDescriptor also gets a 'handshake_material' attribute with
+        the values circuit handshakes need from it, computed once here
+        instead of for every circuit (see
+        :mod:`oppy.netstatus.handshakematerial`).
+
         .. note: This runs in a separate work thread using
             twisted.internet.threads.deferToThread() because parsing tends to
             take a while.
@@ -247,7 +254,13 @@ class NetStatus(object):
                 descriptors[relay.fingerprint] = relay
             # skip any relays not found in the consensus
             except KeyError:
-                pass
+                continue
+            try:
+                relay.handshake_material = makeHandshakeMaterial(relay)
+            # handshakes will compute (and fail on) these values themselves
+            except (BadLinkSpecifier, TypeError, ValueError) as e:
+                msg = "Can't precompute handshake material for {}: {}."
+                logging.debug(msg.format(relay.fingerprint, e))
 
         return descriptors
 
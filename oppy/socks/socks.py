@@ -108,6 +108,21 @@ class OppySOCKSProtocol(Protocol):
         '''
         self.transport.write(data)
 
+    def pauseReading(self):
+        '''Stop reading data from the local client application.
+
+        Called by the attached stream when it has more data waiting than
+        its circuit can take right now.
+        '''
+        self.transport.pauseProducing()
+
+    def resumeReading(self):
+        '''Start reading data from the local client application again.
+
+        Called by the attached stream once its waiting data has drained.
+        '''
+        self.transport.resumeProducing()
+
     def closeFromStream(self):
         '''Lose this transports local connection.
 
@@ -16,6 +16,13 @@
         - Splitting up data to be written to the network into chunks that
           can fit into a RelayData cell
         - Doing some rudimentary flow-control
+        - Pausing the local application when it sends data faster than the
+          circuit can take it
+
+    A stream stops passing data to its circuit while the circuit is paused
+    (see pauseWriting()). Once more than WRITE_QUEUE_HIGH chunks are
+    waiting on its write queue, it stops reading from the local
+    application's socket until no more than WRITE_QUEUE_LOW are left.
 
 '''
 import logging
@@ -29,6 +36,13 @@ from oppy.shared import circuit_manager
 SENDME_THRESHOLD = 450
 STREAM_WINDOW_INIT = 500
 STREAM_WINDOW_SIZE = 50
+# pause and resume reading from the local application at these many chunks
+# waiting to be written
+WRITE_QUEUE_HIGH = 128
+WRITE_QUEUE_LOW = 32
+# put on a stream's write queue once the local application is done with
+# it, so the stream is unregistered after the data in front of it is sent
+_END_OF_DATA = object()
 
 
 class Stream(object):
@@ -50,6 +64,12 @@ class Stream(object):
         self.socks = socks
         self._deliver_window = STREAM_WINDOW_INIT
         self._package_window = STREAM_WINDOW_INIT
+        # True once the exit has connected this stream
+        self._connected = False
+        # True while our circuit can't take more data
+        self._write_paused = False
+        # True while we've asked the SOCKS protocol to stop reading
+        self._socks_paused = False
         self.circuit = None
         self._circuit_request = circuit_manager.requestOpenCircuit(self)
         self._circuit_request.addCallback(self._registerNewStream)
@@ -102,12 +122,19 @@ class Stream(object):
         Called when the local application attached to this stream sends data
         to the network.
 
+        If too much data is now waiting to be written, ask the SOCKS
+        protocol to stop reading from the local application.
+
         :param str data: data passed in from this stream's attached SOCKS
             protocol to write to this stream's circuit
         '''
         chunks = Stream._chunkRelayData(data)
         for chunk in chunks:
             self._write_queue.put(chunk)
+        if self._socks_paused is False and \
+                len(self._write_queue.pending) > WRITE_QUEUE_HIGH:
+            self._socks_paused = True
+            self.socks.pauseReading()
 
     def _pollWriteQueue(self):
         '''Pull a chunk of data from this stream's write queue and, when the
@@ -124,14 +151,42 @@ class Stream(object):
         self._read_deferred.addCallback(self._recvData)
 
     def _writeData(self, data):
-        '''Write *data* to the circuit attached to this stream and decrement
-        the packaging window.
+        '''Write *data*, and any other data already waiting on the write
+        queue (up to the number of chunks the package window allows), to
+        the circuit attached to this stream and decrement the packaging
+        window.
+
+        If the circuit has paused this stream in the meantime, put the data
+        back on the write queue instead. If the SOCKS protocol was paused
+        and the write queue has drained enough, resume it. Once the end of
+        the local application's data is reached, unregister from the
+        circuit.
 
         :param str data: data received from attached SOCKS protocol instance
             to be written to the attached circuit
         '''
+        if self._write_paused is True:
+            self._write_queue.pending.insert(0, data)
+            self._write_deferred = None
+            return
+        if data is _END_OF_DATA:
+            self._write_deferred = None
+            self.circuit.unregisterStream(self)
+            return
         self.circuit.writeData(data, self.stream_id)
-        self._decPackageWindow()
+        count = 1
+        # drain what's already waiting here rather than through one
+        # (synchronously fired) deferred per chunk
+        pending = self._write_queue.pending
+        while pending and pending[0] is not _END_OF_DATA and \
+                count < self._package_window and \
+                self._write_paused is False:
+            self.circuit.writeData(pending.pop(0), self.stream_id)
+            count += 1
+        if self._socks_paused is True and len(pending) <= WRITE_QUEUE_LOW:
+            self._socks_paused = False
+            self.socks.resumeReading()
+        self._decPackageWindow(count)
 
     def _recvData(self, data):
         '''Receive *data* from the attached circuit and hand off to the
@@ -159,16 +214,19 @@ class Stream(object):
             self._deliver_window += STREAM_WINDOW_SIZE
         self._pollReadQueue()
 
-    def _decPackageWindow(self):
-        '''Decrement this stream's package window and, if we still can,
-        listen for more data from the attached SOCKS protocol instance.
+    def _decPackageWindow(self, count=1):
+        '''Decrement this stream's package window by *count* chunks and, if
+        we still can, listen for more data from the attached SOCKS protocol
+        instance.
 
         If the package window <= 0, we need to wait until we receive a
         sendme cell before writing anymore local data from this stream to
         the attached circuit.
+
+        :param int count: number of chunks just written
         '''
-        self._package_window -= 1
-        if self._package_window > 0:
+        self._package_window -= count
+        if self._package_window > 0 and self._write_paused is False:
             self._pollWriteQueue()
         else:
             self._write_deferred = None
@@ -183,7 +241,25 @@ class Stream(object):
         '''
         self._package_window += STREAM_WINDOW_SIZE
         # if we were buffering, we're now free to send data again
-        if self._write_deferred is None and self._package_window > 0:
+        if self._write_deferred is None and self._package_window > 0 and \
+                self._write_paused is False:
+            self._pollWriteQueue()
+
+    def pauseWriting(self):
+        '''Stop passing data to the attached circuit.
+
+        Called by the attached circuit when its connection is congested.
+        '''
+        self._write_paused = True
+
+    def resumeWriting(self):
+        '''Start passing data to the attached circuit again.
+
+        Called by the attached circuit once its connection has drained.
+        '''
+        self._write_paused = False
+        if self._connected is True and self._write_deferred is None and \
+                self._package_window > 0:
             self._pollWriteQueue()
 
     def streamConnected(self):
@@ -193,7 +269,9 @@ class Stream(object):
         Called when the attached circuit receives a RelayConnected cell for
         this stream's RelayBegin request.
         '''
-        self._pollWriteQueue()
+        self._connected = True
+        if self._write_paused is False:
+            self._pollWriteQueue()
 
     def closeFromCircuit(self):
         '''Called when this stream is closed by the circuit.
@@ -215,9 +293,13 @@ class Stream(object):
         stream.
 
         Request that circuit send a RelayEnd cell on our behalf and notify
-        circuit we're now closed.
+        circuit we're now closed. If data from the local application is
+        still waiting to be written, do this once it has been.
         '''
         msg = "Stream {} on circuit {} closing from SOCKS."
         msg = msg.format(self.stream_id, self.circuit.circuit_id)
         logging.debug(msg)
-        self.circuit.unregisterStream(self)
+        if self._connected is True:
+            self._write_queue.put(_END_OF_DATA)
+        else:
+            self.circuit.unregisterStream(self)
@@ -0,0 +1,186 @@
+import unittest
+
+from oppy.cell.cell import Cell
+from oppy.cell.exceptions import NotEnoughBytes, UnknownCellCommand
+from oppy.cell.fixedlen import (
+    DestroyCell,
+    EncryptedCell,
+    FixedLenCell,
+    PaddingCell,
+)
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+from oppy.cell.relay import (
+    RelayBeginCell,
+    RelayDataCell,
+    RelayEndCell,
+    RelaySendMeCell,
+)
+from oppy.cell.varlen import VersionsCell, VPaddingCell
+
+
+class CellParseManyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cells = [
+            EncryptedCell.make(1, '\x01' * MAX_PAYLOAD_LEN),
+            DestroyCell.make(2),
+            EncryptedCell.make(3, '\x02' * MAX_PAYLOAD_LEN, early=True),
+        ]
+        self.data = ''.join(c.getBytes() for c in self.cells)
+
+    def test_parse_many(self):
+        cells, consumed = Cell.parseMany(self.data, encrypted=True)
+        assert cells == self.cells
+        assert consumed == len(self.data)
+
+    def test_parse_many_matches_parse(self):
+        cells, _ = Cell.parseMany(self.data, encrypted=True)
+        for i, cell in enumerate(cells):
+            assert cell == Cell.parse(self.data[i * 512:], encrypted=True)
+
+    def test_parse_many_buffer(self):
+        cells, consumed = Cell.parseMany(buffer(bytearray(self.data)),
+                                         encrypted=True)
+        assert cells == self.cells
+        assert consumed == len(self.data)
+
+    def test_parse_many_partial_cell(self):
+        cells, consumed = Cell.parseMany(self.data[:-1], encrypted=True)
+        assert cells == self.cells[:2]
+        assert consumed == 1024
+
+    def test_parse_many_partial_header(self):
+        cells, consumed = Cell.parseMany(self.data[:513], encrypted=True)
+        assert cells == self.cells[:1]
+        assert consumed == 512
+
+    def test_parse_many_max_cells(self):
+        cells, consumed = Cell.parseMany(self.data, encrypted=True,
+                                         max_cells=2)
+        assert cells == self.cells[:2]
+        assert consumed == 1024
+
+    def test_parse_many_skips_padding(self):
+        data = (PaddingCell.make(0).getBytes() +
+                VPaddingCell.make(0, 10).getBytes() +
+                self.data)
+        cells, consumed = Cell.parseMany(data, encrypted=True)
+        assert cells == self.cells
+        assert consumed == len(data)
+
+    def test_parse_many_varlen(self):
+        versions = VersionsCell.make([3])
+        data = versions.getBytes() + self.data
+        cells, consumed = Cell.parseMany(data, encrypted=True)
+        assert cells == [versions] + self.cells
+        assert consumed == len(data)
+
+    def test_parse_many_varlen_partial(self):
+        data = VersionsCell.make([3]).getBytes()
+        cells, consumed = Cell.parseMany(data[:-1])
+        assert cells == []
+        assert consumed == 0
+
+    def test_parse_many_unencrypted_relay(self):
+        cell = RelayDataCell.make(1, 1, 'data')
+        cells, _ = Cell.parseMany(cell.getBytes())
+        assert len(cells) == 1
+        assert isinstance(cells[0], RelayDataCell)
+        assert cells[0].getBytes() == cell.getBytes()
+
+    def test_parse_many_unknown_cmd(self):
+        self.assertRaises(UnknownCellCommand, Cell.parseMany, '\x00\x01\x77')
+
+    def test_parse_many_bad_link_version(self):
+        self.assertRaises(ValueError, Cell.parseMany, self.data,
+                          link_version=5)
+
+    def test_enough_data_for_varlen_cell(self):
+        data = VersionsCell.make([3]).getBytes()
+        assert Cell.enoughDataForCell(data) is True
+        assert Cell.enoughDataForCell(data[:-1]) is False
+
+
+class EncryptedCellFastPathTests(unittest.TestCase):
+
+    def test_matches_generic_parse(self):
+        data = EncryptedCell.make(5, '\x03' * MAX_PAYLOAD_LEN).getBytes()
+        h = FixedLenCell.Header(circ_id=5, cmd=3, link_version=3)
+        assert Cell.parse(data, encrypted=True) == FixedLenCell._parse(data, h)
+
+    def test_link_version_4(self):
+        cell = EncryptedCell.make(2 ** 20, '\x03' * MAX_PAYLOAD_LEN,
+                                  link_version=4, early=True)
+        data = cell.getBytes()
+        assert Cell.parse(data, link_version=4, encrypted=True) == cell
+        assert Cell.parseMany(data, link_version=4,
+                              encrypted=True) == ([cell], len(data))
+
+    def test_short_data(self):
+        data = EncryptedCell.make(5, '\x03' * MAX_PAYLOAD_LEN).getBytes()
+        self.assertRaises(NotEnoughBytes, Cell.parse, data[:-1],
+                          encrypted=True)
+
+
+class CellSlotsTests(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        cells = [
+            EncryptedCell.make(1, '\x01' * MAX_PAYLOAD_LEN),
+            RelayDataCell.make(1, 1, 'data'),
+            VersionsCell.make([3]),
+        ]
+        for cell in cells:
+            assert not hasattr(cell, '__dict__')
+            assert not hasattr(cell.header, '__dict__')
+        assert not hasattr(cells[1].rheader, '__dict__')
+
+    def test_relay_cell_equality(self):
+        cell = RelayDataCell.make(1, 1, 'data')
+        assert cell == RelayDataCell.make(1, 1, 'data')
+        assert cell != RelayDataCell.make(1, 2, 'data')
+        assert cell != RelayDataCell.make(1, 1, 'atad')
+
+    def test_header_equality(self):
+        h = FixedLenCell.Header(1, 3, 3)
+        assert h == FixedLenCell.Header(1, 3, 3)
+        assert h != FixedLenCell.Header(1, 9, 3)
+        assert h != FixedLenCell.Header(1, 3, 4)
+
+
+class CellWriteIntoTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cells = [
+            EncryptedCell.make(1, '\x01' * MAX_PAYLOAD_LEN),
+            EncryptedCell.make(2 ** 20, '\x01' * MAX_PAYLOAD_LEN,
+                               link_version=4),
+            DestroyCell.make(2),
+            RelayDataCell.make(3, 1, 'data'),
+            RelayDataCell.make(3, 1, 'data', link_version=4),
+            RelaySendMeCell.make(3, stream_id=1),
+            RelayBeginCell.make(3, 1, ('127.0.0.1', 80)),
+            RelayEndCell.make(3, 1),
+            VersionsCell.make([3]),
+        ]
+
+    def test_write_into_matches_get_bytes(self):
+        for cell in self.cells:
+            # start from a dirty buffer to make sure padding is written
+            buf = bytearray('\xff' * 1024)
+            n = cell.writeInto(buf, 7)
+            assert n == len(cell.getBytes())
+            assert str(buf[7:7 + n]) == cell.getBytes()
+            assert buf[:7] == bytearray('\xff' * 7)
+            assert buf[7 + n:] == bytearray('\xff' * (1024 - 7 - n))
+
+    def test_get_payload(self):
+        for cell in self.cells:
+            start, _ = cell.payloadRange()
+            assert cell.getPayload() == cell.getBytes()[start:]
+
+    def test_write_payload_into(self):
+        cell = RelayDataCell.make(3, 1, 'data')
+        buf = bytearray('\xff' * MAX_PAYLOAD_LEN)
+        assert cell.writePayloadInto(buf) == MAX_PAYLOAD_LEN
+        assert str(buf) == cell.getPayload()
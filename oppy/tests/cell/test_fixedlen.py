@@ -14,7 +14,9 @@ from oppy.cell.fixedlen import (
     DestroyCell,
     EncryptedCell,
     NetInfoCell,
+    PackedHeader,
     PaddingCell,
+    RelayHeaderCache,
 )
 from oppy.cell.util import TLVTriple
 from oppy.tests.cell.cellbase import FixedLenTestBase
@@ -290,6 +292,47 @@ class EncryptedCellTests(FixedLenTestBase, unittest.TestCase):
         # "trimmed" arg doesn't make sense for them
         pass
 
+    def test_fromCache(self):
+        headers = RelayHeaderCache(CIRC_ID)
+        payload = "\x00" * 509
+
+        cell = EncryptedCell.fromCache(headers, payload)
+        assert cell == EncryptedCell.make(CIRC_ID, payload)
+        assert cell.header is headers.relay
+        assert cell.getBytes() == encrypted_bytes_good_padded
+
+        cell = EncryptedCell.fromCache(headers, payload, early=True)
+        assert cell == EncryptedCell.make(CIRC_ID, payload, early=True)
+        assert cell.header is headers.relay_early
+
+
+class PackedHeaderTests(unittest.TestCase):
+
+    def test_getBytes(self):
+        for link_version in (3, 4):
+            h = PackedHeader(CIRC_ID, RELAY_CMD, link_version)
+            plain = FixedLenCell.Header(CIRC_ID, RELAY_CMD, link_version)
+            assert h.getBytes() == plain.getBytes()
+
+    def test_writeInto(self):
+        h = PackedHeader(CIRC_ID, RELAY_CMD, 4)
+        buf = bytearray(7)
+        assert h.writeInto(buf, 1) == 5
+        assert str(buf) == "\x00" + h.getBytes() + "\x00"
+
+    def test_equal_to_plain_header(self):
+        h = PackedHeader(CIRC_ID, RELAY_CMD)
+        assert h == FixedLenCell.Header(CIRC_ID, RELAY_CMD)
+        assert FixedLenCell.Header(CIRC_ID, RELAY_CMD) == h
+        assert h != FixedLenCell.Header(CIRC_ID + 1, RELAY_CMD)
+
+    def test_cache_headers(self):
+        headers = RelayHeaderCache(CIRC_ID, link_version=4)
+        assert headers.getHeader() is headers.relay
+        assert headers.getHeader(early=True) is headers.relay_early
+        assert headers.relay == FixedLenCell.Header(CIRC_ID, RELAY_CMD, 4)
+        assert headers.relay_early == FixedLenCell.Header(CIRC_ID, 9, 4)
+
 # NetInfoCell (IPv4 type/length/value) unittests and constant values
 
 NETINFO_CMD = 8
@@ -0,0 +1,108 @@
+import struct
+import unittest
+
+from oppy.cell import pool
+from oppy.cell.cell import Cell
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.relay import RelayDataCell, RelaySendMeCell
+from oppy.cell.pool import CellPool
+
+
+CIRC_ID = 1
+RELAY_CMD = 3
+RELAY_DATA_CMD = 2
+
+data_payload = struct.pack('!B2sH4sH', RELAY_DATA_CMD, '\x00\x00', 5,
+                           '\x01\x02\x03\x04', 4) + 'data'
+data_payload += '\x00' * (509 - len(data_payload))
+
+
+class Thing(object):
+    pass
+
+
+class CellPoolTests(unittest.TestCase):
+
+    def test_acquire_release(self):
+        p = CellPool(Thing)
+        first = p.acquire()
+        p.release(first)
+        assert len(p) == 1
+        assert p.acquire() is first
+        assert len(p) == 0
+        assert (p.hits, p.misses, p.releases) == (1, 1, 1)
+        assert p.hitRate() == 0.5
+
+    def test_hit_rate_empty(self):
+        assert CellPool(Thing).hitRate() == 0.0
+
+    def test_release_full(self):
+        p = CellPool(Thing, max_size=1)
+        p.release(Thing())
+        p.release(Thing())
+        assert len(p) == 1
+        assert p.stats()['discards'] == 1
+
+    def test_reset(self):
+        def reset(thing):
+            thing.data = None
+        p = CellPool(Thing, reset)
+        thing = Thing()
+        thing.data = 'secret'
+        p.release(thing)
+        assert p.acquire().data is None
+
+
+class PoolingTests(unittest.TestCase):
+
+    def setUp(self):
+        pool.enablePooling()
+
+    def tearDown(self):
+        pool.disablePooling()
+
+    def test_disabled(self):
+        pool.disablePooling()
+        assert pool.isPoolingEnabled() is False
+        assert pool.getPool(EncryptedCell) is None
+        assert pool.poolStats() == {}
+        # releasing while disabled is a no-op
+        pool.release(EncryptedCell.fromPayload(CIRC_ID, RELAY_CMD,
+                                               '\x00' * 509))
+
+    def test_encrypted_cell_recycled(self):
+        cell = EncryptedCell.fromPayload(CIRC_ID, RELAY_CMD, '\x00' * 509)
+        pool.release(cell)
+        assert cell.enc_payload is None
+
+        again = EncryptedCell.fromPayload(CIRC_ID + 1, RELAY_CMD,
+                                          '\x01' * 509, 4)
+        assert again is cell
+        assert again == EncryptedCell.make(CIRC_ID + 1, '\x01' * 509, 4)
+        assert pool.poolStats()['EncryptedCell']['hits'] == 1
+
+    def test_relay_data_cell_recycled(self):
+        cell = RelayDataCell.fromPayload(CIRC_ID, RELAY_CMD, data_payload)
+        pool.release(cell)
+        again = RelayDataCell.fromPayload(CIRC_ID, RELAY_CMD, data_payload)
+        assert again is cell
+        header = struct.pack('!HB', CIRC_ID, RELAY_CMD)
+        assert again == Cell.parse(header + data_payload)
+
+    def test_sendme_recycled(self):
+        cell = RelaySendMeCell.make(CIRC_ID, stream_id=3)
+        cell.rheader.digest = '\x01\x02\x03\x04'
+        pool.release(cell)
+        again = RelaySendMeCell.make(CIRC_ID)
+        assert again is cell
+        pool.disablePooling()
+        assert again == RelaySendMeCell.make(CIRC_ID)
+
+
+class RelayDataFromPayloadTests(unittest.TestCase):
+
+    def test_matches_parse(self):
+        cell = RelayDataCell.fromPayload(CIRC_ID, RELAY_CMD, data_payload)
+        header = struct.pack('!HB', CIRC_ID, RELAY_CMD)
+        assert cell == Cell.parse(header + data_payload)
+        assert cell.rpayload == 'data'
@@ -0,0 +1,73 @@
+import struct
+import unittest
+
+from oppy.cell.cell import Cell
+from oppy.cell.exceptions import BadPayloadData, BadRelayCellHeader
+from oppy.cell.schema import CellSchema, Field, atMost, equals, oneOf
+
+
+class Thing(object):
+    pass
+
+
+TEST_SCHEMA = CellSchema([
+    Field('kind', 'B', oneOf((1, 2), "bad kind {}")),
+    Field('version', 'H', equals(3, "bad version {}")),
+    Field('count', 'B', atMost(10, "bad count {}")),
+    Field('dlen', 'H'),
+], tail='data', tail_len='dlen')
+
+
+class CellSchemaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = struct.pack('!BHBH', 2, 3, 7, 4) + 'abcd'
+
+    def test_unpack_from(self):
+        values, offset = TEST_SCHEMA.unpackFrom('xx' + self.data + 'yy', 2)
+        assert values == (2, 3, 7, 4, 'abcd')
+        assert offset == 2 + len(self.data)
+
+    def test_parse_into_and_get_bytes(self):
+        thing = Thing()
+        assert TEST_SCHEMA.parseInto(thing, self.data) == len(self.data)
+        assert (thing.kind, thing.version, thing.count) == (2, 3, 7)
+        assert (thing.dlen, thing.data) == (4, 'abcd')
+        assert TEST_SCHEMA.getBytes(thing) == self.data
+        assert TEST_SCHEMA.length(thing) == len(self.data)
+
+    def test_write_into(self):
+        thing = Thing()
+        TEST_SCHEMA.parseInto(thing, self.data)
+        buf = bytearray('\xff' * 20)
+        assert TEST_SCHEMA.writeInto(thing, buf, 3) == len(self.data)
+        assert str(buf[3:3 + len(self.data)]) == self.data
+
+    def test_parse_from_buffer(self):
+        values, _ = TEST_SCHEMA.unpackFrom(buffer(bytearray(self.data)))
+        assert values == (2, 3, 7, 4, 'abcd')
+
+    def test_checks(self):
+        bad = (
+            struct.pack('!BHBH', 5, 3, 7, 4) + 'abcd',
+            struct.pack('!BHBH', 2, 4, 7, 4) + 'abcd',
+            struct.pack('!BHBH', 2, 3, 11, 4) + 'abcd',
+        )
+        for data in bad:
+            self.assertRaises(BadPayloadData, TEST_SCHEMA.unpackFrom, data)
+
+    def test_tail_too_long(self):
+        self.assertRaises(BadPayloadData, TEST_SCHEMA.unpackFrom,
+                          self.data[:-1])
+        self.assertRaises(BadPayloadData, TEST_SCHEMA.unpackFrom,
+                          self.data, 0, len(self.data) - 1)
+
+    def test_custom_exception(self):
+        rheader = struct.pack('!B2sH4sH', 2, '\x00\x00', 1, '\x00' * 4, 499)
+        data = struct.pack('!HB', 1, 3) + rheader
+        data += '\x00' * (512 - len(data))
+        self.assertRaises(BadRelayCellHeader, Cell.parse, data)
+
+    def test_tail_requires_length_field(self):
+        self.assertRaises(ValueError, CellSchema, [Field('a', 'B')],
+                          tail='data')
@@ -0,0 +1,178 @@
+import unittest
+
+import mock
+
+from oppy.cell.definitions import DESTROY_CMD, RELAY_CMD
+from oppy.cell.fixedlen import RelayHeaderCache
+from oppy.cell.relay import RelayDataCell
+from oppy.circuit.circuit import Circuit, CState
+from oppy.crypto.workers import OrderedCryptoQueue
+from oppy.tests.crypto.test_util import (
+    CIRC_ID,
+    makeCryptPath,
+    makeInbound,
+)
+from oppy.tests.crypto.test_workers import FakeThreads
+
+
+def makeCircuit():
+    with mock.patch.object(Circuit, '_startBuilding'):
+        circuit = Circuit(CIRC_ID, mock.Mock())
+    circuit.link_circuit_id = CIRC_ID
+    circuit.link_version = 3
+    circuit._headers = RelayHeaderCache(CIRC_ID)
+    circuit._crypt_path = makeCryptPath()
+    circuit._state = CState.OPEN
+    circuit.connection = mock.Mock()
+    return circuit
+
+
+def written(circuit):
+    return [c[0][0].getBytes()
+            for c in circuit.connection.writeCell.call_args_list]
+
+
+class CircuitWorkerCryptoTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sync = makeCircuit()
+        self.threaded = makeCircuit()
+        self.threads = FakeThreads()
+        self.threaded._outbound_crypto = OrderedCryptoQueue(self.threads)
+        self.threaded._inbound_crypto = OrderedCryptoQueue(self.threads)
+
+    def test_outbound_matches_reactor_crypto(self):
+        for circuit in (self.sync, self.threaded):
+            for i in xrange(3):
+                circuit.writeData(chr(i) * 100, 1)
+            circuit._pollWriteQueue()
+            circuit.sendStreamSendMe(1)
+            circuit.writeData('after', 1)
+        # nothing is written until the worker finishes
+        assert written(self.threaded) == []
+        assert len(self.threads.jobs) == 1
+        while self.threads.jobs:
+            self.threads.finish()
+        assert len(written(self.sync)) == 5
+        assert written(self.threaded) == written(self.sync)
+        assert self.threaded._package_window == self.sync._package_window
+
+    def test_data_batched_while_worker_busy(self):
+        self.threaded.writeData('a', 1)
+        self.threaded._pollWriteQueue()
+        for i in xrange(5):
+            self.threaded.writeData('b', 1)
+        self.threads.finish()
+        func, args, _ = self.threads.jobs[0]
+        # the five cells written in the meantime go in one batch
+        assert len(args[0]) == 5
+
+    def test_inbound_matches_reactor_crypto(self):
+        streams = {}
+        for circuit in (self.sync, self.threaded):
+            stream = mock.Mock()
+            circuit._stream_map[1] = stream
+            streams[circuit] = stream
+            inbound = makeInbound(
+                [(RelayDataCell.make(CIRC_ID, 1, chr(i) * 50), i % 3)
+                 for i in xrange(6)], makeCryptPath())
+            for cell in inbound:
+                circuit.recvCell(cell)
+            circuit._pollReadQueue()
+        # reading stops until the worker is done with the burst
+        assert streams[self.threaded].recvData.call_count == 0
+        assert len(self.threads.jobs) == 1
+        self.threads.finish()
+        assert streams[self.threaded].recvData.call_args_list == \
+            streams[self.sync].recvData.call_args_list
+        assert streams[self.sync].recvData.call_count == 6
+
+    def test_closed_circuit_drops_results(self):
+        self.threaded.writeData('a', 1)
+        self.threaded._pollWriteQueue()
+        with mock.patch('oppy.shared.circuit_manager', create=True):
+            self.threaded._closeCircuit()
+        self.threads.finish()
+        assert written(self.threaded) == []
+
+    @mock.patch('oppy.shared.circuit_manager', create=True)
+    def test_destroy_waits_for_encryption(self, mock_manager):
+        self.threaded.writeData('a', 1)
+        self.threaded._pollWriteQueue()
+        self.threaded._sendDestroyCell()
+        self.threaded._closeCircuit()
+        assert written(self.threaded) == []
+        while self.threads.jobs:
+            self.threads.finish()
+        cells = [c[0][0] for c in
+                 self.threaded.connection.writeCell.call_args_list]
+        assert [c.header.cmd for c in cells] == [RELAY_CMD, DESTROY_CMD]
+        # the queue is stopped once the DESTROY has been written
+        self.threaded._outbound_crypto.submit(lambda: None)
+        assert self.threads.jobs == []
+
+    @mock.patch('oppy.shared.circuit_manager', create=True)
+    def test_failed_burst_destroys_circuit(self, mock_manager):
+        circuit = self.threaded
+        for cell in makeInbound([(RelayDataCell.make(CIRC_ID, 1, 'a'), 0)],
+                                makeCryptPath()):
+            circuit.recvCell(cell)
+        with mock.patch.object(circuit, '_handleDecrypted',
+                               side_effect=ValueError('bad')):
+            circuit._pollReadQueue()
+            self.threads.finish()
+        mock_manager.circuitDestroyed.assert_called_once_with(circuit)
+        while self.threads.jobs:
+            self.threads.finish()
+        cells = [c[0][0] for c in circuit.connection.writeCell.call_args_list]
+        assert [c.header.cmd for c in cells] == [DESTROY_CMD]
+
+
+class CircuitBackpressureTests(unittest.TestCase):
+
+    def setUp(self):
+        self.circuit = makeCircuit()
+        self.stream = mock.Mock(stream_id=1)
+        self.circuit._stream_map[1] = self.stream
+
+    def test_paused_circuit_keeps_data_queued(self):
+        self.circuit._pollWriteQueue()
+        self.circuit.pauseWriting()
+        self.stream.pauseWriting.assert_called_once_with()
+        self.circuit.writeData('a', 1)
+        self.circuit.writeData('b', 1)
+        assert written(self.circuit) == []
+        assert len(self.circuit._write_queue.pending) == 2
+        self.circuit.resumeWriting()
+        self.stream.resumeWriting.assert_called_once_with()
+        assert len(written(self.circuit)) == 2
+        assert self.circuit._package_window == 998
+
+    def test_stays_buffering_on_resume(self):
+        self.circuit._state = CState.BUFFERING
+        self.circuit.pauseWriting()
+        self.circuit.resumeWriting()
+        assert self.circuit._write_deferred is None
+
+    @mock.patch('oppy.shared.circuit_manager', create=True)
+    def test_end_sent_after_queued_data(self, mock_manager):
+        mock_manager.shouldDestroyCircuit.return_value = False
+        self.circuit._pollWriteQueue()
+        self.circuit.pauseWriting()
+        self.circuit.writeData('a', 1)
+        self.circuit.unregisterStream(self.stream)
+        assert written(self.circuit) == []
+        assert 1 in self.circuit._stream_map
+        self.circuit.resumeWriting()
+        cells = [c[0][0] for c in
+                 self.circuit.connection.writeCell.call_args_list]
+        assert len(cells) == 2
+        assert 1 not in self.circuit._stream_map
+        # only the data cell counts against the package window
+        assert self.circuit._package_window == 999
+
+    def test_new_stream_while_paused(self):
+        self.circuit.pauseWriting()
+        stream = mock.Mock()
+        self.circuit.registerStream(stream)
+        stream.pauseWriting.assert_called_once_with()
@@ -0,0 +1,126 @@
+import unittest
+
+import mock
+
+from twisted.internet import defer
+
+from oppy.cell.definitions import CREATED2_CMD, DESTROY_CMD, RELAY_CMD
+from oppy.circuit.handshake import ntorfsm
+from oppy.circuit.handshake.exceptions import (
+    ReceivedDestroyCell,
+    UnexpectedCell,
+)
+from oppy.circuit.handshake.ntorfsm import NTorFSM, State
+from oppy.crypto import ntorhandshake
+
+
+def makeCell(cmd):
+    cell = mock.Mock()
+    cell.header.cmd = cmd
+    return cell
+
+
+class NTorFSMDerivationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(ntorfsm, 'NTorHandshake'),
+            mock.patch.object(ntorfsm, 'getHandshakeMaterial'),
+            mock.patch.object(ntorfsm, 'RelayExtend2Cell'),
+            mock.patch.object(ntorfsm.crypto, 'encryptCellToTarget'),
+        ]
+        for p in self.patches:
+            p.start()
+        self.crypt_path = []
+        self.fsm = NTorFSM(1, mock.Mock(), self.crypt_path)
+        self.fsm._state = State.EXPECT_CREATED2
+        self.handshake = self.fsm._ntor_handshakes[0]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        ntorhandshake.disableThreadedDerivation()
+
+    def test_derive_on_reactor_thread(self):
+        response = self.fsm.recvCell(makeCell(CREATED2_CMD))
+
+        assert response == ntorfsm.crypto.encryptCellToTarget.return_value
+        derived = self.handshake.deriveRelayCrypto.return_value
+        assert self.crypt_path == [derived]
+        assert self.fsm._state == State.EXPECT_FIRST_EXTENDED2
+        assert not self.handshake.deriveRelayCryptoInThread.called
+
+    def test_derive_in_thread(self):
+        ntorhandshake.enableThreadedDerivation()
+        derived = defer.Deferred()
+        self.handshake.deriveRelayCryptoInThread.return_value = derived
+
+        d = self.fsm.recvCell(makeCell(CREATED2_CMD))
+        assert isinstance(d, defer.Deferred)
+        assert self.fsm._state == State.DERIVING
+        assert self.crypt_path == []
+
+        responses = []
+        d.addCallback(responses.append)
+        entry_crypto = mock.Mock()
+        derived.callback(entry_crypto)
+
+        assert responses == [ntorfsm.crypto.encryptCellToTarget.return_value]
+        assert self.crypt_path == [entry_crypto]
+        assert self.fsm._state == State.EXPECT_FIRST_EXTENDED2
+        assert not self.handshake.deriveRelayCrypto.called
+
+    def test_cell_while_deriving(self):
+        self.fsm._state = State.DERIVING
+        self.assertRaises(UnexpectedCell, self.fsm.recvCell,
+                          makeCell(RELAY_CMD))
+        self.assertRaises(ReceivedDestroyCell, self.fsm.recvCell,
+                          makeCell(DESTROY_CMD))
+
+
+class CircuitHandshakeTests(unittest.TestCase):
+
+    def setUp(self):
+        from oppy.circuit import circuit
+        self.patches = [
+            mock.patch.object(circuit, 'PathSelector'),
+            mock.patch.object(circuit.Circuit, '_startBuilding'),
+            mock.patch.object(circuit.Circuit, '_openCircuit'),
+            mock.patch('oppy.shared.circuit_manager', create=True),
+        ]
+        for p in self.patches:
+            p.start()
+        self.circuit = circuit.Circuit(1, mock.Mock())
+        self.circuit.connection = mock.Mock()
+        self.circuit._handshake = mock.Mock()
+        self.circuit._handshake.isDone.return_value = False
+        self.derived = defer.Deferred()
+        self.circuit._handshake.recvCell.return_value = self.derived
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_response_after_derivation(self):
+        self.circuit._recvHandshakeCell(makeCell(CREATED2_CMD))
+        assert not self.circuit.connection.writeCell.called
+
+        response = mock.Mock()
+        self.derived.callback(response)
+        self.circuit.connection.writeCell.assert_called_once_with(response)
+
+    def test_closed_while_deriving(self):
+        self.circuit._recvHandshakeCell(makeCell(CREATED2_CMD))
+        self.circuit.destroyCircuitFromConnection()
+
+        self.derived.callback(mock.Mock())
+        assert not self.circuit.connection.writeCell.called
+
+    def test_derivation_failed(self):
+        from oppy.crypto.exceptions import KeyDerivationFailed
+        self.circuit._recvHandshakeCell(makeCell(CREATED2_CMD))
+
+        with mock.patch.object(self.circuit,
+                               'destroyCircuitProtocolViolation') as destroy:
+            self.derived.errback(KeyDerivationFailed())
+            assert destroy.called
@@ -0,0 +1,63 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+from oppy.connection.handshake.certcache import CertCache
+
+
+START = datetime(2015, 1, 1)
+HOUR = timedelta(hours=1)
+
+
+class CertCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = START
+        self.cache = CertCache(max_entries=2, now=lambda: self.now)
+
+    def add(self, id_der, link_der='link'):
+        self.cache.add(id_der, link_der, 'key-' + id_der,
+                       START - HOUR, START + HOUR)
+
+    def test_miss_then_hit(self):
+        assert self.cache.lookup('id', 'link') is None
+        self.add('id')
+        entry = self.cache.lookup('id', 'link')
+        assert entry.link_key == 'key-id'
+        assert self.cache.hits == 1
+        assert self.cache.misses == 1
+
+    def test_keyed_by_both_certs(self):
+        self.add('id')
+        assert self.cache.lookup('id', 'other link') is None
+        assert self.cache.lookup('other id', 'link') is None
+
+    def test_expired_entries_dropped(self):
+        self.add('id')
+        self.now = START + 2 * HOUR
+        assert self.cache.lookup('id', 'link') is None
+        assert self.cache.expired == 1
+        assert len(self.cache) == 0
+
+    def test_not_yet_valid(self):
+        self.add('id')
+        self.now = START - 2 * HOUR
+        assert self.cache.lookup('id', 'link') is None
+
+    def test_evicts_least_recently_used(self):
+        self.add('a')
+        self.add('b')
+        self.cache.lookup('a', 'link')
+        self.add('c')
+        assert len(self.cache) == 2
+        assert self.cache.lookup('b', 'link') is None
+        assert self.cache.lookup('a', 'link') is not None
+        assert self.cache.lookup('c', 'link') is not None
+
+    def test_stats(self):
+        self.add('id')
+        self.cache.lookup('id', 'link')
+        stats = self.cache.stats()
+        assert stats['hits'] == 1
+        assert stats['size'] == 1
+        assert stats['max_entries'] == 2
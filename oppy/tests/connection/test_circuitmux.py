@@ -0,0 +1,172 @@
+import unittest
+
+import mock
+
+from twisted.internet import task
+
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+from oppy.connection import circuitmux
+from oppy.connection.circuitmux import EWMACircuitMux
+from oppy.connection.connection import Connection, ConnState
+
+
+def makeCell(circ_id, i=0):
+    return EncryptedCell.make(circ_id, chr(i) * MAX_PAYLOAD_LEN)
+
+
+class EWMACircuitMuxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.mux = EWMACircuitMux(self.sent.append, halflife=10,
+                                  callLater=self.clock.callLater,
+                                  seconds=self.clock.seconds)
+
+    def sentIDs(self):
+        return [cell.header.circ_id for cell in self.sent]
+
+    def test_sends_at_end_of_turn(self):
+        self.mux.writeCell(makeCell(1))
+        assert self.sent == []
+        assert len(self.mux) == 1
+        self.clock.advance(0)
+        assert self.sentIDs() == [1]
+        assert len(self.mux) == 0
+
+    def test_circuit_order_kept(self):
+        cells = [makeCell(1, i) for i in xrange(5)]
+        for cell in cells:
+            self.mux.writeCell(cell)
+        self.clock.advance(0)
+        assert self.sent == cells
+
+    def test_quiet_circuit_goes_first(self):
+        for i in xrange(20):
+            self.mux.writeCell(makeCell(1, i))
+        self.clock.advance(0)
+        # circuit 1 has been busy; now both circuits have cells waiting
+        for i in xrange(3):
+            self.mux.writeCell(makeCell(1, i))
+        self.mux.writeCell(makeCell(2))
+        del self.sent[:]
+        self.clock.advance(0)
+        assert self.sentIDs() == [2, 1, 1, 1]
+
+    def test_busy_circuits_alternate(self):
+        for i in xrange(4):
+            self.mux.writeCell(makeCell(1, i))
+            self.mux.writeCell(makeCell(2, i))
+        self.clock.advance(0)
+        assert self.sentIDs() == [1, 2, 1, 2, 1, 2, 1, 2] or \
+            self.sentIDs() == [2, 1, 2, 1, 2, 1, 2, 1]
+
+    def test_ewma_decays(self):
+        for i in xrange(8):
+            self.mux.writeCell(makeCell(1, i))
+        self.clock.advance(0)
+        assert self.mux._queues[1].ewma == 8
+        # three halflives later, plus the new cell
+        self.clock.advance(30)
+        self.mux.writeCell(makeCell(1))
+        self.clock.advance(0)
+        assert abs(self.mux._queues[1].ewma - 2) < 1e-9
+
+    def test_pause_and_resume(self):
+        self.mux.writeCell(makeCell(1))
+        self.mux.pauseProducing()
+        self.clock.advance(0)
+        assert self.sent == []
+        self.mux.writeCell(makeCell(1))
+        assert self.clock.getDelayedCalls() == []
+        self.mux.resumeProducing()
+        assert len(self.sent) == 2
+
+    def test_pause_while_sending(self):
+        self.mux = EWMACircuitMux(self.sendAndPause, halflife=10,
+                                  callLater=self.clock.callLater,
+                                  seconds=self.clock.seconds)
+        for i in xrange(3):
+            self.mux.writeCell(makeCell(1, i))
+        self.clock.advance(0)
+        assert len(self.sent) == 1
+        assert len(self.mux) == 2
+
+    def sendAndPause(self, cell):
+        self.sent.append(cell)
+        self.mux.pauseProducing()
+
+    def test_stop_producing(self):
+        self.mux.writeCell(makeCell(1))
+        self.mux.stopProducing()
+        self.mux.writeCell(makeCell(1))
+        self.mux.resumeProducing()
+        self.clock.advance(0)
+        assert self.sent == []
+        assert len(self.mux) == 0
+
+    def test_remove_circuit(self):
+        self.mux.writeCell(makeCell(1))
+        self.clock.advance(0)
+        self.mux.removeCircuit(1)
+        assert 1 not in self.mux._queues
+
+    def test_remove_circuit_with_queued_cells(self):
+        self.mux.writeCell(makeCell(1))
+        self.mux.removeCircuit(1)
+        self.clock.advance(0)
+        assert self.sentIDs() == [1]
+        assert 1 not in self.mux._queues
+
+
+class ConnectionSchedulerTests(unittest.TestCase):
+
+    def tearDown(self):
+        circuitmux.disableScheduler()
+
+    def openConnection(self):
+        conn = Connection(mock.Mock())
+        conn.transport = mock.Mock()
+        conn._handshake = mock.Mock(link_version=4)
+        conn._handshake.recvCell.return_value = None
+        conn._handshake.isDone.return_value = True
+        conn._recvHandshakeCell(mock.Mock())
+        assert conn._state == ConnState.OPEN
+        return conn
+
+    def test_disabled_by_default(self):
+        conn = self.openConnection()
+        assert conn._mux is None
+        conn.writeCell(makeCell(1))
+        assert conn.transport.write.call_count == 1
+
+    def test_enabled(self):
+        circuitmux.enableScheduler()
+        conn = self.openConnection()
+        with mock.patch.object(conn._mux, '_callLater') as callLater:
+            conn.writeCell(makeCell(1))
+        assert conn.transport.write.call_count == 0
+        assert callLater.call_count == 1
+        conn._mux.flush()
+        assert conn.transport.write.call_count == 1
+
+    def test_paused_with_connection(self):
+        circuitmux.enableScheduler()
+        conn = self.openConnection()
+        with mock.patch.object(conn._mux, '_callLater'):
+            conn.writeCell(makeCell(1))
+        conn.pauseProducing()
+        conn._mux.flush()
+        assert conn.transport.write.call_count == 0
+        conn.resumeProducing()
+        assert conn.transport.write.call_count == 1
+
+    @mock.patch('oppy.shared.connection_pool')
+    def test_connection_lost(self, mock_pool):
+        circuitmux.enableScheduler()
+        conn = self.openConnection()
+        with mock.patch.object(conn._mux, '_callLater'):
+            conn.writeCell(makeCell(1))
+        conn.connectionLost(mock.Mock())
+        assert len(conn._mux) == 0
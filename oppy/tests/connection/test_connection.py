@@ -0,0 +1,246 @@
+import unittest
+
+import mock
+
+from oppy.cell.fixedlen import EncryptedCell, PaddingCell
+from oppy.cell.relay import RelayDataCell
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+from oppy.connection.connection import Connection, ConnState
+from oppy.connection.definitions import RECV_BUFFER_HIGH_WATER
+from oppy.connection.handshake.exceptions import HandshakeFailed
+
+
+class ConnectionDataReceivedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection(mock.Mock())
+        self.conn._state = ConnState.OPEN
+        self.conn.transport = mock.Mock()
+        self.circuit = mock.Mock()
+        self.conn._circuit_map[1] = self.circuit
+        self.cells = [EncryptedCell.make(1, chr(i) * MAX_PAYLOAD_LEN)
+                      for i in xrange(3)]
+        self.data = ''.join(c.getBytes() for c in self.cells)
+
+    def test_whole_cells(self):
+        self.conn.dataReceived(self.data)
+        received = [c[0][0] for c in self.circuit.recvCell.call_args_list]
+        assert received == self.cells
+        assert len(self.conn._buffer) == 0
+
+    def test_split_reads(self):
+        for i in xrange(0, len(self.data), 100):
+            self.conn.dataReceived(self.data[i:i + 100])
+        received = [c[0][0] for c in self.circuit.recvCell.call_args_list]
+        assert received == self.cells
+        assert len(self.conn._buffer) == 0
+
+    def test_partial_cell_stays_buffered(self):
+        self.conn.dataReceived(self.data[:700])
+        assert self.circuit.recvCell.call_count == 1
+        assert len(self.conn._buffer) == 700 - 512
+
+    def test_padding_dropped(self):
+        self.conn.dataReceived(PaddingCell.make(1).getBytes())
+        assert self.circuit.recvCell.call_count == 0
+        assert len(self.conn._buffer) == 0
+
+    @mock.patch('oppy.connection.connection.Connection.closeConnection')
+    def test_high_water_closes_connection(self, mock_close):
+        # a partial cell that never completes
+        self.conn.dataReceived(self.data[:10])
+        self.conn.dataReceived('\x00' * RECV_BUFFER_HIGH_WATER)
+        assert mock_close.call_count == 1
+        assert len(self.conn._buffer) == 0
+
+
+class ConnectionHandshakeDataReceivedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection(mock.Mock())
+        self.conn._state = ConnState.PENDING
+        self.conn.transport = mock.Mock()
+        self.circuit = mock.Mock()
+        self.conn._circuit_map[1] = self.circuit
+        self.cells = [EncryptedCell.make(1, chr(i) * MAX_PAYLOAD_LEN)
+                      for i in xrange(2)]
+        self.data = ''.join(c.getBytes() for c in self.cells)
+
+    @mock.patch('oppy.connection.connection.Connection._recvHandshakeCell')
+    def test_handshake_completes_mid_buffer(self, mock_recv_handshake):
+        def openConnection(cell):
+            self.conn._state = ConnState.OPEN
+        mock_recv_handshake.side_effect = openConnection
+
+        self.conn.dataReceived(self.data)
+
+        mock_recv_handshake.assert_called_once_with(self.cells[0])
+        self.circuit.recvCell.assert_called_once_with(self.cells[1])
+        assert len(self.conn._buffer) == 0
+
+
+class ConnectionWriteCellTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection(mock.Mock())
+        self.conn._state = ConnState.OPEN
+        self.conn.transport = mock.Mock()
+
+    def test_write_cells(self):
+        cells = [
+            RelayDataCell.make(1, 1, 'x' * 400),
+            RelayDataCell.make(1, 1, 'y'),
+            EncryptedCell.make(1, 'z' * MAX_PAYLOAD_LEN),
+        ]
+        for cell in cells:
+            self.conn.writeCell(cell)
+        written = [c[0][0] for c in self.conn.transport.write.call_args_list]
+        assert written == [cell.getBytes() for cell in cells]
+        assert all(type(w) is str for w in written)
+
+    def test_write_cell_not_open(self):
+        self.conn._state = ConnState.PENDING
+        cell = RelayDataCell.make(1, 1, 'x')
+        self.conn.writeCell(cell)
+        assert self.conn.transport.write.call_count == 0
+        assert self.conn._cell_queue == [cell]
+
+
+class ConnectionLinkV4Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection(mock.Mock())
+        self.conn._state = ConnState.OPEN
+        self.conn.link_version = 4
+        self.conn.transport = mock.Mock()
+
+    def test_data_received_v4(self):
+        circ_id = 0x80000001
+        circuit = mock.Mock()
+        self.conn._circuit_map[circ_id] = circuit
+        cells = [EncryptedCell.make(circ_id, chr(i) * MAX_PAYLOAD_LEN, 4)
+                 for i in xrange(3)]
+        data = ''.join(c.getBytes() for c in cells)
+        assert len(data) == 3 * 514
+
+        self.conn.dataReceived(data)
+
+        received = [c[0][0] for c in circuit.recvCell.call_args_list]
+        assert received == cells
+        assert len(self.conn._buffer) == 0
+
+    def test_link_circuit_id_v4(self):
+        assert self.conn.linkCircuitID(1) == 0x80000001
+        assert self.conn.linkCircuitID(0x10000) == 0x80010000
+
+    def test_link_circuit_id_v3(self):
+        self.conn.link_version = 3
+        assert self.conn.linkCircuitID(1) == 1
+        self.assertRaises(ValueError, self.conn.linkCircuitID, 0x10000)
+
+    def test_add_new_circuit(self):
+        circuit = mock.Mock(circuit_id=1, link_circuit_id=0x80000001)
+        self.conn.addNewCircuit(circuit)
+        assert self.conn._circuit_map == {0x80000001: circuit}
+        self.assertRaises(ValueError, self.conn.addNewCircuit, circuit)
+
+
+class ConnectionWhenOpenTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection(mock.Mock())
+        self.conn.transport = mock.Mock()
+        self.conn._handshake = mock.Mock()
+        self.conn._handshake.recvCell.return_value = None
+        self.conn._handshake.link_version = 4
+
+    def test_fires_when_handshake_done(self):
+        opened = []
+        self.conn.whenOpen().addCallback(opened.append)
+
+        self.conn._handshake.isDone.return_value = False
+        self.conn._recvHandshakeCell(mock.Mock())
+        assert opened == []
+        assert self.conn.link_version == 4
+
+        self.conn._handshake.isDone.return_value = True
+        self.conn._recvHandshakeCell(mock.Mock())
+        assert opened == [self.conn]
+        assert self.conn._state == ConnState.OPEN
+
+    def test_already_open(self):
+        self.conn._state = ConnState.OPEN
+        opened = []
+        self.conn.whenOpen().addCallback(opened.append)
+        assert opened == [self.conn]
+
+    @mock.patch('oppy.shared.connection_pool', create=True)
+    def test_fails_on_close(self, mock_pool):
+        failures = []
+        self.conn.whenOpen().addErrback(failures.append)
+        self.conn.closeConnection()
+        assert len(failures) == 1
+        assert failures[0].check(HandshakeFailed)
+
+
+class ConnectionBackpressureTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection(mock.Mock())
+        self.conn.transport = mock.Mock()
+        self.circuit = mock.Mock(link_circuit_id=1)
+        self.conn.addNewCircuit(self.circuit)
+
+    @mock.patch('oppy.connection.connection.V3FSM')
+    def test_registers_as_producer(self, mock_fsm):
+        self.conn.connectionMade()
+        self.conn.transport.registerProducer.assert_called_once_with(
+            self.conn, True)
+
+    def test_pause_and_resume_circuits(self):
+        self.conn.pauseProducing()
+        assert self.conn.isPaused() is True
+        self.circuit.pauseWriting.assert_called_once_with()
+        # already paused
+        self.conn.pauseProducing()
+        assert self.circuit.pauseWriting.call_count == 1
+        self.conn.resumeProducing()
+        assert self.conn.isPaused() is False
+        self.circuit.resumeWriting.assert_called_once_with()
+
+    def test_new_circuit_while_paused(self):
+        self.conn.pauseProducing()
+        circuit = mock.Mock(link_circuit_id=2)
+        self.conn.addNewCircuit(circuit)
+        circuit.pauseWriting.assert_called_once_with()
+
+    def test_resume_round_robin(self):
+        circuits = [self.circuit]
+        for circ_id in (2, 3):
+            circuit = mock.Mock(link_circuit_id=circ_id)
+            self.conn.addNewCircuit(circuit)
+            circuits.append(circuit)
+        # circuit 1 fills the send buffer again as soon as it's resumed
+        circuits[0].resumeWriting.side_effect = self.conn.pauseProducing
+        self.conn.pauseProducing()
+        self.conn.resumeProducing()
+        assert [c.resumeWriting.call_count for c in circuits] == [1, 0, 0]
+        # the next resume starts with the circuits that were skipped
+        circuits[0].resumeWriting.side_effect = None
+        circuits[1].resumeWriting.side_effect = self.conn.pauseProducing
+        self.conn.resumeProducing()
+        assert [c.resumeWriting.call_count for c in circuits] == [1, 1, 0]
+        circuits[1].resumeWriting.side_effect = None
+        self.conn.resumeProducing()
+        assert [c.resumeWriting.call_count for c in circuits] == [2, 2, 1]
+
+    @mock.patch('oppy.shared.connection_pool', create=True)
+    def test_close_drops_queued_cells(self, mock_pool):
+        mux = self.conn._mux = mock.Mock()
+        coalescer = self.conn._coalescer = mock.Mock()
+        self.conn.closeConnection()
+        mux.stopProducing.assert_called_once_with()
+        coalescer.stop.assert_called_once_with()
+        assert mux.flush.call_count == 0
+        assert coalescer.flush.call_count == 0
+        self.conn.transport.abortConnection.assert_called_once_with()
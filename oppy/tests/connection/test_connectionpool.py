@@ -0,0 +1,92 @@
+import unittest
+
+import mock
+
+from twisted.internet import defer, task
+
+from oppy.connection.connectionpool import ConnectionPool
+
+
+def makeRelay(fingerprint):
+    return mock.Mock(fingerprint=fingerprint, address='127.0.0.1',
+                     or_port=9001)
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = ConnectionPool(idle_timeout=60, max_idle=2,
+                                   callLater=self.clock.callLater)
+
+    def addConnection(self, fingerprint):
+        connection = mock.Mock()
+        self.pool._connection_map[fingerprint] = connection
+        return connection
+
+    def getConnection(self, fingerprint):
+        got = []
+        self.pool.getConnection(makeRelay(fingerprint)).addCallback(
+            got.append)
+        return got
+
+    @mock.patch('oppy.connection.connectionpool.endpoints')
+    def test_hits_and_misses(self, mock_endpoints):
+        mock_endpoints.connectProtocol.return_value = defer.Deferred()
+        first = self.getConnection('a')
+        second = self.getConnection('a')
+        assert mock_endpoints.connectProtocol.call_count == 1
+        connection = mock.Mock()
+        self.pool._connectionOpened(connection, 'a')
+        third = self.getConnection('a')
+        assert first == second == third == [connection]
+        stats = self.pool.stats()
+        assert stats['misses'] == 1
+        assert stats['pending_hits'] == 1
+        assert stats['hits'] == 1
+        assert abs(stats['hit_rate'] - 2.0 / 3) < 1e-9
+
+    def test_idle_connection_kept_until_timeout(self):
+        connection = self.addConnection('a')
+        assert self.pool.shouldDestroyConnection('a') is False
+        self.clock.advance(59)
+        assert connection.closeConnection.call_count == 0
+        self.clock.advance(1)
+        connection.closeConnection.assert_called_once_with()
+        assert 'a' not in self.pool._connection_map
+        assert self.pool.stats()['idle_timeouts'] == 1
+
+    def test_reused_idle_connection(self):
+        connection = self.addConnection('a')
+        self.pool.shouldDestroyConnection('a')
+        assert self.getConnection('a') == [connection]
+        assert self.pool.stats()['idle'] == 0
+        self.clock.advance(60)
+        assert connection.closeConnection.call_count == 0
+        assert self.clock.getDelayedCalls() == []
+
+    def test_least_recently_used_evicted(self):
+        connections = dict((fp, self.addConnection(fp)) for fp in 'abc')
+        self.pool.shouldDestroyConnection('a')
+        self.pool.shouldDestroyConnection('b')
+        # reusing a makes b the least recently used
+        self.getConnection('a')
+        self.pool.shouldDestroyConnection('a')
+        self.pool.shouldDestroyConnection('c')
+        connections['b'].closeConnection.assert_called_once_with()
+        assert connections['a'].closeConnection.call_count == 0
+        assert list(self.pool._idle) == ['a', 'c']
+        assert self.pool.stats()['idle_evictions'] == 1
+        assert len(self.clock.getDelayedCalls()) == 2
+
+    def test_removed_connection_forgets_timeout(self):
+        self.addConnection('a')
+        self.pool.shouldDestroyConnection('a')
+        self.pool.removeConnection('a')
+        assert self.pool.stats()['idle'] == 0
+        assert self.clock.getDelayedCalls() == []
+
+    def test_idle_disabled(self):
+        pool = ConnectionPool(idle_timeout=0, callLater=self.clock.callLater)
+        pool._connection_map['a'] = mock.Mock()
+        assert pool.shouldDestroyConnection('a') is True
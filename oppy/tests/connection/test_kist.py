@@ -0,0 +1,118 @@
+import socket
+import sys
+import unittest
+
+import mock
+
+from twisted.internet import task
+
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+from oppy.connection import kist
+from oppy.connection.circuitmux import EWMACircuitMux
+from oppy.connection.kist import SocketLimit
+
+
+CELL_LEN = len(EncryptedCell.make(1, '\x00' * MAX_PAYLOAD_LEN))
+
+
+class FakeLimit(object):
+
+    run_interval = 0.01
+
+    def __init__(self, budgets):
+        self.budgets = budgets
+
+    def writableBytes(self):
+        return self.budgets.pop(0)
+
+
+class KISTLimitTests(unittest.TestCase):
+
+    def test_compute_limit(self):
+        # 10 segments in the window, 4 in flight, nothing waiting
+        assert kist.computeLimit(10, 4, 1000, 0, 1.0) == 6000 + 10000
+        # waiting data eats into the extra space
+        assert kist.computeLimit(10, 4, 1000, 12000, 1.0) == 4000
+        assert kist.computeLimit(10, 10, 1000, 50000, 1.0) == 0
+        assert kist.computeLimit(10, 4, 1000, 0, 0.5) == 6000 + 5000
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'needs Linux')
+    def test_read_socket_info(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        client = socket.create_connection(server.getsockname())
+        accepted, _ = server.accept()
+        try:
+            cwnd, unacked, mss, notsent = kist.readSocketInfo(client)
+            assert cwnd > 0
+            assert mss > 0
+            assert unacked == 0
+            assert notsent == 0
+            assert SocketLimit(client).writableBytes() == 2 * cwnd * mss
+        finally:
+            for sock in (client, accepted, server):
+                sock.close()
+
+    def test_unreadable_socket(self):
+        sock = socket.socket()
+        sock.close()
+        assert SocketLimit(sock).writableBytes() is None
+
+    def test_find_socket(self):
+        sock = socket.socket()
+        try:
+            tcp = mock.Mock(socket=sock)
+            tls = mock.Mock(socket=None, transport=tcp)
+            assert kist.findSocket(tls) is sock
+            assert kist.findSocket(mock.Mock(socket=None,
+                                             transport=None)) is None
+        finally:
+            sock.close()
+
+    def test_make_socket_limit(self):
+        sock = socket.socket()
+        transport = mock.Mock(socket=sock)
+        try:
+            assert kist.makeSocketLimit(transport) is None
+            kist.enableKIST(0.5, 0.02)
+            limit = kist.makeSocketLimit(transport)
+            assert limit.sock is sock
+            assert limit.sock_buf_factor == 0.5
+            assert limit.run_interval == 0.02
+        finally:
+            kist.disableKIST()
+            sock.close()
+
+
+class LimitedMuxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+
+    def makeMux(self, budgets):
+        return EWMACircuitMux(self.sent.append, 10, FakeLimit(budgets),
+                              callLater=self.clock.callLater,
+                              seconds=self.clock.seconds)
+
+    def test_holds_cells_past_limit(self):
+        mux = self.makeMux([2 * CELL_LEN, 0, CELL_LEN * 10])
+        for i in xrange(4):
+            mux.writeCell(EncryptedCell.make(1, chr(i) * MAX_PAYLOAD_LEN))
+        self.clock.advance(0)
+        assert len(self.sent) == 2
+        assert len(mux) == 2
+        self.clock.advance(0.01)
+        assert len(self.sent) == 2
+        self.clock.advance(0.01)
+        assert len(self.sent) == 4
+        assert self.clock.getDelayedCalls() == []
+
+    def test_no_limit(self):
+        mux = self.makeMux([None])
+        for i in xrange(4):
+            mux.writeCell(EncryptedCell.make(1, chr(i) * MAX_PAYLOAD_LEN))
+        self.clock.advance(0)
+        assert len(self.sent) == 4
@@ -0,0 +1,58 @@
+import unittest
+
+from oppy.connection.exceptions import RecvBufferOverflow
+from oppy.connection.recvbuffer import RecvBuffer
+
+
+class RecvBufferTests(unittest.TestCase):
+
+    def test_append_view(self):
+        buf = RecvBuffer()
+        buf.append('abc')
+        buf.append('def')
+        assert len(buf) == 6
+        assert buf.view()[:] == 'abcdef'
+
+    def test_consume(self):
+        buf = RecvBuffer()
+        buf.append('abcdef')
+        buf.consume(2)
+        assert len(buf) == 4
+        assert buf.view()[:2] == 'cd'
+        buf.consume(4)
+        assert len(buf) == 0
+        assert buf.view()[:] == ''
+
+    def test_consume_too_much(self):
+        buf = RecvBuffer()
+        buf.append('abc')
+        self.assertRaises(ValueError, buf.consume, 4)
+
+    def test_compaction_keeps_unconsumed_bytes(self):
+        buf = RecvBuffer(compact_threshold=4)
+        buf.append('abcdefgh')
+        buf.consume(3)
+        assert buf._offset == 3
+        buf.consume(2)
+        # crossing the threshold discards the consumed prefix
+        assert buf._offset == 0
+        assert len(buf._buf) == 3
+        assert buf.view()[:] == 'fgh'
+
+    def test_high_water(self):
+        buf = RecvBuffer(high_water=8)
+        buf.append('abcdef')
+        self.assertRaises(RecvBufferOverflow, buf.append, 'ghi')
+        # a failed append leaves the buffer untouched
+        assert buf.view()[:] == 'abcdef'
+        buf.consume(3)
+        buf.append('ghijk')
+        assert buf.view()[:] == 'defghijk'
+
+    def test_clear(self):
+        buf = RecvBuffer()
+        buf.append('abc')
+        buf.consume(1)
+        buf.clear()
+        assert len(buf) == 0
+        assert buf.view()[:] == ''
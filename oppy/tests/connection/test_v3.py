@@ -0,0 +1,124 @@
+import unittest
+
+import mock
+import OpenSSL
+
+from oppy.cell.definitions import CERTS_CMD
+from oppy.cell.varlen import VersionsCell
+from oppy.connection.handshake import certcache, v3
+from oppy.connection.handshake.certcache import CertCache
+from oppy.connection.handshake.exceptions import HandshakeFailed
+from oppy.connection.handshake.v3 import V3FSM, V3State
+from test.utils import makeCert, makeKey
+
+
+class V3FSMVersionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fsm = V3FSM(mock.Mock())
+        self.fsm.handshakeSupported = mock.Mock(return_value=True)
+        self.process = V3FSM._response_map[V3State.EXPECT_VERSIONS]
+
+    def test_initiating_cell_offers_v3_and_v4(self):
+        cell = self.fsm.getInitiatingCell()
+        assert cell == VersionsCell.make([3, 4])
+        assert self.fsm.link_version == 3
+
+    def test_negotiates_v4(self):
+        self.process(self.fsm, VersionsCell.make([3, 4]))
+        assert self.fsm.link_version == 4
+        assert self.fsm._state == V3State.EXPECT_CERTS
+
+    def test_falls_back_to_v3(self):
+        self.process(self.fsm, VersionsCell.make([3]))
+        assert self.fsm.link_version == 3
+
+    def test_no_common_version(self):
+        cell = mock.Mock(versions=[1, 2])
+        cell.header.cmd = VersionsCell.make([3]).header.cmd
+        self.assertRaisesRegexp(
+            HandshakeFailed,
+            '^Relay does not support Link Protocol 3 or 4 '
+            '\\(it offered 1, 2\\)$',
+            self.process, self.fsm, cell)
+        assert self.fsm.handshakeSupported.call_count == 0
+
+    def test_unsupported_tls_handshake(self):
+        self.fsm.handshakeSupported.return_value = False
+        self.assertRaisesRegexp(
+            HandshakeFailed,
+            '^TLS connection does not support a V3 handshake$',
+            self.process, self.fsm, VersionsCell.make([3, 4]))
+
+
+def der(cert):
+    return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_ASN1, cert)
+
+
+class V3FSMCertsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.id_key = makeKey()
+        self.link_key = makeKey()
+        self.id_cert = makeCert(self.id_key, self.id_key)
+        self.link_cert = makeCert(self.link_key, self.id_key)
+        self.cache = CertCache()
+        mock.patch.object(certcache, '_cache', self.cache).start()
+        self.verify = mock.patch.object(
+            v3.crypto_util, 'verifyCertSig',
+            wraps=v3.crypto_util.verifyCertSig).start()
+        self.addCleanup(mock.patch.stopall)
+        self.process = V3FSM._response_map[V3State.EXPECT_CERTS]
+
+    def makeCell(self, link_cert=None):
+        link_cert = link_cert or self.link_cert
+        cell = mock.Mock(num_certs=2, cert_payload_items=[
+            mock.Mock(cert_type=1, cert=der(link_cert)),
+            mock.Mock(cert_type=2, cert=der(self.id_cert))])
+        cell.header.cmd = CERTS_CMD
+        return cell
+
+    def makeFSM(self, conn_cert=None):
+        # the peer certificate of a real connection has no private key
+        conn_cert = OpenSSL.crypto.load_certificate(
+            OpenSSL.crypto.FILETYPE_ASN1, der(conn_cert or self.link_cert))
+        transport = mock.Mock()
+        transport.getPeerCertificate.return_value = conn_cert
+        fsm = V3FSM(transport)
+        fsm._state = V3State.EXPECT_CERTS
+        return fsm
+
+    def test_verifies_then_caches(self):
+        fsm = self.makeFSM()
+        self.process(fsm, self.makeCell())
+        assert fsm._state == V3State.EXPECT_AUTH_CHALLENGE
+        assert self.verify.call_count == 2
+        assert len(self.cache) == 1
+
+        fsm = self.makeFSM()
+        self.process(fsm, self.makeCell())
+        assert fsm._state == V3State.EXPECT_AUTH_CHALLENGE
+        # signatures were not checked again
+        assert self.verify.call_count == 2
+        assert self.cache.hits == 1
+
+    def test_cache_hit_still_checks_tls_key(self):
+        self.process(self.makeFSM(), self.makeCell())
+        other = makeCert(makeKey(), self.id_key)
+        fsm = self.makeFSM(conn_cert=other)
+        self.assertRaises(HandshakeFailed, self.process, fsm, self.makeCell())
+        assert self.cache.hits == 1
+
+    def test_bad_signature_not_cached(self):
+        forged = makeCert(self.link_key, makeKey())
+        fsm = self.makeFSM()
+        self.assertRaises(HandshakeFailed, self.process, fsm,
+                          self.makeCell(link_cert=forged))
+        assert len(self.cache) == 0
+
+    def test_expired_cert(self):
+        expired = makeCert(self.link_key, self.id_key, not_after=-60)
+        fsm = self.makeFSM()
+        self.assertRaises(HandshakeFailed, self.process, fsm,
+                          self.makeCell(link_cert=expired))
+        assert self.verify.call_count == 0
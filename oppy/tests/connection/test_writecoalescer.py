@@ -0,0 +1,111 @@
+import unittest
+
+import mock
+
+from twisted.internet import task
+
+from oppy.cell.fixedlen import EncryptedCell
+from oppy.cell.definitions import MAX_PAYLOAD_LEN
+from oppy.connection import writecoalescer
+from oppy.connection.connection import Connection, ConnState
+from oppy.connection.writecoalescer import WriteCoalescer
+
+
+def makeCells(n):
+    return [EncryptedCell.make(1, chr(i) * MAX_PAYLOAD_LEN) for i in xrange(n)]
+
+
+class WriteCoalescerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.writes = []
+        self.coalescer = WriteCoalescer(self.writes.append, max_bytes=2048,
+                                        callLater=self.clock.callLater)
+
+    def test_flushes_at_end_of_turn(self):
+        cells = makeCells(3)
+        for cell in cells:
+            self.coalescer.writeCell(cell)
+        assert self.writes == []
+        assert len(self.coalescer) == 3
+        self.clock.advance(0)
+        assert self.writes == [''.join(c.getBytes() for c in cells)]
+        assert self.clock.getDelayedCalls() == []
+
+    def test_flushes_when_full(self):
+        cells = makeCells(5)
+        for cell in cells:
+            self.coalescer.writeCell(cell)
+        # the fourth cell reached max_bytes
+        assert self.writes == [''.join(c.getBytes() for c in cells[:4])]
+        self.clock.advance(0)
+        assert ''.join(self.writes) == ''.join(c.getBytes() for c in cells)
+
+    def test_max_delay(self):
+        coalescer = WriteCoalescer(self.writes.append, max_delay=0.5,
+                                   callLater=self.clock.callLater)
+        coalescer.writeCell(makeCells(1)[0])
+        self.clock.advance(0.4)
+        assert self.writes == []
+        self.clock.advance(0.1)
+        assert len(self.writes) == 1
+
+    def test_large_cell(self):
+        cell = mock.Mock()
+        cell.__len__ = mock.Mock(return_value=5000)
+        cell.getBytes.return_value = 'x' * 5000
+        small = makeCells(1)[0]
+        self.coalescer.writeCell(small)
+        self.coalescer.writeCell(cell)
+        # order is kept
+        assert self.writes == [small.getBytes(), 'x' * 5000]
+
+    def test_stop(self):
+        self.coalescer.writeCell(makeCells(1)[0])
+        self.coalescer.stop()
+        self.clock.advance(0)
+        assert self.writes == []
+
+    def test_stats(self):
+        before = writecoalescer.coalescingStats()
+        for cell in makeCells(3):
+            self.coalescer.writeCell(cell)
+        self.coalescer.flush()
+        stats = writecoalescer.coalescingStats()
+        assert stats['cells'] - before['cells'] == 3
+        assert stats['flushes'] - before['flushes'] == 1
+        assert stats['max_cells_per_flush'] >= 3
+
+
+class ConnectionCoalescingTests(unittest.TestCase):
+
+    def tearDown(self):
+        writecoalescer.disableWriteCoalescing()
+
+    def openConnection(self):
+        conn = Connection(mock.Mock())
+        conn.transport = mock.Mock()
+        conn._handshake = mock.Mock(link_version=4)
+        conn._handshake.recvCell.return_value = None
+        conn._handshake.isDone.return_value = True
+        conn._recvHandshakeCell(mock.Mock())
+        assert conn._state == ConnState.OPEN
+        return conn
+
+    def test_disabled_by_default(self):
+        conn = self.openConnection()
+        assert conn._coalescer is None
+        conn.writeCell(makeCells(1)[0])
+        assert conn.transport.write.call_count == 1
+
+    def test_enabled(self):
+        writecoalescer.enableWriteCoalescing()
+        conn = self.openConnection()
+        with mock.patch.object(conn._coalescer, '_callLater') as callLater:
+            for cell in makeCells(3):
+                conn.writeCell(cell)
+        assert conn.transport.write.call_count == 0
+        assert callLater.call_count == 1
+        conn._coalescer.flush()
+        assert conn.transport.write.call_count == 1
@@ -0,0 +1,92 @@
+import unittest
+
+from oppy.crypto import backend
+from oppy.crypto.backend import OpenSSLBackend, PyCryptoBackend
+from oppy.crypto.exceptions import CryptoBackendUnavailable
+from test.utils import makeCert, makeKey
+
+
+KEY = 'k' * 16
+
+
+class BackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pycrypto = PyCryptoBackend()
+        try:
+            self.openssl = OpenSSLBackend()
+        except CryptoBackendUnavailable as e:
+            raise unittest.SkipTest(str(e))
+        self.backends = (self.pycrypto, self.openssl)
+
+    def test_aes_ctr(self):
+        data = ''.join(chr(i % 256) for i in xrange(509 * 3))
+        for initial_value in (0, 1, 2 ** 64 + 5):
+            outputs = []
+            for b in self.backends:
+                cipher = b.makeAES128CTRCipher(KEY, initial_value)
+                # keystream continues across calls
+                out = cipher.encrypt(data[:509]) + cipher.encrypt(data[509:])
+                assert b.makeAES128CTRCipher(
+                    KEY, initial_value).decrypt(out) == data
+                outputs.append(out)
+            assert outputs[0] == outputs[1]
+
+    def test_hmac(self):
+        assert self.pycrypto.makeHMACSHA256('msg', 'key') == \
+            self.openssl.makeHMACSHA256('msg', 'key')
+
+    def test_hkdf(self):
+        args = ('secret input', 'salt', 'info', 72)
+        km = self.pycrypto.hkdfSHA256(*args)
+        assert len(km) == 72
+        assert km == self.openssl.hkdfSHA256(*args)
+
+    def test_curve25519_agreement(self):
+        a_secret, a_public = self.pycrypto.generateCurve25519Keypair()
+        b_secret, b_public = self.openssl.generateCurve25519Keypair()
+        assert len(a_public) == len(b_public) == 32
+
+        shared = self.pycrypto.curve25519(a_secret, b_public)
+        assert shared == self.openssl.curve25519(b_secret, a_public)
+        assert shared == self.openssl.curve25519(a_secret, b_public)
+        assert shared == self.pycrypto.curve25519(b_secret, a_public)
+        for b in self.backends:
+            key = b.loadCurve25519Key(b_secret)
+            assert shared == b.curve25519(key, a_public)
+
+    def test_curve25519_zero_point(self):
+        secret, _ = self.pycrypto.generateCurve25519Keypair()
+        for b in self.backends:
+            assert b.curve25519(secret, '\x00' * 32) == '\x00' * 32
+
+    def test_verify_cert_sig(self):
+        id_key = makeKey()
+        other_key = makeKey()
+        id_cert = makeCert(id_key)
+        other_cert = makeCert(other_key)
+        link_cert = makeCert(other_key, issuer_key=id_key)
+        for b in self.backends:
+            assert b.verifyCertSig(id_cert, id_cert) is True
+            assert b.verifyCertSig(id_cert, link_cert) is True
+            assert b.verifyCertSig(other_cert, link_cert) is False
+
+
+class SetBackendTests(unittest.TestCase):
+
+    def tearDown(self):
+        backend.setBackend(backend.DEFAULT_BACKEND)
+
+    def test_default(self):
+        assert isinstance(backend.getBackend(), PyCryptoBackend)
+
+    def test_set_backend(self):
+        try:
+            b = backend.setBackend('openssl')
+        except CryptoBackendUnavailable as e:
+            raise unittest.SkipTest(str(e))
+        assert isinstance(b, OpenSSLBackend)
+        assert backend.getBackend() is b
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, backend.setBackend, 'rot13')
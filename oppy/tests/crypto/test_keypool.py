@@ -0,0 +1,84 @@
+import itertools
+import unittest
+
+from twisted.internet import task
+
+from oppy.crypto import keypool
+from oppy.crypto.keypool import KeypairPool, REFILL_BATCH
+
+
+class KeypairPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        counter = itertools.count()
+        self.generate = lambda: ('secret%d' % next(counter), 'public')
+        self.pool = KeypairPool(5, callLater=self.clock.callLater,
+                                generate=self.generate)
+
+    def test_refills_in_idle_time(self):
+        assert len(self.pool) == 0
+        assert len(self.clock.getDelayedCalls()) == 1
+        self.clock.advance(0)
+        assert len(self.pool) == 5
+        assert self.pool.generated == 5
+        assert self.clock.getDelayedCalls() == []
+
+    def test_refill_batch(self):
+        self.pool.refill()
+        assert len(self.pool) == REFILL_BATCH
+        # the rest is left for later calls
+        self.clock.advance(0)
+        assert len(self.pool) == 5
+
+    def test_miss_when_empty(self):
+        keypair = self.pool.take()
+        assert keypair == ('secret0', 'public')
+        assert self.pool.misses == 1
+        assert self.pool.hits == 0
+
+    def test_keypairs_used_once(self):
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+        taken = [self.pool.take() for _ in xrange(5)]
+        assert len(set(taken)) == 5
+        assert self.pool.hits == 5
+        assert len(self.pool) == 0
+        # taking schedules a refill
+        assert len(self.clock.getDelayedCalls()) == 1
+
+    def test_stats(self):
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+        self.pool.take()
+        stats = self.pool.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 0
+        assert stats['size'] == 4
+        assert stats['target_size'] == 5
+        assert stats['hit_rate'] == 1.0
+
+    def test_stop(self):
+        self.pool.stop()
+        assert self.clock.getDelayedCalls() == []
+        assert len(self.pool) == 0
+
+
+class TakeKeypairTests(unittest.TestCase):
+
+    def tearDown(self):
+        keypool.disableKeypairPool()
+
+    def test_disabled(self):
+        assert keypool.getKeypairPool() is None
+        secret_key, public_key = keypool.takeKeypair()
+        assert len(secret_key) == len(public_key) == 32
+
+    def test_enabled(self):
+        keypool.enableKeypairPool(3)
+        pool = keypool.getKeypairPool()
+        assert pool.target_size == 3
+        pool.refill()
+        keypair = keypool.takeKeypair()
+        assert pool.hits == 1
+        assert keypool.takeKeypair() != keypair
@@ -0,0 +1,73 @@
+import unittest
+
+from twisted.internet import task
+
+from oppy.crypto import keystream
+from oppy.crypto.keystream import PrefetchCipher
+from oppy.crypto.util import makeAES128CTRCipher
+
+
+KEY = 'k' * 16
+BLOCK_SIZE = 1024
+
+
+class PrefetchCipherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cipher = PrefetchCipher(makeAES128CTRCipher(KEY), BLOCK_SIZE,
+                                     callLater=self.clock.callLater)
+        self.plain = makeAES128CTRCipher(KEY)
+
+    def test_matches_cipher(self):
+        for size in (509, 509, 1, 3000, 509, 16, 0, 509):
+            data = chr(size % 256) * size
+            assert self.cipher.encrypt(data) == self.plain.encrypt(data)
+            self.clock.advance(0)
+
+    def test_matches_cipher_without_prefetch(self):
+        # never run the scheduled prefetches
+        for _ in xrange(10):
+            data = 'x' * 509
+            assert self.cipher.encrypt(data) == self.plain.encrypt(data)
+
+    def test_decrypt(self):
+        enc = makeAES128CTRCipher(KEY).encrypt('y' * 509)
+        assert self.cipher.decrypt(enc) == 'y' * 509
+
+    def test_prefetch_scheduled_below_low_water(self):
+        self.cipher.encrypt('x' * 100)
+        assert self.cipher.available() == BLOCK_SIZE - 100
+        assert len(self.clock.getDelayedCalls()) == 0
+
+        self.cipher.encrypt('x' * 500)
+        assert len(self.clock.getDelayedCalls()) == 1
+        # only one prefetch is scheduled at a time
+        self.cipher.encrypt('x' * 10)
+        assert len(self.clock.getDelayedCalls()) == 1
+
+        self.clock.advance(0)
+        assert self.cipher.available() == 2 * BLOCK_SIZE - 610
+
+    def test_large_encrypt(self):
+        data = 'z' * (BLOCK_SIZE * 3 + 7)
+        assert self.cipher.encrypt(data) == self.plain.encrypt(data)
+        assert self.cipher.available() >= 0
+
+
+class WrapCipherTests(unittest.TestCase):
+
+    def tearDown(self):
+        keystream.disablePrefetch()
+
+    def test_disabled(self):
+        cipher = makeAES128CTRCipher(KEY)
+        assert keystream.isPrefetchEnabled() is False
+        assert keystream.wrapCipher(cipher) is cipher
+
+    def test_enabled(self):
+        keystream.enablePrefetch(BLOCK_SIZE)
+        assert keystream.isPrefetchEnabled() is True
+        wrapped = keystream.wrapCipher(makeAES128CTRCipher(KEY))
+        assert isinstance(wrapped, PrefetchCipher)
+        assert wrapped.block_size == BLOCK_SIZE
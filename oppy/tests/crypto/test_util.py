@@ -0,0 +1,208 @@
+import hashlib
+import unittest
+
+import oppy.cell.pool as pool
+
+from oppy.cell.definitions import RELAY_CMD
+from oppy.cell.fixedlen import EncryptedCell, RelayHeaderCache
+from oppy.cell.relay import RelayDataCell, RelayEndCell, RelaySendMeCell
+from oppy.crypto import util
+from oppy.crypto.exceptions import UnrecognizedCell
+from oppy.crypto.relaycrypto import RelayCrypto
+
+
+CIRC_ID = 1
+
+
+def makeCryptPath(hops=3):
+    crypt_path = []
+    for i in xrange(hops):
+        fdigest = hashlib.sha1('forward' + str(i))
+        bdigest = hashlib.sha1('backward' + str(i))
+        fcipher = util.makeAES128CTRCipher(chr(i) * 16)
+        bcipher = util.makeAES128CTRCipher(chr(i + 16) * 16)
+        crypt_path.append(RelayCrypto(fdigest, bdigest, fcipher, bcipher))
+    return crypt_path
+
+
+def makeCells(count, link_version=3):
+    return [RelayDataCell.make(CIRC_ID, i + 1, chr(i) * (i * 7 % 498 + 1),
+                               link_version)
+            for i in xrange(count)]
+
+
+class EncryptCellsToTargetTests(unittest.TestCase):
+
+    def _check(self, count, target=2, early=False, headers=None):
+        single_path = makeCryptPath()
+        batch_path = makeCryptPath()
+
+        expected = [util.encryptCellToTarget(cell, single_path, target,
+                                             early, headers)
+                    for cell in makeCells(count)]
+        batched = util.encryptCellsToTarget(makeCells(count), batch_path,
+                                            target, early, headers)
+
+        assert [c.getBytes() for c in batched] == \
+            [c.getBytes() for c in expected]
+        # ciphers and digests must be left in the same state too
+        for single, batch in zip(single_path, batch_path):
+            assert single.forward_digest.digest() == \
+                batch.forward_digest.digest()
+            assert single.forward_cipher.encrypt('\x00' * 16) == \
+                batch.forward_cipher.encrypt('\x00' * 16)
+
+    def test_single_cell(self):
+        self._check(1)
+
+    def test_many_cells(self):
+        self._check(20)
+
+    def test_targets(self):
+        for target in xrange(3):
+            self._check(5, target=target)
+
+    def test_early(self):
+        self._check(3, target=0, early=True)
+
+    def test_header_cache(self):
+        self._check(5, headers=RelayHeaderCache(CIRC_ID))
+
+    def test_sets_digests(self):
+        cells = makeCells(3)
+        util.encryptCellsToTarget(cells, makeCryptPath())
+        assert all(c.rheader.digest != '\x00' * 4 for c in cells)
+
+    def test_empty(self):
+        assert util.encryptCellsToTarget([], makeCryptPath()) == []
+
+
+def makeInbound(cells_and_origins, relay_path):
+    '''Encrypt each (cell, origin) pair the way the relays on a circuit
+    would, using *relay_path* (the relays' side of the crypt path).'''
+    encrypted = []
+    for cell, origin in cells_and_origins:
+        if cell is None:
+            # junk that passed through every hop without being recognized
+            payload = 'garbage!' * 63 + 'g' * 5
+            origin = len(relay_path) - 1
+        else:
+            relay = relay_path[origin]
+            payload = util.makePayloadWithDigest(cell.getPayload())
+            relay.backward_digest.update(payload)
+            payload = util.makePayloadWithDigest(
+                payload, relay.backward_digest.digest()[:4])
+        for node in xrange(origin, -1, -1):
+            payload = relay_path[node].backward_cipher.encrypt(payload)
+        encrypted.append(EncryptedCell.make(CIRC_ID, payload))
+    return encrypted
+
+
+class DecryptCellsUntilRecognizedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.inbound = [
+            (RelayDataCell.make(CIRC_ID, 1, 'a' * 498), 2),
+            (RelayDataCell.make(CIRC_ID, 1, 'b' * 10), 2),
+            (RelaySendMeCell.make(CIRC_ID, 1), 2),
+            (None, None),
+            (RelayDataCell.make(CIRC_ID, 2, 'c'), 1),
+            (RelayEndCell.make(CIRC_ID, 2), 0),
+            (RelayDataCell.make(CIRC_ID, 3, 'd' * 300), 2),
+        ]
+
+    def tearDown(self):
+        pool.disablePooling()
+
+    def _decryptOneByOne(self, cells, crypt_path):
+        results = []
+        for cell in cells:
+            try:
+                results.append(util.decryptCellUntilRecognized(cell,
+                                                               crypt_path))
+            except UnrecognizedCell:
+                results.append(None)
+        return results
+
+    def _check(self, inbound):
+        single_path = makeCryptPath()
+        batch_path = makeCryptPath()
+
+        expected = self._decryptOneByOne(
+            makeInbound(inbound, makeCryptPath()), single_path)
+        batched = util.decryptCellsUntilRecognized(
+            makeInbound(inbound, makeCryptPath()), batch_path)
+
+        assert len(batched) == len(inbound)
+        for result, (cell, origin) in zip(batched, inbound):
+            if cell is None:
+                assert result is None
+            else:
+                dec, dec_origin = result
+                assert dec_origin == origin
+                assert type(dec) is type(cell)
+                assert util.makePayloadWithDigest(dec.getPayload()) == \
+                    cell.getPayload()
+        assert batched == expected
+        # ciphers and digests must be left in the same state too
+        for single, batch in zip(single_path, batch_path):
+            assert single.backward_digest.digest() == \
+                batch.backward_digest.digest()
+            assert single.backward_cipher.decrypt('\x00' * 16) == \
+                batch.backward_cipher.decrypt('\x00' * 16)
+
+    def test_mixed_origins(self):
+        self._check(self.inbound)
+
+    def test_all_from_exit(self):
+        self._check([(RelayDataCell.make(CIRC_ID, 1, chr(i) * 100), 2)
+                     for i in xrange(20)])
+
+    def test_single_cell(self):
+        self._check(self.inbound[:1])
+
+    def test_pooled(self):
+        pool.enablePooling()
+        self._check(self.inbound)
+
+    def test_empty(self):
+        assert util.decryptCellsUntilRecognized([], makeCryptPath()) == []
+
+    def test_keeps_relay_cmd(self):
+        cells = makeInbound(self.inbound[:1], makeCryptPath())
+        (dec, _), = util.decryptCellsUntilRecognized(cells, makeCryptPath())
+        assert dec.header.cmd == RELAY_CMD
+        assert dec.header.circ_id == CIRC_ID
+
+
+class RecognitionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cell = RelayDataCell.make(CIRC_ID, 1, 'a' * 100)
+        self.relay_path = makeCryptPath()
+        self.encrypted, = makeInbound([(self.cell, 2)], self.relay_path)
+
+    def test_cell_recognized(self):
+        crypt_path = makeCryptPath()
+        payload = self.encrypted.getPayload()
+        for node in xrange(2):
+            payload = crypt_path[node].backward_cipher.decrypt(payload)
+            assert util.cellRecognized(payload, crypt_path[node]) is False
+        payload = crypt_path[2].backward_cipher.decrypt(payload)
+        before = crypt_path[2].backward_digest.digest()
+        assert util.cellRecognized(payload, crypt_path[2]) is True
+        # checking doesn't advance the digest
+        assert crypt_path[2].backward_digest.digest() == before
+
+    def test_winning_digest_replaces_running_digest(self):
+        crypt_path = makeCryptPath()
+        others = [crypt_path[node].backward_digest for node in xrange(2)]
+        _, origin = util.decryptCellUntilRecognized(self.encrypted,
+                                                    crypt_path)
+        assert origin == 2
+        assert crypt_path[2].backward_digest.digest() == \
+            self.relay_path[2].backward_digest.digest()
+        # hops that didn't recognize the cell keep their digest untouched
+        assert [crypt_path[node].backward_digest for node in xrange(2)] == \
+            others
+        assert others[0].digest() == hashlib.sha1('backward0').digest()
@@ -0,0 +1,106 @@
+import unittest
+
+from twisted.internet import defer
+
+from oppy.crypto import workers
+from oppy.crypto.workers import OrderedCryptoQueue
+
+
+class FakeThreads(object):
+    '''Runs each job when the test says so, instead of in a thread.'''
+
+    def __init__(self):
+        self.jobs = []
+
+    def __call__(self, func, *args):
+        d = defer.Deferred()
+        self.jobs.append((func, args, d))
+        return d
+
+    def finish(self):
+        func, args, d = self.jobs.pop(0)
+        try:
+            result = func(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+
+class OrderedCryptoQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = FakeThreads()
+        self.queue = OrderedCryptoQueue(runInThread=self.threads)
+
+    def test_one_job_at_a_time_in_order(self):
+        results = []
+        for i in xrange(3):
+            self.queue.submit(lambda x: x * 2, i).addCallback(results.append)
+        assert len(self.threads.jobs) == 1
+        assert len(self.queue) == 3
+        self.threads.finish()
+        assert results == [0]
+        assert len(self.threads.jobs) == 1
+        self.threads.finish()
+        self.threads.finish()
+        assert results == [0, 2, 4]
+        assert len(self.queue) == 0
+
+    def test_job_submitted_from_callback_runs_after_queued_jobs(self):
+        order = []
+
+        def submitMore(_):
+            self.queue.submit(order.append, 'c')
+        self.queue.submit(order.append, 'a').addCallback(submitMore)
+        self.queue.submit(order.append, 'b')
+        while self.threads.jobs:
+            self.threads.finish()
+        assert order == ['a', 'b', 'c']
+
+    def test_errors(self):
+        failures = []
+        d = self.queue.submit(lambda: 1 / 0)
+        d.addErrback(failures.append)
+        self.queue.submit(lambda: None)
+        self.threads.finish()
+        failures[0].trap(ZeroDivisionError)
+        # later jobs still run
+        assert len(self.threads.jobs) == 1
+
+    def test_stop(self):
+        fired = []
+        self.queue.submit(lambda: None).addCallback(fired.append)
+        self.queue.submit(lambda: None).addCallback(fired.append)
+        self.queue.stop()
+        self.threads.finish()
+        assert fired == []
+        assert self.threads.jobs == []
+        self.queue.submit(lambda: None)
+        assert self.threads.jobs == []
+
+
+class WorkerCryptoTests(unittest.TestCase):
+
+    def tearDown(self):
+        workers.disableWorkerCrypto()
+
+    def test_disabled_by_default(self):
+        assert workers.isWorkerCryptoEnabled() is False
+        assert workers.makeQueue() is None
+
+    def test_enable(self):
+        workers.enableWorkerCrypto(2)
+        assert workers.isWorkerCryptoEnabled() is True
+        assert isinstance(workers.makeQueue(), OrderedCryptoQueue)
+        workers.disableWorkerCrypto()
+        assert workers.makeQueue() is None
+
+    def test_open_queue_survives_disable(self):
+        workers.enableWorkerCrypto(1)
+        queue = workers.makeQueue()
+        workers.disableWorkerCrypto()
+        results = []
+        queue.submit(lambda x: x * 2, 2).addCallback(results.append)
+        # the pool is gone, so the job runs on the reactor thread
+        assert results == [4]
@@ -0,0 +1,103 @@
+import base64
+import hashlib
+import os
+import struct
+import unittest
+import zlib
+
+import mock
+
+from oppy.cell.definitions import LSTYPE_IPv4, LSTYPE_IPv6, LSTYPE_LEGACY
+from oppy.crypto.ntorhandshake import NTorHandshake
+from oppy.netstatus import netstatus
+from oppy.netstatus.handshakematerial import (
+    HandshakeMaterial,
+    getHandshakeMaterial,
+    makeHandshakeMaterial,
+)
+
+
+class FakeRelay(object):
+
+    def __init__(self, address='10.1.2.3', ntor=True):
+        self.fingerprint = 'F' * 40
+        self.address = address
+        self.or_port = 9001
+        self.key_der = os.urandom(140)
+        b64 = base64.b64encode(self.key_der)
+        self.signing_key = '\n'.join(['-----BEGIN RSA PUBLIC KEY-----',
+                                      b64[:64], b64[64:128], b64[128:],
+                                      '-----END RSA PUBLIC KEY-----'])
+        self.ntor_key = os.urandom(32)
+        if ntor:
+            self.ntor_onion_key = base64.b64encode(self.ntor_key)
+        else:
+            self.ntor_onion_key = None
+
+
+class HandshakeMaterialTests(unittest.TestCase):
+
+    def test_material(self):
+        relay = FakeRelay()
+        material = makeHandshakeMaterial(relay)
+        assert material.identity_digest == \
+            hashlib.sha1(relay.key_der).digest()
+        assert material.ntor_onion_key == relay.ntor_key
+        ipv4, legacy = material.link_specifiers
+        assert ipv4.lstype == LSTYPE_IPv4
+        assert ipv4.getBytes()[2:] == '\x0a\x01\x02\x03' + \
+            struct.pack('!H', 9001)
+        assert legacy.lstype == LSTYPE_LEGACY
+        assert legacy.lspec == material.identity_digest
+
+    def test_ipv6(self):
+        material = makeHandshakeMaterial(FakeRelay(address='::1'))
+        assert material.link_specifiers[0].lstype == LSTYPE_IPv6
+
+    def test_no_ntor_key(self):
+        assert makeHandshakeMaterial(FakeRelay(ntor=False)).ntor_onion_key \
+            is None
+
+    def test_uses_attached_material(self):
+        relay = FakeRelay()
+        relay.handshake_material = makeHandshakeMaterial(relay)
+        assert getHandshakeMaterial(relay) is relay.handshake_material
+
+    def test_computes_missing_material(self):
+        relay = FakeRelay()
+        assert isinstance(getHandshakeMaterial(relay), HandshakeMaterial)
+        # anything else in the attribute is ignored
+        relay.handshake_material = mock.Mock()
+        assert isinstance(getHandshakeMaterial(relay), HandshakeMaterial)
+
+    def test_onion_skin(self):
+        relay = FakeRelay()
+        relay.handshake_material = makeHandshakeMaterial(relay)
+        skin = NTorHandshake(relay).createOnionSkin()
+        assert skin[:20] == hashlib.sha1(relay.key_der).digest()
+        assert skin[20:52] == relay.ntor_key
+
+
+class ProcessDescriptorsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ns = netstatus.NetStatus.__new__(netstatus.NetStatus)
+        self.relays = [FakeRelay(), FakeRelay(address='not an address')]
+        self.relays[1].fingerprint = 'E' * 40
+        self.ns._consensus = mock.Mock()
+        self.ns._consensus.routers = dict(
+            (r.fingerprint, mock.Mock(flags=['Fast'])) for r in self.relays)
+
+    def test_attaches_material(self):
+        with mock.patch.object(netstatus, 'parse_file',
+                               return_value=iter(self.relays)):
+            descriptors = self.ns._processDescriptors(zlib.compress(''))
+        good, bad = self.relays
+        assert descriptors[good.fingerprint] is good
+        material = good.handshake_material
+        assert material.identity_digest == hashlib.sha1(good.key_der).digest()
+        assert material.ntor_onion_key == good.ntor_key
+        assert good.flags == set(['Fast'])
+        # relays whose material can't be computed are still kept
+        assert descriptors[bad.fingerprint] is bad
+        assert not hasattr(bad, 'handshake_material')
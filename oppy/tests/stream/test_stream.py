@@ -0,0 +1,32 @@
+import unittest
+
+import mock
+
+from oppy.stream.stream import Stream
+
+
+class StreamCloseTests(unittest.TestCase):
+
+    @mock.patch('oppy.stream.stream.circuit_manager')
+    def setUp(self, mock_manager):
+        self.stream = Stream(mock.Mock(), mock.Mock())
+        self.circuit = mock.Mock()
+        self.stream._registerNewStream(self.circuit)
+        self.stream.streamConnected()
+
+    def test_close_after_queued_data(self):
+        self.stream.pauseWriting()
+        self.stream.writeData('a')
+        self.stream.writeData('b')
+        self.stream.closeFromSOCKS()
+        assert self.circuit.unregisterStream.call_count == 0
+        self.stream.resumeWriting()
+        self.circuit.writeData.assert_has_calls(
+            [mock.call('a', self.stream.stream_id),
+             mock.call('b', self.stream.stream_id)])
+        self.circuit.unregisterStream.assert_called_once_with(self.stream)
+
+    def test_close_before_connected(self):
+        self.stream._connected = False
+        self.stream.closeFromSOCKS()
+        self.circuit.unregisterStream.assert_called_once_with(self.stream)
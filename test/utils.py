@@ -1,4 +1,7 @@
 import unittest
+
+import OpenSSL
+
 from mock import patch
 
 
@@ -24,6 +27,27 @@ class DataTestCase(BaseTestCase):
                 DATA_BASE[:(size % len(DATA_BASE))])
 
 
+def makeKey(bits=1024):
+    key = OpenSSL.crypto.PKey()
+    key.generate_key(OpenSSL.crypto.TYPE_RSA, bits)
+    return key
+
+
+def makeCert(key, issuer_key=None, not_before=-3600, not_after=3600):
+    '''Make a certificate for *key*, signed by *issuer_key* (or
+    self-signed), valid from *not_before* to *not_after* seconds from
+    now.'''
+    cert = OpenSSL.crypto.X509()
+    cert.get_subject().CN = 'oppy'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(not_before)
+    cert.gmtime_adj_notAfter(not_after)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(issuer_key or key, 'sha1')
+    return cert
+
+
 # this code gleefully stolen from jsbueno on stack overflow
 # http://stackoverflow.com/questions/9757299/python-testing-an-abstract-base-class
 def concrete(abclass):
@@ -44,6 +68,8 @@ def concrete(abclass):
         return abclass
 
     new_dict = abclass.__dict__.copy()
+    # let the dummy class have a __dict__ so tests can set attributes on it
+    new_dict.pop('__slots__', None)
     for abstractmethod in abclass.__abstractmethods__:
         # replace each abc method or property with an identity function:
         new_dict[abstractmethod] = lambda x, *args, **kw: (x, args, kw)